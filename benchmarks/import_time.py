@@ -0,0 +1,147 @@
+# Checks that each lightbeam command only imports what it needs (with `python -X importtime`), and measures
+# how long it spends importing modules. Since lightbeam is often run many times (with small selectors) from
+# orchestrators like Airflow, start-up time matters.
+#
+# Commands are run (only reading data) against the Ed-Fi API configured by the environment variables
+# EDFI_API_BASE_URL, EDFI_API_CLIENT_ID, and EDFI_API_CLIENT_SECRET (as for `test_lightbeam.py`), or if
+# EDFI_API_BASE_URL isn't set, against a mock API (see `mock_api.py`) started for the purpose:
+#     python benchmarks/import_time.py [--runs 5] [--save-baseline]
+# This prints the import time of each command (the median over `--runs`), and exits with an error if any
+# command imports a module it shouldn't, or (compared to a baseline saved from an earlier run with
+# `--save-baseline` on the same machine) its import time is higher by more than `--tolerance`.
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import statistics
+import subprocess
+import contextlib
+from mock_api import MockServer
+
+# command: (lightbeam arguments, (slow-to-import) modules it mustn't import)
+COMMANDS = {
+    "--version": (["--version"], ["yaml", "requests", "aiohttp", "jsonschema", "dateutil", "pandas"]),
+    "count": (["count", "-s", "schools"], ["jsonschema", "pandas"]),
+    "fetch": (["fetch", "-s", "schools", "--set", "data_dir", "{dir}/fetched/"], ["jsonschema", "pandas"]),
+    # (descriptor values are cached by the first, unmeasured run - see below - so needn't be fetched)
+    "validate": (["validate", "-s", "schools"], ["aiohttp", "pandas"]),
+    "validate --offline": (["validate", "-s", "schools", "--offline"], ["requests", "aiohttp", "pandas"]),
+    "create": (["create", "-s", "schools"], ["aiohttp", "jsonschema", "pandas"]),
+    "generate": (["generate", "-s", "schools", "-f", "--set", "data_dir", "{dir}/generated/"], ["aiohttp", "jsonschema", "pandas"]),
+}
+# (import times lower than a baseline's by less than this many milliseconds aren't regressions, whatever
+# `--tolerance`, since they're within the noise of measuring a few milliseconds)
+MIN_REGRESSION_MS = 5
+
+CONFIG = """state_dir: {dir}/state
+data_dir: {dir}/data/
+edfi_api:
+  base_url: {base_url}
+  version: 3
+  mode: {mode}
+  client_id: {client_id}
+  client_secret: {client_secret}
+connection:
+  verify_ssl: False
+validate:
+  references:
+    remote: False
+log_level: WARNING
+"""
+
+# (a payload to validate; whether it's valid doesn't matter)
+SCHOOL = {"schoolId": 1, "nameOfInstitution": "Benchmark School",
+    "educationOrganizationCategories": [{"educationOrganizationCategoryDescriptor": "uri://ed-fi.org/EducationOrganizationCategoryDescriptor#School"}],
+    "gradeLevels": [{"gradeLevelDescriptor": "uri://ed-fi.org/GradeLevelDescriptor#Ninth grade"}]}
+
+
+# Returns the modules imported by a Python process (per `-X importtime` output on `stderr`), as a
+# dictionary of module -> cumulative import time (in microseconds) of those imported first by
+# the process itself, and a set of the packages of all of them
+def parse_import_times(stderr):
+    times = {}
+    packages = set()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line: continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        packages.add(name.strip().split(".")[0])
+        if name.startswith("  "): continue # (imported by another module, so already counted in its time)
+        times[name.strip()] = times.get(name.strip(), 0) + int(cumulative)
+    return times, packages
+
+# Runs lightbeam (from this repository) with `args`, in a new directory (so `create` can run repeatedly)
+def run(args, dir):
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return subprocess.run([sys.executable, "-X", "importtime", "-m", "lightbeam"] + args,
+        cwd=tempfile.mkdtemp(dir=dir), env=env, capture_output=True, text=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the import time of each lightbeam command")
+    parser.add_argument("--runs", type=int, default=5, help="number of times to run each command")
+    parser.add_argument("--baseline", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "output", "import_time_baseline.json"), help="JSON file of a baseline run to compare to")
+    parser.add_argument("--save-baseline", action="store_true", help="save the import times of this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative increase in a command's import time (from the baseline) that's a regression")
+    args = parser.parse_args()
+
+    # (modules imported by the interpreter itself at start-up aren't counted)
+    startup = subprocess.run([sys.executable, "-X", "importtime", "-c", "pass"], capture_output=True, text=True)
+    startup_modules = set(parse_import_times(startup.stderr)[0].keys())
+
+    baseline = {}
+    if not args.save_baseline and os.path.isfile(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+
+    with tempfile.TemporaryDirectory() as dir, contextlib.ExitStack() as stack:
+        base_url = os.environ.get("EDFI_API_BASE_URL", None) or stack.enter_context(MockServer())
+        os.makedirs(os.path.join(dir, "data"))
+        os.makedirs(os.path.join(dir, "fetched"))
+        os.makedirs(os.path.join(dir, "generated"))
+        with open(os.path.join(dir, "data", "schools.jsonl"), "w") as file:
+            file.write(json.dumps(SCHOOL) + "\n")
+        config_file = os.path.join(dir, "lightbeam.yml")
+        with open(config_file, "w") as file:
+            file.write(CONFIG.format(dir=dir,
+                base_url=base_url,
+                mode=os.environ.get("EDFI_API_MODE", "sandbox"),
+                client_id=os.environ.get("EDFI_API_CLIENT_ID", "populated"),
+                client_secret=os.environ.get("EDFI_API_CLIENT_SECRET", "populatedSecret")))
+
+        failures = []
+        results = {}
+        print(f"{'command':<20} {'imports (ms)':>12} {'baseline (ms)':>14}  slowest imports")
+        for command, (command_args, unwanted) in COMMANDS.items():
+            command_args = [ arg.format(dir=dir) for arg in command_args ]
+            if command_args[0]!="--version": command_args = command_args + ["-c", config_file]
+            # (the first run caches API metadata, for `--offline`, and compiles bytecode; it isn't counted)
+            result = run(command_args, dir)
+            if result.returncode!=0:
+                sys.exit(f"`lightbeam {' '.join(command_args)}` failed:\n{result.stderr[-2000:]}")
+            totals = []
+            for _ in range(args.runs):
+                times, packages = parse_import_times(run(command_args, dir).stderr)
+                times = { name: time for name, time in times.items() if name not in startup_modules }
+                totals.append(sum(times.values()) / 1000)
+            slowest = sorted(times.items(), key=lambda x: -x[1])[:3]
+            total = results[command] = round(statistics.median(totals), 1)
+            baseline_total = baseline.get(command, None)
+            print(f"{command:<20} {total:>12.1f} {'' if baseline_total is None else baseline_total:>14}  " + ", ".join(f"{name} ({time/1000:.0f})" for name, time in slowest))
+            imported = [ module for module in unwanted if module in packages ]
+            if imported:
+                failures.append(f"`{command}` imports {', '.join(imported)}")
+            if baseline_total is not None and total > baseline_total * (1 + args.tolerance) and total - baseline_total > MIN_REGRESSION_MS:
+                failures.append(f"`{command}` import time {baseline_total} -> {total} ms ({(total - baseline_total) / baseline_total:+.0%})")
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"saved baseline to {args.baseline}")
+
+    if failures:
+        sys.exit("failed:\n  " + "\n  ".join(failures))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,468 @@
+# A lightweight, in-memory stand-in for an Ed-Fi API, so lightbeam's commands can be run (and benchmarked)
+# reproducibly on a laptop, without Docker or an ODS. It serves:
+# * the base URL's metadata, `dependencies`, and Swagger docs (from the JSON files in `fixtures/`)
+# * OAuth tokens, which expire after `--token-expiry` seconds
+# * `GET`/`POST`/`DELETE` of resources and descriptors, stored in memory: `POST`s upsert by natural key,
+#   and `GET`s support `offset`/`limit` paging, `totalCount` (the `Total-Count` header), searching by
+#   (natural key or other) property values, change versions, and partitions (`pageToken`/`pageSize`)
+# * `GET /__stats`, the number of requests received (by method and path), percentiles of the time taken to
+#   respond to data requests, the number of OAuth tokens issued, and the number of records of each endpoint
+#   (`DELETE /__stats` resets the counts of requests)
+# Requests can be slowed down (`--latency-ms`, with a `fixed`, `uniform`, or `lognormal` distribution), and
+# a random fraction of data requests can be made to fail with 429s (`--throttle-rate`) or 5xxs
+# (`--error-rate`). Unlike a real Ed-Fi API, it doesn't validate payloads or check that references exist.
+#
+# Run it with
+#     python benchmarks/mock_api.py --port 8765 [--latency-ms 50] [--error-rate 0.01] ...
+# then point lightbeam at `http://127.0.0.1:8765/` (with any client ID and secret). Descriptor values are
+# loaded at start-up from the JSONL files in `fixtures/seed/` (or `--seed-dir`). Benchmarks can start it
+# with `with MockServer(...) as base_url:`.
+
+import os
+import sys
+import json
+import time
+import uuid
+import base64
+import bisect
+import random
+import asyncio
+import hashlib
+import argparse
+import socket
+import statistics
+import subprocess
+import urllib.request
+from aiohttp import web
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+LATENCY_DISTRIBUTIONS = ["fixed", "uniform", "lognormal"]
+ERROR_STATUSES = [500, 503, 504]
+
+
+class MockEdFiAPI:
+
+    def __init__(self, fixtures_dir=FIXTURES_DIR, token_expiry=1800, latency_ms=0, latency_distribution="fixed", error_rate=0.0, throttle_rate=0.0, random_seed=None):
+        self.token_expiry = token_expiry
+        self.latency_ms = latency_ms
+        self.latency_distribution = latency_distribution
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(random_seed)
+        self.tokens = {}        # token -> expiry time
+        self.records = {}       # endpoint -> {key: record}
+        self.keys = {}          # endpoint -> [key] (sorted)
+        self.ids = {}           # endpoint -> {id: key}
+        self.identities = {}    # endpoint -> {natural key: key}
+        self.tombstones = {}    # endpoint -> [deleted record]
+        self.next_key = 0
+        self.change_version = 0
+        self.request_counts = {}
+        self.path_counts = {}
+        self.latencies = [] # (seconds taken to respond to each data request)
+        self.in_flight = {}     # method and path -> number of data requests being responded to
+        self.concurrency = {}   # method and path -> most data requests responded to at once
+        self.metadata_bodies = {}
+        with open(os.path.join(fixtures_dir, "resources-swagger.json")) as f: self.resources_swagger = json.load(f)
+        with open(os.path.join(fixtures_dir, "descriptors-swagger.json")) as f: self.descriptors_swagger = json.load(f)
+        with open(os.path.join(fixtures_dir, "dependencies.json")) as f: self.dependencies = json.load(f)
+        self.endpoints = {} # endpoint -> namespace
+        for dependency in self.dependencies:
+            namespace, endpoint = dependency["resource"].strip("/").split("/")
+            self.endpoints[endpoint] = namespace
+            self.records[endpoint] = {}
+            self.keys[endpoint] = []
+            self.ids[endpoint] = {}
+            self.identities[endpoint] = {}
+            self.tombstones[endpoint] = []
+
+    def app(self):
+        app = web.Application(middlewares=[self.middleware])
+        app.router.add_get("/", self.get_base)
+        app.router.add_get("/__stats", self.get_stats)
+        app.router.add_delete("/__stats", self.delete_stats)
+        app.router.add_get("/metadata/", self.get_openapi_metadata)
+        app.router.add_get("/metadata/data/v3/dependencies", self.get_dependencies)
+        app.router.add_get("/metadata/data/v3/resources/swagger.json", self.get_resources_swagger)
+        app.router.add_get("/metadata/data/v3/descriptors/swagger.json", self.get_descriptors_swagger)
+        app.router.add_post("/oauth/token", self.post_token)
+        app.router.add_get("/changeQueries/v1/availableChangeVersions", self.get_available_change_versions)
+        app.router.add_get("/data/v3/{namespace}/{endpoint}", self.get_records)
+        app.router.add_post("/data/v3/{namespace}/{endpoint}", self.post_record)
+        app.router.add_get("/data/v3/{namespace}/{endpoint}/partitions", self.get_partitions)
+        app.router.add_get("/data/v3/{namespace}/{endpoint}/deletes", self.get_deletes)
+        app.router.add_get("/data/v3/{namespace}/{endpoint}/{id}", self.get_record)
+        app.router.add_delete("/data/v3/{namespace}/{endpoint}/{id}", self.delete_record)
+        return app
+
+    # counts (and times) requests, adds latency, and (for data requests) injects errors and checks the OAuth token
+    @web.middleware
+    async def middleware(self, request, handler):
+        path = request.method + " " + request.path
+        if not request.path.startswith("/__"):
+            self.request_counts[request.method] = self.request_counts.get(request.method, 0) + 1
+            self.path_counts[path] = self.path_counts.get(path, 0) + 1
+        if not request.path.startswith("/data/"):
+            return await self.respond(request, handler)
+        start = time.perf_counter()
+        self.in_flight[path] = self.in_flight.get(path, 0) + 1
+        self.concurrency[path] = max(self.concurrency.get(path, 0), self.in_flight[path])
+        try:
+            return await self.respond(request, handler)
+        finally:
+            self.in_flight[path] -= 1
+            self.latencies.append(time.perf_counter() - start)
+
+    async def respond(self, request, handler):
+        if self.latency_ms:
+            if self.latency_distribution=="uniform": delay = self.random.uniform(0, 2 * self.latency_ms)
+            elif self.latency_distribution=="lognormal": delay = self.random.lognormvariate(0, 0.5) * self.latency_ms
+            else: delay = self.latency_ms
+            await asyncio.sleep(delay / 1000)
+        if request.path.startswith("/data/"):
+            if self.throttle_rate and self.random.random() < self.throttle_rate:
+                return web.json_response({"message": "Too many requests."}, status=429)
+            if self.error_rate and self.random.random() < self.error_rate:
+                return web.json_response({"message": "An unexpected error occurred on the server."}, status=self.random.choice(ERROR_STATUSES))
+            token = request.headers.get("Authorization", "").replace("Bearer ", "")
+            if self.tokens.get(token, 0) < time.time():
+                return web.json_response({"message": "Authorization denied. The access token is expired."}, status=401)
+        return await handler(request)
+
+    def url(self, request, path):
+        return f"{request.scheme}://{request.host}{path}"
+
+    async def get_base(self, request):
+        return web.json_response({
+            "version": "5.3",
+            "apiMode": "Sandbox",
+            "urls": {
+                "dependencies": self.url(request, "/metadata/data/v3/dependencies"),
+                "openApiMetadata": self.url(request, "/metadata/"),
+                "oauth": self.url(request, "/oauth/token"),
+                "dataManagementApi": self.url(request, "/data/v3/"),
+                "changeQueries": self.url(request, "/changeQueries/v1/"),
+            }
+        })
+
+    # returns a JSON metadata document, with an ETag (and a 304 if it matches the request's `If-None-Match`)
+    def metadata_response(self, request, name, document):
+        if name not in self.metadata_bodies:
+            body = json.dumps(document)
+            self.metadata_bodies[name] = (body, '"' + hashlib.md5(body.encode()).hexdigest() + '"')
+        body, etag = self.metadata_bodies[name]
+        if request.headers.get("If-None-Match")==etag:
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(body=body, content_type="application/json", headers={"ETag": etag})
+
+    # returns the 50th, 95th, and 99th percentiles of the time taken to respond to data requests (in milliseconds)
+    def get_latency_percentiles(self):
+        if len(self.latencies) < 2: return {}
+        percentiles = statistics.quantiles(self.latencies, n=100, method="inclusive")
+        return { f"p{p}": round(percentiles[p-1] * 1000, 3) for p in (50, 95, 99) }
+
+    async def get_stats(self, request):
+        return web.json_response({
+            "methods": self.request_counts,
+            "paths": self.path_counts,
+            "concurrency": self.concurrency,
+            "latency_ms": self.get_latency_percentiles(),
+            "tokens": len(self.tokens),
+            "records": { endpoint: len(records) for endpoint, records in self.records.items() },
+        })
+
+    async def delete_stats(self, request):
+        self.request_counts = {}
+        self.path_counts = {}
+        self.concurrency = {}
+        self.latencies = []
+        return web.Response(status=204)
+
+    async def get_openapi_metadata(self, request):
+        # (its URLs depend on the host requested)
+        return self.metadata_response(request, "openApiMetadata " + request.host, [
+            {"name": "Resources", "endpointUri": self.url(request, "/metadata/data/v3/resources/swagger.json"), "prefix": ""},
+            {"name": "Descriptors", "endpointUri": self.url(request, "/metadata/data/v3/descriptors/swagger.json"), "prefix": ""},
+        ])
+
+    async def get_dependencies(self, request):
+        return self.metadata_response(request, "dependencies", self.dependencies)
+
+    async def get_resources_swagger(self, request):
+        return self.metadata_response(request, "resources", self.resources_swagger)
+
+    async def get_descriptors_swagger(self, request):
+        return self.metadata_response(request, "descriptors", self.descriptors_swagger)
+
+    async def post_token(self, request):
+        token = uuid.uuid4().hex
+        self.tokens[token] = time.time() + self.token_expiry
+        return web.json_response({"access_token": token, "expires_in": self.token_expiry, "token_type": "bearer"})
+
+    async def get_available_change_versions(self, request):
+        return web.json_response({"oldestChangeVersion": 0, "newestChangeVersion": self.change_version})
+
+    # returns the natural key of a record (a sorted tuple of (property, value) pairs), per its Swagger definition
+    def get_identity(self, endpoint, record):
+        if endpoint.endswith("Descriptors"):
+            return (("codeValue", str(record.get("codeValue"))), ("namespace", str(record.get("namespace"))))
+        definition = self.resources_swagger["definitions"]["edFi_" + self.singularize(endpoint)]
+        identity = []
+        for prop, schema in definition["properties"].items():
+            if "$ref" in schema and prop in definition.get("required", []):
+                for k, v in (record.get(prop) or {}).items():
+                    if k!="link": identity.append((k, str(v)))
+            elif schema.get("x-Ed-Fi-isIdentity", False):
+                identity.append((prop, str(record.get(prop))))
+        return tuple(sorted(identity))
+
+    @staticmethod
+    def singularize(endpoint):
+        if endpoint.endswith("ies"): return endpoint[:-3] + "y"
+        if endpoint=="people": return "person"
+        return endpoint[:-1]
+
+    # returns a record's scalar properties, with those of its references (which can be searched by) flattened in
+    @staticmethod
+    def flatten(record):
+        flat = {}
+        for k, v in record.items():
+            if isinstance(v, dict):
+                for sk, sv in v.items():
+                    if sk!="link": flat[sk] = sv
+            elif not isinstance(v, list):
+                flat[k] = v
+        return flat
+
+    @classmethod
+    def matches(cls, record, filters):
+        if not filters: return True
+        flat = cls.flatten(record)
+        for k, v in filters.items():
+            if k not in flat or str(flat[k]).lower()!=str(v).lower(): return False
+        return True
+
+    # returns the endpoint of a data request, or raises a 404 if it doesn't exist
+    def check_endpoint(self, request):
+        endpoint = request.match_info["endpoint"]
+        if self.endpoints.get(endpoint, None)!=request.match_info["namespace"]:
+            raise web.HTTPNotFound(text=json.dumps({"message": "The specified data could not be found."}), content_type="application/json")
+        return endpoint
+
+    @staticmethod
+    def pop_change_versions(query):
+        return int(query.pop("minChangeVersion", -1)), int(query.pop("maxChangeVersion", sys.maxsize))
+
+    # returns the (sorted) keys of an endpoint's records that match a search (for an unfiltered search, the
+    # endpoint's own list of keys, so paging through it needn't copy or scan it; this mustn't be changed)
+    def select(self, endpoint, filters, min_change_version=-1, max_change_version=sys.maxsize):
+        records = self.records[endpoint]
+        # (a search by natural key, like `delete` does for each payload, is looked up rather than scanned for)
+        key = self.identities[endpoint].get(tuple(sorted((k, str(v)) for k, v in filters.items())), None) if filters else None
+        if key is not None:
+            keys = [key]
+        elif not filters and min_change_version==-1 and max_change_version==sys.maxsize:
+            return self.keys[endpoint]
+        else:
+            keys = records.keys()
+        # (records are stored in the order of their keys, which only ever increase)
+        return [ key for key in keys
+                 if min_change_version <= records[key]["_changeVersion"] <= max_change_version
+                 and self.matches(records[key], filters) ]
+
+    async def get_records(self, request):
+        endpoint = self.check_endpoint(request)
+        query = dict(request.query)
+        limit = int(query.pop("limit", 25))
+        offset = int(query.pop("offset", 0))
+        total_count = query.pop("totalCount", "false").lower()=="true"
+        page_token = query.pop("pageToken", None)
+        page_size = int(query.pop("pageSize", limit))
+        min_change_version, max_change_version = self.pop_change_versions(query)
+        records = self.records[endpoint]
+        selected = self.select(endpoint, query, min_change_version, max_change_version)
+        headers = {}
+        if total_count: headers["Total-Count"] = str(len(selected))
+        if page_token:
+            token = self.decode_token(page_token)
+            start, end = bisect.bisect_right(selected, token["after"]), bisect.bisect_right(selected, token["max"])
+            page = selected[start:min(end, start + page_size)]
+            if end - start > page_size:
+                headers["Next-Page-Token"] = self.encode_token(page[-1], token["max"])
+        else:
+            page = selected[offset:offset+limit]
+        return web.json_response([ self.public(records[key]) for key in page ], headers=headers)
+
+    # (a page token is the range of (internal) keys of the records in a partition)
+    @staticmethod
+    def encode_token(after, max):
+        return base64.urlsafe_b64encode(json.dumps({"after": after, "max": max}).encode()).decode()
+
+    @staticmethod
+    def decode_token(token):
+        return json.loads(base64.urlsafe_b64decode(token.encode()))
+
+    async def get_partitions(self, request):
+        endpoint = self.check_endpoint(request)
+        query = dict(request.query)
+        number = int(query.pop("number", 1))
+        min_change_version, max_change_version = self.pop_change_versions(query)
+        keys = self.select(endpoint, query, min_change_version, max_change_version)
+        tokens = []
+        if keys:
+            size = -(-len(keys) // number)
+            previous = -1
+            for i in range(0, len(keys), size):
+                upper = keys[min(i + size, len(keys)) - 1]
+                tokens.append(self.encode_token(previous, upper))
+                previous = upper
+        return web.json_response({"pageTokens": tokens})
+
+    async def get_deletes(self, request):
+        endpoint = self.check_endpoint(request)
+        query = dict(request.query)
+        limit = int(query.pop("limit", 25))
+        offset = int(query.pop("offset", 0))
+        min_change_version, max_change_version = self.pop_change_versions(query)
+        selected = [ tombstone for tombstone in self.tombstones[endpoint]
+                     if min_change_version <= tombstone["changeVersion"] <= max_change_version ]
+        headers = {}
+        if query.get("totalCount", "false").lower()=="true": headers["Total-Count"] = str(len(selected))
+        return web.json_response(selected[offset:offset+limit], headers=headers)
+
+    @staticmethod
+    def public(record):
+        return { k: v for k, v in record.items() if k!="_changeVersion" }
+
+    async def get_record(self, request):
+        endpoint = self.check_endpoint(request)
+        key = self.ids[endpoint].get(request.match_info["id"], None)
+        if key is None:
+            return web.json_response({"message": "The specified data could not be found."}, status=404)
+        return web.json_response(self.public(self.records[endpoint][key]))
+
+    async def post_record(self, request):
+        endpoint = self.check_endpoint(request)
+        try:
+            payload = json.loads(await request.text())
+            if not isinstance(payload, dict): raise ValueError("payload is not an object")
+        except Exception as e:
+            return web.json_response({"message": "The request could not be processed.", "errors": [f"Request body could not be parsed: {e}"]}, status=400)
+        status, id = self.upsert(endpoint, payload)
+        location = self.url(request, f"/data/v3/{self.endpoints[endpoint]}/{endpoint}/{id}")
+        return web.Response(status=status, headers={"Location": location, "ETag": payload["_etag"]})
+
+    # inserts a record, or updates the record with the same natural key; returns (HTTP status, id)
+    def upsert(self, endpoint, payload):
+        identity = self.get_identity(endpoint, payload)
+        self.change_version += 1
+        payload["_etag"] = str(self.change_version)
+        payload["_lastModifiedDate"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        payload["_changeVersion"] = self.change_version
+        key = self.identities[endpoint].get(identity, None)
+        if key is not None:
+            payload["id"] = self.records[endpoint][key]["id"]
+            self.records[endpoint][key] = payload
+            return 200, payload["id"]
+        self.next_key += 1
+        key = self.next_key
+        payload["id"] = uuid.uuid4().hex
+        self.records[endpoint][key] = payload
+        # (keys only ever increase, so appending keeps them sorted)
+        self.keys[endpoint].append(key)
+        self.ids[endpoint][payload["id"]] = key
+        self.identities[endpoint][identity] = key
+        return 201, payload["id"]
+
+    async def delete_record(self, request):
+        endpoint = self.check_endpoint(request)
+        key = self.ids[endpoint].pop(request.match_info["id"], None)
+        if key is None:
+            return web.json_response({"message": "Resource to delete was not found."}, status=404)
+        record = self.records[endpoint].pop(key)
+        keys = self.keys[endpoint]
+        del keys[bisect.bisect_left(keys, key)]
+        del self.identities[endpoint][self.get_identity(endpoint, record)]
+        self.change_version += 1
+        self.tombstones[endpoint].append({"id": record["id"], "changeVersion": self.change_version, "keyValues": self.flatten(record)})
+        return web.Response(status=204)
+
+    # loads records from the JSONL files (named like `{endpoint}.jsonl`) in a directory
+    def seed(self, seed_dir):
+        for file_name in sorted(os.listdir(seed_dir)):
+            endpoint = file_name.split(".")[0]
+            if endpoint not in self.records: continue
+            with open(os.path.join(seed_dir, file_name)) as file:
+                for line in file:
+                    if line.strip()=="": continue
+                    self.upsert(endpoint, json.loads(line))
+
+
+# Runs the mock API in a separate process (so its memory use isn't attributed to the process starting it,
+# or to that process's children); use as `with MockServer(**options) as base_url:`, where `options` are the
+# command-line options below (like `latency_ms=50` or `seed_dir=[...]`). By default it listens on a free port.
+class MockServer:
+
+    def __init__(self, port=0, **options):
+        self.port = port
+        self.options = options
+
+    def __enter__(self):
+        if self.port==0:
+            with socket.socket() as s:
+                s.bind(("127.0.0.1", 0))
+                self.port = s.getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{self.port}/"
+        args = [sys.executable, os.path.abspath(__file__), "--port", str(self.port)]
+        for option, value in self.options.items():
+            for v in (value if isinstance(value, list) else [value]):
+                if v is not None: args += ["--" + option.replace("_", "-"), str(v)]
+        self.process = subprocess.Popen(args, stdout=subprocess.DEVNULL)
+        # (wait for it to start listening)
+        while True:
+            try:
+                self.request("GET", "__stats")
+                return self.base_url
+            except OSError:
+                if self.process.poll() is not None: raise RuntimeError("mock API failed to start")
+                time.sleep(0.05)
+
+    def request(self, method, path):
+        with urllib.request.urlopen(urllib.request.Request(self.base_url + path, method=method)) as response:
+            body = response.read()
+        return json.loads(body) if body else None
+
+    # returns the mock API's `GET /__stats`
+    def stats(self):
+        return self.request("GET", "__stats")
+
+    # resets its counts of requests (and their times)
+    def reset_stats(self):
+        self.request("DELETE", "__stats")
+
+    def __exit__(self, *args):
+        self.process.terminate()
+        self.process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs an in-memory mock Ed-Fi API, for testing and benchmarking lightbeam")
+    parser.add_argument("--port", type=int, default=8765, help="port to listen on (at 127.0.0.1)")
+    parser.add_argument("--fixtures-dir", default=FIXTURES_DIR, help="directory of `dependencies.json`, `resources-swagger.json`, and `descriptors-swagger.json`")
+    parser.add_argument("--seed-dir", action="append", help="directory of JSONL files (named like `{endpoint}.jsonl`) of records to load at start-up; may be repeated (default: `fixtures/seed/`)")
+    parser.add_argument("--token-expiry", type=int, default=1800, help="seconds until OAuth tokens expire")
+    parser.add_argument("--latency-ms", type=float, default=0, help="mean latency (in milliseconds) to add to each request")
+    parser.add_argument("--latency-distribution", choices=LATENCY_DISTRIBUTIONS, default="fixed", help="distribution of added latencies")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of data requests that fail with a 5xx status")
+    parser.add_argument("--throttle-rate", type=float, default=0, help="fraction of data requests that fail with a 429 status")
+    parser.add_argument("--random-seed", type=int, help="seed for the latencies and errors (for reproducible runs)")
+    args = parser.parse_args()
+
+    api = MockEdFiAPI(args.fixtures_dir, args.token_expiry, args.latency_ms, args.latency_distribution, args.error_rate, args.throttle_rate, args.random_seed)
+    for seed_dir in args.seed_dir or [os.path.join(FIXTURES_DIR, "seed")]:
+        api.seed(seed_dir)
+    print(f"mock Ed-Fi API listening at http://127.0.0.1:{args.port}/")
+    web.run_app(api.app(), host="127.0.0.1", port=args.port, print=None, access_log=None)
+
+if __name__ == "__main__":
+    main()
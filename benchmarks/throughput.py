@@ -0,0 +1,280 @@
+# Measures the throughput of lightbeam's commands, by running them (from this repository) on synthetic data
+# against a mock Ed-Fi API (see `mock_api.py`), for each of a set of scenarios:
+#     python benchmarks/throughput.py [--scale 10000] [--latency-ms 5] [--scenarios send,fetch]
+# For each scenario this records the records processed per second (or for start-up scenarios, the seconds
+# taken), the 50th/95th/99th percentiles of the time the mock took to respond to each data request, and
+# lightbeam's CPU time and peak memory use (RSS). Each run is appended to a JSON history file, and compared
+# against a baseline (saved from an earlier run with `--save-baseline`): if any scenario's throughput is
+# lower, or its start-up time, CPU time, or memory use higher, by more than `--tolerance`, this exits with
+# an error.
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import datetime
+import tempfile
+import subprocess
+from mock_api import MockServer, FIXTURES_DIR
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ENDPOINTS = ["schools", "students", "studentSchoolAssociations"]
+
+# scenario: {
+#   "command": lightbeam arguments,
+#   "mock": options for the mock API,
+#   "seed": whether the mock API starts with the synthetic data already in it,
+#   "warm": whether to run the command once first (unmeasured), so the hashlog is populated,
+#   "expect": what should happen to the synthetic data ("sent", "fetched", "deleted"),
+#   "exit_code": lightbeam's expected exit code (default 0),
+#   "endpoints": the endpoints selected (default `ENDPOINTS`),
+#   "startup": whether the scenario measures start-up time, so its wall-clock seconds (rather than records
+#              per second, which is meaningless for so few records) are reported and compared to the baseline
+# }
+SCENARIOS = {
+    "validate": {"command": ["validate"]},
+    # (a small run, like an orchestrator's, where start-up (loading the Swagger and descriptors) dominates;
+    # cold starts with an empty `state_dir`, warm with the API metadata already cached there)
+    "validate (cold start)": {"command": ["validate"], "endpoints": ["schools"], "startup": True},
+    "validate (warm start)": {"command": ["validate"], "endpoints": ["schools"], "warm": True, "startup": True},
+    "send (cold hashlog)": {"command": ["send"], "expect": "sent"},
+    "send (warm hashlog)": {"command": ["send"], "warm": True, "expect": "sent", "exit_code": 99}, # (all payloads skipped)
+    "send (errors)": {"command": ["send"], "mock": {"error_rate": 0.02, "throttle_rate": 0.02}, "expect": "sent"},
+    "send (token expiry)": {"command": ["send"], "mock": {"token_expiry": 2}, "expect": "sent"},
+    "fetch": {"command": ["fetch", "--set", "data_dir", "{dir}/fetched/"], "seed": True, "expect": "fetched"},
+    "delete": {"command": ["delete"], "seed": True, "expect": "deleted"},
+    "truncate": {"command": ["truncate"], "seed": True, "expect": "deleted"},
+}
+# (metrics compared against the baseline, and whether higher is better)
+METRICS = {"records_per_second": True, "startup_seconds": False, "cpu_seconds": False, "peak_rss_mb": False}
+
+CONFIG = """state_dir: {dir}/state
+data_dir: {data_dir}/
+edfi_api:
+  base_url: {base_url}
+  version: 3
+  mode: sandbox
+  client_id: benchmark
+  client_secret: benchmark
+connection:
+  pool_size: {pool_size}
+  num_retries: 10
+  backoff_factor: 1.5
+  retry_statuses: [429, 500, 501, 503, 504]
+  verify_ssl: False
+fetch:
+  page_size: 500
+validate:
+  references:
+    remote: False
+force_delete: True
+log_level: INFO
+"""
+
+FIRST_NAMES = ["Ava", "Ben", "Chloe", "Diego", "Emma", "Farah", "Gabe", "Hana", "Ian", "Jada", "Kai", "Liam", "Maya", "Noah", "Omar", "Priya"]
+LAST_NAMES = ["Garcia", "Smith", "Nguyen", "Johnson", "Patel", "Brown", "Kim", "Lopez", "Miller", "Davis", "Wilson", "Martinez"]
+GRADE_LEVELS = ["Sixth grade", "Seventh grade", "Eighth grade", "Ninth grade", "Tenth grade", "Eleventh grade", "Twelfth grade"]
+BIRTH_SEXES = ["Female", "Male", "Not Selected"]
+
+
+# Writes synthetic JSONL for `ENDPOINTS` to `data_dir` (one student, and school association, per `scale`,
+# and a school per 500 students); returns the number of records written for each endpoint
+def generate_data(data_dir, scale, seed):
+    rand = random.Random(seed)
+    num_schools = max(1, scale // 500)
+    school_ids = [ 255901000 + i for i in range(num_schools) ]
+    with open(os.path.join(data_dir, "schools.jsonl"), "w") as file:
+        for school_id in school_ids:
+            file.write(json.dumps({
+                "schoolId": school_id,
+                "nameOfInstitution": f"Benchmark School {school_id}",
+                "educationOrganizationCategories": [{"educationOrganizationCategoryDescriptor": "uri://ed-fi.org/EducationOrganizationCategoryDescriptor#School"}],
+                "gradeLevels": [ {"gradeLevelDescriptor": f"uri://ed-fi.org/GradeLevelDescriptor#{grade}"} for grade in rand.sample(GRADE_LEVELS, 3) ],
+            }) + "\n")
+    with open(os.path.join(data_dir, "students.jsonl"), "w") as students, open(os.path.join(data_dir, "studentSchoolAssociations.jsonl"), "w") as associations:
+        for i in range(scale):
+            student_id = f"{i:09d}"
+            students.write(json.dumps({
+                "studentUniqueId": student_id,
+                "firstName": rand.choice(FIRST_NAMES),
+                "lastSurname": rand.choice(LAST_NAMES),
+                "birthDate": (datetime.date(2008, 1, 1) + datetime.timedelta(days=rand.randrange(2000))).isoformat(),
+                "birthSexDescriptor": "uri://ed-fi.org/BirthSexDescriptor#" + rand.choice(BIRTH_SEXES),
+            }) + "\n")
+            associations.write(json.dumps({
+                "studentReference": {"studentUniqueId": student_id},
+                "schoolReference": {"schoolId": rand.choice(school_ids)},
+                "entryDate": (datetime.date(2024, 8, 15) + datetime.timedelta(days=rand.randrange(30))).isoformat(),
+                "entryGradeLevelDescriptor": "uri://ed-fi.org/GradeLevelDescriptor#" + rand.choice(GRADE_LEVELS),
+            }) + "\n")
+    return {"schools": num_schools, "students": scale, "studentSchoolAssociations": scale}
+
+# Runs lightbeam (from this repository) with `args`, with its output written to `log_file`; returns its
+# exit code, wall-clock seconds, CPU seconds, and peak RSS (in MB)
+def run(args, dir, log_file):
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(BENCHMARKS_DIR))
+    start = time.perf_counter()
+    with open(log_file, "a") as log:
+        process = subprocess.Popen([sys.executable, "-m", "lightbeam"] + args, cwd=dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        # (`wait4()` returns the resources used by just this process)
+        _, status, usage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    # (`ru_maxrss` is in bytes on macOS, and kilobytes elsewhere; on Linux it's at least the RSS of this process
+    # when lightbeam was started, which is why the mock API runs in a separate process)
+    peak_rss_mb = usage.ru_maxrss / (1024 * 1024 if sys.platform=="darwin" else 1024)
+    return process.returncode, seconds, usage.ru_utime + usage.ru_stime, peak_rss_mb
+
+def count_lines(dir):
+    num_lines = 0
+    for file_name in os.listdir(dir):
+        with open(os.path.join(dir, file_name)) as file:
+            num_lines += sum(1 for line in file if line.strip()!="")
+    return num_lines
+
+# Runs one scenario; returns its results
+def run_scenario(scenario, dir, data_dir, record_counts, args):
+    endpoints = scenario.get("endpoints", ENDPOINTS)
+    num_records = sum(record_counts[endpoint] for endpoint in endpoints)
+    os.makedirs(os.path.join(dir, "fetched"))
+    log_file = os.path.join(dir, "lightbeam.log")
+    seed_dirs = [ os.path.join(FIXTURES_DIR, "seed") ] + ([ data_dir ] if scenario.get("seed", False) else [])
+    mock_options = dict({"latency_ms": args.latency_ms, "latency_distribution": args.latency_distribution, "random_seed": args.seed, "seed_dir": seed_dirs}, **scenario.get("mock", {}))
+    server = MockServer(**mock_options)
+    with server as base_url:
+        config_file = os.path.join(dir, "lightbeam.yml")
+        with open(config_file, "w") as file:
+            file.write(CONFIG.format(dir=dir, data_dir=data_dir, base_url=base_url, pool_size=args.pool_size))
+        command = [ arg.format(dir=dir) for arg in scenario["command"] ]
+        command = command[:1] + ["-c", config_file, "-s", ",".join(endpoints)] + command[1:]
+        if scenario.get("warm", False):
+            if run(command, dir, log_file)[0]!=0:
+                return {"failed": f"warm-up run failed; see {log_file}"}
+            server.reset_stats()
+        returncode, seconds, cpu_seconds, peak_rss_mb = run(command, dir, log_file)
+        stats = server.stats()
+        results = {
+            "seconds": round(seconds, 3),
+            "latency_ms": stats["latency_ms"],
+            "requests": sum(stats["methods"].values()),
+            "oauth_tokens": stats["tokens"],
+            "cpu_seconds": round(cpu_seconds, 3),
+            "peak_rss_mb": round(peak_rss_mb, 1),
+        }
+        if scenario.get("startup", False): results["startup_seconds"] = round(seconds, 3)
+        else: results["records_per_second"] = round(num_records / seconds, 1)
+        # (check that the command did what it should have, so a faster but broken lightbeam isn't rewarded)
+        num_in_api = sum(stats["records"][endpoint] for endpoint in endpoints)
+        expect = scenario.get("expect", None)
+        if returncode!=scenario.get("exit_code", 0): results["failed"] = f"lightbeam exited with {returncode}; see {log_file}"
+        elif expect=="sent" and num_in_api!=num_records: results["failed"] = f"{num_in_api} of {num_records} records were sent"
+        elif expect=="deleted" and num_in_api!=0: results["failed"] = f"{num_in_api} records were not deleted"
+        elif expect=="fetched" and count_lines(os.path.join(dir, "fetched"))!=num_records: results["failed"] = "not all records were fetched"
+    return results
+
+# Returns a list of regressions of the results of a run compared to a baseline run
+def find_regressions(run, baseline, tolerance):
+    regressions = []
+    for scenario, results in run["results"].items():
+        baseline_results = baseline["results"].get(scenario, {})
+        for metric, higher_is_better in METRICS.items():
+            if metric not in results or metric not in baseline_results: continue
+            change = (results[metric] - baseline_results[metric]) / baseline_results[metric]
+            if (higher_is_better and change < -tolerance) or (not higher_is_better and change > tolerance):
+                regressions.append(f"{scenario}: {metric} {baseline_results[metric]} -> {results[metric]} ({change:+.0%})")
+    return regressions
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARKS_DIR, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the throughput of lightbeam's commands against a mock Ed-Fi API")
+    parser.add_argument("--scale", type=int, default=10000, help="number of students (and student school associations) to generate")
+    parser.add_argument("--scenarios", help="comma-separated list of scenarios to run (default: all of " + ", ".join(f"'{s}'" for s in SCENARIOS) + "); a command name runs all its scenarios")
+    parser.add_argument("--latency-ms", type=float, default=5, help="mean latency the mock API adds to each request")
+    parser.add_argument("--latency-distribution", default="lognormal", help="distribution of latencies the mock API adds")
+    parser.add_argument("--pool-size", type=int, default=8, help="lightbeam's `connection.pool_size`")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for the synthetic data and the mock API")
+    parser.add_argument("--history", default=os.path.join(BENCHMARKS_DIR, "output", "history.json"), help="JSON file to append the results of this run to")
+    parser.add_argument("--baseline", default=os.path.join(BENCHMARKS_DIR, "output", "baseline.json"), help="JSON file of a baseline run to compare to")
+    parser.add_argument("--save-baseline", action="store_true", help="save the results of this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative change in a metric (from the baseline) that's a regression")
+    args = parser.parse_args()
+
+    selected = [ s.strip() for s in args.scenarios.split(",") ] if args.scenarios else list(SCENARIOS.keys())
+    scenarios = { name: scenario for name, scenario in SCENARIOS.items() if name in selected or name.split(" ")[0] in selected }
+    if not scenarios:
+        sys.exit(f"no scenarios match `{args.scenarios}`")
+
+    this_run = {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "options": {"scale": args.scale, "latency_ms": args.latency_ms, "latency_distribution": args.latency_distribution, "pool_size": args.pool_size, "seed": args.seed},
+        "results": {},
+    }
+    with tempfile.TemporaryDirectory() as dir:
+        data_dir = os.path.join(dir, "data")
+        os.makedirs(data_dir)
+        record_counts = generate_data(data_dir, args.scale, args.seed)
+        print(f"generated {sum(record_counts.values())} records; running {len(scenarios)} scenarios...")
+        print(f"{'scenario':<22} {'records/s':>10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'CPU s':>8} {'RSS MB':>8}")
+        for name, scenario in scenarios.items():
+            scenario_dir = os.path.join(dir, name.replace(" ", "_").replace("(", "").replace(")", ""))
+            results = run_scenario(scenario, scenario_dir, data_dir, record_counts, args)
+            this_run["results"][name] = results
+            if "records_per_second" in results or "startup_seconds" in results:
+                latency = results["latency_ms"]
+                # (start-up scenarios are measured in seconds)
+                rate = f"{results['records_per_second']:.1f}" if "records_per_second" in results else f"{results['startup_seconds']:.2f} s"
+                print(f"{name:<22} {rate:>10} {latency.get('p50', 0):>8.1f} {latency.get('p95', 0):>8.1f} {latency.get('p99', 0):>8.1f} {results['cpu_seconds']:>8.2f} {results['peak_rss_mb']:>8.1f}", end="")
+            else:
+                print(f"{name:<22}", end="")
+            # (the scenario's log is lost with the temporary directory, so show the end of it now)
+            if "failed" in results:
+                print(f"  FAILED: {results['failed']}")
+                with open(os.path.join(scenario_dir, "lightbeam.log")) as log:
+                    print("".join(log.readlines()[-10:]))
+            else:
+                print()
+
+    cold, warm = ( this_run["results"].get(f"validate ({start} start)", {}).get("startup_seconds", None) for start in ["cold", "warm"] )
+    if cold is not None and warm is not None:
+        print(f"validate start-up: {cold:.2f} s cold, {warm:.2f} s warm (a cold start takes {cold - warm:.2f} s longer)")
+
+    os.makedirs(os.path.dirname(args.history), exist_ok=True)
+    history = []
+    if os.path.isfile(args.history):
+        with open(args.history) as file:
+            history = json.load(file)
+    history.append(this_run)
+    with open(args.history, "w") as file:
+        json.dump(history, file, indent=2)
+
+    failures = [ name for name, results in this_run["results"].items() if "failed" in results ]
+    regressions = []
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(this_run, file, indent=2)
+        print(f"saved baseline to {args.baseline}")
+    elif os.path.isfile(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline["options"]!=this_run["options"]:
+            print(f"(not comparing to the baseline, which was run with different options: {baseline['options']})")
+        else:
+            regressions = find_regressions(this_run, baseline, args.tolerance)
+            print(f"compared to the baseline (commit {baseline['commit']}): " + ("\n  " + "\n  ".join(regressions) if regressions else "no regressions"))
+
+    if failures or regressions:
+        sys.exit("failed: " + ", ".join(failures + ([ "regressions" ] if regressions else [])))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# Fixtures for the tests which run lightbeam against `benchmarks/mock_api.py` (an in-memory stand-in for an
+# Ed-Fi API), so they need no Ed-Fi API of their own - unlike `test_lightbeam.py`.
+
+import os
+import sys
+import json
+import subprocess
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(ROOT_DIR, "benchmarks"))
+from mock_api import MockServer
+
+
+# A mock API (with the descriptor values in `benchmarks/fixtures/seed/`), started afresh for each test; a
+# test may pass it options (see `MockServer`) with `@pytest.mark.parametrize("mock_api", [{...}], indirect=True)`
+@pytest.fixture
+def mock_api(request):
+    server = MockServer(**getattr(request, "param", {}))
+    with server:
+        yield server
+
+
+# Runs lightbeam commands against the mock API, with a config whose `state_dir` and `data_dir` are in a
+# temporary directory. Call it like `lightbeam("send", "-s", "students")`; it returns the finished process
+# (with its output as `stdout`). Settings in `config` are added to the config of every command.
+class LightbeamRunner:
+
+    def __init__(self, base_url, dir):
+        self.dir = dir
+        self.data_dir = os.path.join(dir, "data")
+        self.state_dir = os.path.join(dir, "state")
+        os.makedirs(self.data_dir, exist_ok=True)
+        self.config = {
+            "state_dir": self.state_dir,
+            "data_dir": self.data_dir,
+            "edfi_api": {
+                "base_url": base_url,
+                "version": 3,
+                "mode": "sandbox",
+                "client_id": "client_id",
+                "client_secret": "client_secret",
+            },
+            "connection": {"verify_ssl": False, "pool_size": 4},
+            "force_delete": True,
+        }
+
+    def __call__(self, command, *args):
+        config_file = self.write_config()
+        return subprocess.run([sys.executable, "-m", "lightbeam", command, "-c", config_file] + list(args),
+            cwd=self.dir, env=dict(os.environ, PYTHONPATH=ROOT_DIR),
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+
+    # Writes the config to `lightbeam.yaml`, and returns its path
+    def write_config(self):
+        config_file = os.path.join(self.dir, "lightbeam.yaml")
+        # (JSON is also YAML)
+        with open(config_file, "w") as file:
+            json.dump(self.config, file)
+        return config_file
+
+    # Writes records (dictionaries) to `{endpoint}.jsonl` in the `data_dir`
+    def write_data(self, endpoint, records):
+        with open(os.path.join(self.data_dir, f"{endpoint}.jsonl"), "w") as file:
+            for record in records:
+                file.write(json.dumps(record) + "\n")
+
+    # Writes `num_students` student records (valid for the mock API) to `students.jsonl`
+    def write_students(self, num_students, first_name="Ada"):
+        self.write_data("students", [
+            {"studentUniqueId": f"{i:06d}", "birthDate": "2015-09-01", "firstName": first_name, "lastSurname": "Lovelace"}
+            for i in range(num_students)
+        ])
+
+@pytest.fixture
+def lightbeam(mock_api, tmp_path):
+    return LightbeamRunner(mock_api.base_url, str(tmp_path))
@@ -2,7 +2,6 @@ import os
 import sys
 import logging
 import argparse
-from lightbeam.lightbeam import Lightbeam
 
 
 class ExitOnExceptionHandler(logging.StreamHandler):
@@ -23,7 +22,8 @@ ALLOWED_COMMANDS = {
    "truncate": "truncate",
    "count": "count",
    "fetch": "fetch",
-   "create": "create"
+   "create": "create",
+   "generate": "generate"
 }
 command_list = ', '.join(f"'{c}'" for c in ALLOWED_COMMANDS.values())
 
@@ -81,6 +81,10 @@ def main(argv=None):
         type=str,
         help='a JSON dictionary of query parameters to add to GET requests when using the `fetch` command'
         )
+    parser.add_argument("--query-file",
+        type=str,
+        help='for `fetch`, a JSONL file of query parameter dictionaries; records are fetched for each of them'
+        )
     parser.add_argument("-p", "--params",
         type=str,
         help='specify parameters as a JSON object via CLI (overrides environment variables)'
@@ -91,7 +95,7 @@ def main(argv=None):
         )
     parser.add_argument("-f", "--force",
         action='store_true',
-        help='process all payloads, ignoring history'
+        help='process all payloads, ignoring history (for `generate`, overwrite existing files)'
         )
     parser.add_argument("-o", "--older-than",
         type=str,
@@ -105,6 +109,14 @@ def main(argv=None):
         type=str,
         help='only payloads that returned one of these comma-delimited HTTP status codes on last send will be processed'
         )
+    parser.add_argument("--resume",
+        action='store_true',
+        help='for `fetch`, continue an interrupted fetch where it left off'
+        )
+    parser.add_argument("--offline",
+        action='store_true',
+        help='for `validate` and `generate`, use only API metadata cached in `state_dir` by a previous run (no API requests)'
+        )
     parser.add_argument("--results-file",
         type=str,
         help='produces a JSON output file with structured information about run results'
@@ -115,7 +127,7 @@ def main(argv=None):
         help='overrides a setting in the config YAML; example: --set fetch.page_size 1000'
     )
 
-    defaults = { "selector":"*", "params": "", "older_than": "", "newer_than": "", "resend_status_codes": "", "results_file": "" }
+    defaults = { "selector":"*", "query_file": "", "params": "", "older_than": "", "newer_than": "", "resend_status_codes": "", "results_file": "" }
     parser.set_defaults(**defaults)
     args, unknown_args = parser.parse_known_args()
     if len(unknown_args) > 0:
@@ -152,10 +164,16 @@ def main(argv=None):
     
     if args.set and len(args.set)%2 != 0: # odd number of overrides
         logger.error("overrides specified with --set must be followed by an even number of strings (key value key value ...)")
+    if args.query and args.query_file:
+        logger.error("specify either `--query` or `--query-file`, not both")
+    if args.offline and args.command not in [ALLOWED_COMMANDS['validate'], ALLOWED_COMMANDS['generate']]:
+        logger.error("`--offline` is only supported for `validate` and `generate`")
     overrides = None
     if args.set:
         overrides = dict(zip(args.set[::2], args.set[1::2]))
 
+    # (imported only now, so `--version`, `--help`, and argument errors don't load lightbeam's dependencies)
+    from lightbeam.lightbeam import Lightbeam
     lb = Lightbeam(
         config_file=args.config_file,
         logger=logger,
@@ -164,12 +182,15 @@ def main(argv=None):
         keep_keys=args.keep_keys or "*",
         drop_keys=args.drop_keys or "",
         query=args.query or "{}",
+        query_file=args.query_file,
         params=args.params,
         wipe=args.wipe,
         force=args.force,
         older_than=args.older_than,
         newer_than=args.newer_than,
         resend_status_codes=args.resend_status_codes,
+        resume=args.resume,
+        offline=args.offline,
         results_file=args.results_file,
         overrides=overrides,
         )
@@ -181,13 +202,20 @@ def main(argv=None):
         elif args.command==ALLOWED_COMMANDS['validate']: lb.validator.validate()
         elif args.command==ALLOWED_COMMANDS['send']: lb.sender.send()
         elif args.command==ALLOWED_COMMANDS['validate+send']:
-            lb.validator.validate()
-            lb.sender.send()
+            if lb.config.get("validate",{}).get("fused", False):
+                lb.sender.send(validate=True)
+            else:
+                lb.validator.validate()
+                lb.sender.send()
         elif args.command==ALLOWED_COMMANDS['delete']: lb.deleter.delete()
         elif args.command==ALLOWED_COMMANDS['truncate']: lb.truncator.truncate()
+        elif args.command==ALLOWED_COMMANDS['generate']: lb.generator.generate()
         lb.logger.info("done!")
     except Exception as e:
         logger.exception(e, exc_info=lb.config["show_stacktrace"])
+    finally:
+        # (also when a command exits early, like `send` when all payloads are skipped)
+        lb.api.save_endpoint_plans()
 
 if __name__ == "__main__":
     sys.exit(main())
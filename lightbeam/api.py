@@ -1,42 +1,61 @@
 import os
-import csv
 import json
 import time
 import asyncio
-import aiohttp
-import requests
-from requests.adapters import HTTPAdapter, Retry
-from aiohttp_retry import RetryClient, ExponentialRetry
+import concurrent.futures
 
 from lightbeam import util
 from lightbeam import hashlog
+from lightbeam import swagger as swagger_cache
+from lightbeam.plan import EndpointPlan
 
 
 class EdFiAPI:
 
     SWAGGER_CACHE_TTL = 2629800 # one month in seconds
     DESCRIPTORS_CACHE_TTL = 2629800 # one month in seconds
+    OAUTH_REFRESH_BUFFER = 60 # seconds before a token expires at which it is refreshed
     
     def __init__(self, lightbeam=None):
         self.lightbeam = lightbeam
         self.logger = self.lightbeam.logger
         self.config = None
         self.reports_identity = False
+        self.client = None
+        self.token = None
+        self.token_refresh_at = None
+        self.oauth_lock = None
+        self.oauth_lock_loop = None
+        self.swagger_versions = {}
+        self.endpoint_plans = {}
+        self.endpoint_plans_hash = None
+        self.endpoint_plans_file = None
+        self.endpoint_plans_changed = False
+        self.descriptor_values_version = ""
+        self.endpoint_orders = {}
+        self.metadata_bundle = None
+        self.metadata_bundle_file = None
+        self.metadata_checked = set()
     
     # prepares this API object by fetching some of its metadata and
     # setting up data and objects for further use
     def prepare(self):
         self.config = self.lightbeam.config["edfi_api"]
+        self.load_metadata_bundle()
 
         # fetch/set up Ed-Fi API URLs
         try:
             self.logger.debug("fetching base_url...")
-            api_base = self.get_with_protocol_fallback(self.config["base_url"], 'base_url')
+            api_base = self.get_metadata(self.config["base_url"], 'base_url')
         except Exception as e:
-            self.logger.critical("could not connect to {0} ({1})".format(self.config["base_url"], str(e)))
+            # (only needed below, if other URLs aren't configured)
+            api_base = None
         
         # Data URL doesn't rely on metadata connection
         self.config["data_url"] = self.get_data_url()
+        # (used for incremental `fetch`; Change Queries URLs are structured like data URLs)
+        if self.config.get("change_queries_url", "")=="":
+            self.config["change_queries_url"] = self.config["data_url"].replace("/data/v3", "/changeQueries/v1", 1)
 
         # If ALL urls are set in config (probably from source/destination file),
         # then they don't need to be pulled from api metadata, so this section can be skipped.
@@ -48,7 +67,8 @@ class EdFiAPI:
             or self.config.get("open_api_metadata_url", "")==""
         ):
             try:
-                api_base = api_base.json()
+                if api_base is None: raise Exception("no response")
+                api_base = json.loads(api_base)
                 if self.config.get("oauth_url", "")=="":
                     self.config["oauth_url"] = api_base["urls"]["oauth"]
                 if self.config.get("dependencies_url", "")=="":
@@ -64,6 +84,69 @@ class EdFiAPI:
         # filter down to only selected endpoints
         self.lightbeam.endpoints = self.apply_filters(self.lightbeam.all_endpoints)
 
+        self.save_metadata_bundle()
+
+    # Loads the metadata bundle: the API's metadata documents (its base URL, dependencies, and Swagger) as
+    # last fetched, with their `ETag` and `Last-Modified` headers, saved in `state_dir` so later runs can
+    # re-use them (see `get_metadata()`)
+    def load_metadata_bundle(self):
+        if self.metadata_bundle is not None: return
+        self.metadata_bundle = {}
+        if self.lightbeam.track_state:
+            url_hash = hashlog.get_hash_string(self.config["base_url"])
+            self.metadata_bundle_file = os.path.join(self.lightbeam.config["state_dir"], "cache", f"metadata-{url_hash}.dat")
+            if not self.lightbeam.wipe:
+                try:
+                    self.metadata_bundle = hashlog.load(self.metadata_bundle_file)
+                except Exception as e:
+                    self.logger.debug(f"(could not load cached API metadata; it will be re-fetched)")
+        self.metadata_bundle_changed = False
+
+    def save_metadata_bundle(self):
+        if self.metadata_bundle_file and self.metadata_bundle_changed:
+            os.makedirs(os.path.dirname(self.metadata_bundle_file), exist_ok=True)
+            hashlog.save(self.metadata_bundle_file, self.metadata_bundle)
+            self.metadata_bundle_changed = False
+
+    # Returns the body of a metadata document from the API, re-using the copy in the metadata bundle if
+    # it's still current: that's checked with a conditional request (if the API sent an `ETag` or
+    # `Last-Modified` for it), or else it's re-used for up to `ttl` seconds. Each document is requested at
+    # most once per run, and never with `--offline`.
+    def get_metadata(self, url, url_type, ttl=0):
+        cached = self.metadata_bundle.get(url, None)
+        if url in self.metadata_checked or (cached and self.lightbeam.offline):
+            return cached["body"]
+        if self.lightbeam.offline:
+            self.logger.critical(f"{url_type} {url} isn't cached (in `state_dir`) from a previous run, so can't be loaded `--offline`")
+        headers = {}
+        if cached:
+            if cached["etag"]: headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]: headers["If-Modified-Since"] = cached["last_modified"]
+            if not headers and time.time()-cached["fetched"]<ttl:
+                self.metadata_checked.add(url)
+                return cached["body"]
+        response = self.get_with_protocol_fallback(url, url_type, headers)
+        if response.status_code==304 and cached:
+            self.logger.debug(f"(cached {url_type} is current)")
+        elif not response.ok:
+            raise Exception("{0} returned status {1} ({2})".format(url_type, response.status_code, (response.content[:75] + b"...") if len(response.content)>75 else response.content))
+        else:
+            cached = self.metadata_bundle[url] = {
+                "etag": response.headers.get("ETag", None),
+                "last_modified": response.headers.get("Last-Modified", None),
+                "fetched": time.time(),
+                "body": response.text,
+            }
+            self.metadata_bundle_changed = True
+        self.metadata_checked.add(url)
+        return cached["body"]
+
+    # Returns the bodies of several metadata documents (each a tuple of `get_metadata()` arguments), which
+    # are requested concurrently
+    def get_metadata_concurrently(self, documents):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(documents), 1)) as executor:
+            return list(executor.map(lambda document: self.get_metadata(*document), documents))
+
 
     def apply_filters(self, endpoints=[]):
         # apply filters
@@ -86,18 +169,25 @@ class EdFiAPI:
 
     # Returns a client object with exponential retry and other parameters per configs
     def get_retry_client(self):
+        # (HTTP clients are imported where they're used, so commands which don't need them don't load them)
+        import aiohttp
+        from aiohttp_retry import RetryClient, ExponentialRetry
         return RetryClient(
             timeout=aiohttp.ClientTimeout(sock_connect=self.lightbeam.config['connection']["timeout"]),
             retry_options=ExponentialRetry(
                 attempts=self.lightbeam.config['connection']["num_retries"],
                 factor=self.lightbeam.config['connection']["backoff_factor"],
-                statuses=self.lightbeam.config['connection']["retry_statuses"].append(401)
+                # (not 401s: a retry would reuse the expired token, so commands handle those by refreshing it)
+                statuses=set(self.lightbeam.config['connection']["retry_statuses"])
                 ),
             connector=aiohttp.connector.TCPConnector(limit=self.lightbeam.config['connection']["pool_size"])
             )
     
     # Obtains an OAuth token from the API and sets the client headers accordingly
-    def do_oauth(self):
+    # (unless the current token is still fresh, or `force` is set)
+    def do_oauth(self, force=False):
+        if not force and self.token_is_fresh(): return
+        import requests
         try:
             try:
                 token_response = requests.post(
@@ -121,24 +211,78 @@ class EdFiAPI:
                         verify=self.lightbeam.config["connection"]["verify_ssl"])
                 except Exception as e:
                     self.logger.critical(f"could not reach {self.config['oauth_url']} ({str(e)})")    
-            self.token = token_response.json()["access_token"]
-            self.headers = {
-                    "accept": "application/json",
-                    "Content-Type": "application/json",
-                    "authorization": "Bearer " + self.token
-                }
+            self.set_token(token_response.json())
         except Exception as e:
             self.logger.error(f"OAuth token could not be obtained; check your API credentials?")
 
-    def update_oauth(self):
-        self.logger.debug("fetching new OAuth token due to a 401 response...")
-        self.lightbeam.token_version += 1
-        self.do_oauth()
+    # Obtains an OAuth token from the API without blocking the event loop
+    async def do_oauth_async(self):
+        import aiohttp
+        oauth_url = self.config["oauth_url"]
+        swapped_url = oauth_url.replace("http://", "https://") if "http://" in oauth_url else oauth_url.replace("https://", "http://")
+        try:
+            async with aiohttp.ClientSession() as session:
+                try:
+                    token_json = await self.post_oauth(session, oauth_url)
+                except aiohttp.ClientConnectionError as e:
+                    token_json = await self.post_oauth(session, swapped_url)
+            self.set_token(token_json)
+        except Exception as e:
+            self.logger.error(f"OAuth token could not be obtained; check your API credentials?")
+
+    async def post_oauth(self, session, url):
+        import aiohttp
+        async with session.post(url,
+            data={"grant_type":"client_credentials"},
+            auth=aiohttp.BasicAuth(self.config["client_id"], self.config["client_secret"]),
+            ssl=self.lightbeam.config["connection"]["verify_ssl"],
+            timeout=aiohttp.ClientTimeout(sock_connect=self.lightbeam.config['connection']["timeout"])
+            ) as response:
+            return await response.json(content_type=None)
+
+    # Stores a new OAuth token (and when it should be refreshed) from a token response
+    def set_token(self, token_json):
+        self.token = token_json["access_token"]
         self.headers = {
-            "accept": "application/json",
-            "Content-Type": "application/json",
-            "authorization": "Bearer " + self.token
-        }
+                "accept": "application/json",
+                "Content-Type": "application/json",
+                "authorization": "Bearer " + self.token
+            }
+        # refresh a little before the token expires (but not too early for very short-lived tokens)
+        expires_in = token_json.get("expires_in", None)
+        if expires_in:
+            expires_in = int(expires_in)
+            self.token_refresh_at = time.time() + expires_in - min(self.OAUTH_REFRESH_BUFFER, expires_in/2)
+        else:
+            self.token_refresh_at = None # (unknown expiry; refresh only upon a 401 response)
+        self.lightbeam.token_version += 1
+
+    def token_is_fresh(self):
+        return self.token is not None and (self.token_refresh_at is None or time.time() < self.token_refresh_at)
+
+    # Returns request headers with a valid token, first refreshing the token if it's about to expire
+    async def get_headers(self):
+        if not self.token_is_fresh():
+            await self.refresh_oauth()
+        return self.headers
+
+    # Refreshes the OAuth token. Only one refresh happens at a time: tasks that arrive while a refresh
+    # is underway wait for it, then use the new token. Tasks that got a 401 pass the `token_version`
+    # they used, so a token that has since been replaced is not refreshed again.
+    async def refresh_oauth(self, token_version=None):
+        async with self.get_oauth_lock():
+            if token_version is None and self.token_is_fresh(): return
+            if token_version is not None and token_version!=self.lightbeam.token_version: return
+            self.logger.debug("fetching new OAuth token...")
+            await self.do_oauth_async()
+
+    # (`asyncio.Lock`s are bound to an event loop, and each endpoint is processed in its own loop)
+    def get_oauth_lock(self):
+        loop = asyncio.get_running_loop()
+        if self.oauth_lock_loop is not loop:
+            self.oauth_lock = asyncio.Lock()
+            self.oauth_lock_loop = loop
+        return self.oauth_lock
 
 
     # Constructs a base data URL (based on config params) to which we will post data
@@ -167,10 +311,7 @@ class EdFiAPI:
     def get_sorted_endpoints(self):
         self.logger.debug("fetching resource dependencies...")
         try:
-            response = self.get_with_protocol_fallback(self.config["dependencies_url"], 'dependencies_url')
-            if response.status_code not in [ 200, 201 ]:
-                raise Exception("Dependencies URL returned status {0} ({1})".format(response.status_code, (response.content[:75] + "...") if len(response.content)>75 else response.content))
-            data = response.json()
+            data = json.loads(self.get_metadata(self.config["dependencies_url"], 'dependencies_url'))
         except Exception as e:
             self.logger.critical("Unable to load dependencies from API... terminating. Check API connectivity. ({0})".format(str(e)))
         
@@ -188,7 +329,19 @@ class EdFiAPI:
             for namespace in possible_namespaces:
                 if e["resource"].startswith(f"/{namespace}/"):
                     ordered_endpoints.append(e["resource"].replace(f"/{namespace}/", ""))
+                    self.endpoint_orders[ordered_endpoints[-1]] = e["order"]
         return ordered_endpoints
+
+    # Groups (dependency-ordered) endpoints into dependency levels: lists of endpoints with the same Ed-Fi
+    # `order`, none of which depend on each other
+    def get_dependency_levels(self, endpoints):
+        levels = []
+        for endpoint in endpoints:
+            if levels and self.endpoint_orders.get(endpoint)==self.endpoint_orders.get(levels[-1][0]):
+                levels[-1].append(endpoint)
+            else:
+                levels.append([endpoint])
+        return levels
     
     # Loads the Swagger JSON from the Ed-Fi API
     def load_swagger_docs(self):
@@ -210,10 +363,7 @@ class EdFiAPI:
             # grab Descriptors and Resources swagger URLs
             try:
                 self.logger.debug("fetching swagger docs...")
-                response = self.get_with_protocol_fallback(self.config["open_api_metadata_url"], 'open_api_metadata_url')
-                if not response.ok:
-                    raise Exception("OpenAPI metadata URL returned status {0} ({1})".format(response.status_code, (response.content[:75] + "...") if len(response.content)>75 else response.content))
-                openapi = response.json()
+                openapi = json.loads(self.get_metadata(self.config["open_api_metadata_url"], 'open_api_metadata_url'))
 
             except Exception as e:
                 self.logger.critical("Unable to load Swagger docs from API... terminating. Check your `edfi_api.open_api_metadata_url` and/or manually specify `edfi_api.descriptors_swagger_url` and `edfi_api.resources_swagger_url`.")
@@ -232,51 +382,180 @@ class EdFiAPI:
                 self.logger.debug("creating cache dir {0}".format(cache_dir))
                 os.mkdir(cache_dir)
 
-        for endpoint in openapi:
-            endpoint_type = endpoint["name"].lower()
-            if endpoint_type=="descriptors" or endpoint_type=="resources":
-                swagger_url = endpoint["endpointUri"]
-                if self.lightbeam.track_state:
-                    url_hash = hashlog.get_hash_string(swagger_url)
-                    file = os.path.join(cache_dir, f"swagger-{endpoint_type}-{url_hash}.json")
-                if (
-                    self.lightbeam.track_state  # we have a state_dir in which to store
-                    and not self.lightbeam.wipe # we aren't clearing the cache
-                    and os.path.isfile(file)    # the cache file exists
-                    and time.time()-os.path.getmtime(file)<self.SWAGGER_CACHE_TTL # cache file isn't expired
-                ):
-                    self.logger.debug(f"re-using cached {endpoint_type} swagger doc (from {file})...")
-                    with open(file) as f:
-                        swagger = json.load(f)
-                else:
-                    self.logger.debug(f"fetching {endpoint_type} swagger doc...")
-                    try:
-                        response = self.get_with_protocol_fallback(swagger_url, endpoint_type)
-                        if not response.ok:
-                            raise Exception("OpenAPI metadata URL returned status {0} ({1})".format(response.status_code, (response.content[:75] + "...") if len(response.content)>75 else response.content))
-                        swagger = response.json()
-                        if '"x-Ed-Fi-isIdentity":' in response.text:
-                            self.reports_identity = True
+        # (from the metadata bundle, if it's current; both are requested at once)
+        swagger_docs = [ (endpoint["name"].lower(), endpoint["endpointUri"]) for endpoint in openapi
+            if endpoint["name"].lower() in ["descriptors", "resources"] ]
+        for _, url in swagger_docs:
+            # (the bundle only holds the version of a Swagger doc, once it's been preprocessed and cached - see
+            # `lightbeam/swagger.py`; if that's gone missing, the doc must be re-fetched)
+            cached = self.metadata_bundle.get(url, None)
+            if cached and cached["body"] is None and not os.path.isfile(self.get_swagger_cache_file(cached.get("version", ""))):
+                del self.metadata_bundle[url]
+        try:
+            swagger_texts = self.get_metadata_concurrently([ (url, endpoint_type, self.SWAGGER_CACHE_TTL) for endpoint_type, url in swagger_docs ])
+        except Exception as e:
+            self.logger.critical(f"Unable to load Swagger from API... terminating. Check API connectivity. ({str(e)})")
 
+        for (endpoint_type, url), swagger_text in zip(swagger_docs, swagger_texts):
+            if swagger_text is None:
+                swagger_version = self.metadata_bundle[url]["version"]
+                try:
+                    swagger, info = swagger_cache.load(self.get_swagger_cache_file(swagger_version))
+                except Exception as e:
+                    # (a cached Swagger doc which can't be read is dropped, and the doc re-fetched)
+                    self.logger.debug(f"(could not load cached {endpoint_type} swagger; it will be re-fetched: {str(e)})")
+                    del self.metadata_bundle[url]
+                    self.metadata_checked.discard(url)
+                    self.metadata_bundle_changed = True
+                    try:
+                        swagger_text = self.get_metadata(url, endpoint_type, self.SWAGGER_CACHE_TTL)
                     except Exception as e:
-                        self.logger.critical(f"Unable to load {endpoint_type} Swagger from API... terminating. Check API connectivity.")
+                        self.logger.critical(f"Unable to load Swagger from API... terminating. Check API connectivity. ({str(e)})")
+            if swagger_text is not None:
+                # (a change to the Swagger invalidates any cached validation results; see `Validator`)
+                swagger_version = hashlog.get_hash_string(swagger_text)
+                swagger = json.loads(swagger_text)
+                info = {"reports_identity": '"x-Ed-Fi-isIdentity":' in swagger_text}
+                if self.lightbeam.track_state:
+                    self.logger.debug(f"caching {endpoint_type} swagger...")
+                    swagger_cache.save(self.get_swagger_cache_file(swagger_version), swagger, info)
+                    self.metadata_bundle[url].update({"body": None, "version": swagger_version})
+                    self.metadata_bundle_changed = True
+            if info["reports_identity"]:
+                self.reports_identity = True
+            self.swagger_versions[endpoint_type] = swagger_version
 
-                    if self.lightbeam.track_state:
-                        self.logger.debug(f"(saving to {file})")
-                        with open(file, 'w') as f:
-                            json.dump(swagger, f)
-                
             if endpoint_type=="descriptors": self.descriptors_swagger = swagger
             if endpoint_type=="resources": self.resources_swagger = swagger
-
-    # Loops over all descriptor endpoints (from Descriptors swagger) and fetches all valid
-    # Descriptor values for each Descriptor. These values can then be used by
+        self.save_metadata_bundle()
+
+        # load any cached EndpointPlans for this Swagger (and namespaces and data URL); if they're already
+        # loaded (by an earlier call, with the same Swagger), they're kept, with any plans built since
+        plans_hash = hashlog.get_hash_string(json.dumps([
+            self.swagger_versions,
+            self.lightbeam.config["namespace"],
+            self.lightbeam.config.get("namespace_overrides", None),
+            self.config["data_url"],
+        ], sort_keys=True))
+        if plans_hash==self.endpoint_plans_hash: return
+        self.save_endpoint_plans() # (any built for a previous Swagger)
+        self.endpoint_plans_hash = plans_hash
+        self.endpoint_plans = {}
+        self.endpoint_plans_file = None
+        self.endpoint_plans_changed = False
+        if self.lightbeam.track_state:
+            self.endpoint_plans_file = os.path.join(cache_dir, f"endpoint-plans-{plans_hash}.dat")
+            if not self.lightbeam.wipe:
+                try:
+                    self.endpoint_plans = hashlog.load(self.endpoint_plans_file)
+                except Exception as e:
+                    self.logger.debug(f"(could not load cached endpoint plans; they will be rebuilt)")
+                    self.endpoint_plans = {}
+
+    def get_swagger_cache_file(self, swagger_version):
+        return os.path.join(self.lightbeam.config["state_dir"], "cache", f"swagger-{swagger_version}.dat")
+
+    # Returns the EndpointPlan for an endpoint, building it first if necessary (newly-built plans are cached
+    # by `save_endpoint_plans()`)
+    def get_endpoint_plan(self, endpoint):
+        if endpoint not in self.endpoint_plans:
+            self.endpoint_plans[endpoint] = self.build_endpoint_plan(endpoint)
+            self.endpoint_plans_changed = True
+        return self.endpoint_plans[endpoint]
+
+    # Saves any newly-built EndpointPlans (once, at the end of a command, rather than as each is built)
+    def save_endpoint_plans(self):
+        if self.endpoint_plans_file and self.endpoint_plans_changed:
+            hashlog.save(self.endpoint_plans_file, self.endpoint_plans)
+            self.endpoint_plans_changed = False
+
+    def build_endpoint_plan(self, endpoint):
+        self.logger.debug(f"(building plan for {endpoint}...)")
+        namespace = self.lightbeam.get_namespace_for_endpoint(endpoint)
+        if "Descriptor" in endpoint:
+            swagger_type = "descriptors"
+            swagger = self.descriptors_swagger
+        else:
+            swagger_type = "resources"
+            swagger = self.resources_swagger
+        definition = util.get_swagger_ref_for_endpoint(namespace, swagger, endpoint)
+        if not util.resolve_swagger_ref(swagger, definition):
+            self.logger.critical(f"Swagger does not contain a definition for `{endpoint}` - check that the endpoint and namespace are correct.")
+        plan = EndpointPlan(endpoint, namespace, swagger_type,
+            definition.split("/")[-1],
+            util.url_join(self.config["data_url"], namespace, endpoint))
+        plan.required_params = self.get_required_params_from_swagger(swagger, definition)
+        plan.all_params = self.get_all_params_from_swagger(swagger, definition)
+        if swagger_type=="descriptors":
+            # descriptor endpoints all have the same structure and identity fields:
+            plan.identity_params = { 'namespace':'namespace', 'codeValue':'codeValue', 'shortDescription':'shortDescription'}
+        else:
+            plan.identity_params = self.get_identity_params_from_swagger(swagger, definition)
+            plan.references = self.load_references_structure(swagger, plan.definition)
+        plan.descriptor_paths = self.get_descriptor_paths_from_swagger(swagger, definition)
+        plan.array_identities = self.get_array_identities_from_swagger(swagger, definition)
+        return plan
+
+    # Returns the endpoints which (possibly nested) references in payloads of a definition can be to, and
+    # the (required) properties of each reference
+    def load_references_structure(self, swagger, definition):
+        if "definitions" in swagger.keys():
+            schema = swagger["definitions"][definition]
+        elif "components" in swagger.keys() and "schemas" in swagger["components"].keys():
+            schema = swagger["components"]["schemas"][definition]
+        else:
+            self.logger.critical(f"Swagger contains neither `definitions` nor `components.schemas` - check that the Swagger is valid.")
+        references = {}
+        prefixes_to_remove = ["#/definitions/", "#/components/schemas/"]
+        for k in schema["properties"].keys():
+            if k.endswith("Reference"):
+                original_endpoint = util.resolve_reference_to_endpoint(k)
+
+                # this deals with the fact that an educationOrganizationReference may be to a school, LEA, etc.:
+                endpoints_to_check = util.EDFI_GENERICS_TO_RESOURCES_MAPPING.get(original_endpoint, [original_endpoint])
+                
+                for endpoint in endpoints_to_check:
+                    ref_definition = schema["properties"][k]["$ref"]
+                    for prefix_to_remove in prefixes_to_remove:
+                        ref_definition = ref_definition.replace(prefix_to_remove,"")
+                    # look up (in swagger) the required fields for any reference
+                    ref_properties = self.load_reference(swagger, ref_definition)
+                    references[endpoint] = ref_properties
+            elif "items" in schema["properties"][k].keys():
+                # this deals with a property which is a list of items which themselves contain References
+                # (example: studentAssessment.studentObjectiveAssessments contain an objectiveAssessmentReference)
+                nested_definition = schema["properties"][k]["items"]["$ref"]
+                for prefix_to_remove in prefixes_to_remove:
+                    nested_definition = nested_definition.replace(prefix_to_remove,"")
+                nested_references = self.load_references_structure(swagger, nested_definition)
+                references.update(nested_references)
+        return references
+
+    def load_reference(self, swagger, definition):
+        properties = []
+        if "definitions" in swagger.keys():
+            schema = swagger["definitions"][definition]
+        elif "components" in swagger.keys() and "schemas" in swagger["components"].keys():
+            schema = swagger["components"]["schemas"][definition]
+        else:
+            self.logger.critical(f"Swagger contains neither `definitions` nor `components.schemas` - check that the Swagger is valid.")
+        for k in schema["properties"].keys():
+            if k in schema.get("required",[]):
+                properties.append(k)
+        return properties
+
+    # Loads the valid values of each descriptor which can occur in payloads of `endpoints` (see
+    # `get_descriptor_endpoints()`), as `self.descriptor_values`: a dictionary of descriptor endpoint ->
+    # {`namespace#codeValue`: (shortDescription, description)}. These values can then be used by
     # `validate_endpoint()` to check for invalid descriptor values before `send`ing.
-    async def load_descriptors_values(self):
-        # get token with which to send requests
-        self.do_oauth()
-
+    #
+    # Each descriptor's values are cached (in `state_dir`) separately, for up to a month; only those which
+    # aren't cached (or have expired) are fetched, concurrently.
+    async def load_descriptors_values(self, endpoints):
         self.logger.debug("loading descriptor values...")
+        descriptor_endpoints = self.get_descriptor_endpoints(endpoints)
+        cache = {}
+        cache_file = None
         if self.lightbeam.track_state:
             cache_dir = os.path.join(self.lightbeam.config["state_dir"], "cache")
             if not os.path.isdir(cache_dir):
@@ -285,59 +564,83 @@ class EdFiAPI:
         
             # check for cached descriptor values
             url_hash = hashlog.get_hash_string(self.config["base_url"])
-            cache_file = os.path.join(cache_dir, f"descriptor-values-{url_hash}.csv")
+            cache_file = os.path.join(cache_dir, f"descriptor-values-{url_hash}.dat")
+            if not self.lightbeam.wipe:
+                try:
+                    cache = hashlog.load(cache_file)
+                except Exception as e:
+                    self.logger.debug(f"(could not load cached descriptor values; they will be re-fetched)")
+                    cache = {}
 
         self.lightbeam.reset_counters()
-        if (
-            self.lightbeam.track_state     # we have a state_dir, and therefore a cache dir in which to save
-            and not self.lightbeam.wipe    # we're not wiping/rebuilding the cache
-            and os.path.isfile(cache_file) # the cache file exists
-            and time.time()-os.path.getmtime(cache_file)<self.DESCRIPTORS_CACHE_TTL # the cache file isn't expired
-        ):
-            # cache file exists and we can use it!
-            self.logger.debug(f"re-using cached descriptor values (from {cache_file})...")
-            with open(cache_file, 'r') as csvfile:
-                csvreader = csv.reader(csvfile)
-                fields = next(csvreader)
-                self.descriptor_values = []
-                for row in csvreader:
-                    self.descriptor_values.append(row)
-        else:
-            # load descriptor values from API
-            selector_backup = self.lightbeam.selector
-            exclude_backup = self.lightbeam.exclude
-            keep_keys_backup = self.lightbeam.keep_keys
-            drop_keys_backup = self.lightbeam.drop_keys
-            self.lightbeam.selector = "*Descriptors"
-            self.lightbeam.exclude = ""
-            self.lightbeam.keep_keys = "*"
-            self.lightbeam.drop_keys = ""
-            self.logger.debug(f"fetching descriptor values...")
-            all_endpoints = self.get_sorted_endpoints()
-            self.lightbeam.endpoints = self.apply_filters(all_endpoints)
-            await self.lightbeam.fetcher.get_records(do_write=False, log_status_counts=False)
-            self.descriptor_values = []
-            for v in self.lightbeam.results:
-                descriptor = ""
-                for key in v.keys():
-                    if key.endswith("Id"): descriptor = key[0:-2]
-                self.descriptor_values.append([descriptor, v["namespace"], v["codeValue"], v["shortDescription"], v.get("description", "")])
-
-            # save
-            if self.lightbeam.track_state:
+        # (with `--offline`, expired values are re-used, since they're all we have)
+        to_fetch = [ descriptor for descriptor in descriptor_endpoints if descriptor not in cache
+            or (time.time()-cache[descriptor]["fetched"]>=self.DESCRIPTORS_CACHE_TTL and not self.lightbeam.offline) ]
+        if to_fetch and self.lightbeam.offline:
+            self.logger.critical("descriptor values for {0} aren't cached (in `state_dir`) from a previous run, so can't be loaded `--offline`".format(", ".join(to_fetch)))
+        if len(to_fetch)<len(descriptor_endpoints):
+            self.logger.debug(f"re-using cached descriptor values for {len(descriptor_endpoints)-len(to_fetch)} descriptors (from {cache_file})...")
+        if to_fetch:
+            self.logger.debug(f"fetching descriptor values for {len(to_fetch)} descriptors...")
+            self.do_oauth()
+            async with self.lightbeam.open_client():
+                fetched = await asyncio.gather(*[ self.fetch_descriptor_values(descriptor) for descriptor in to_fetch ])
+            for descriptor, (values, complete) in zip(to_fetch, fetched):
+                if values is None: continue
+                cache[descriptor] = {
+                    # (incomplete values are used for this run, but then treated as expired)
+                    "fetched": time.time() if complete else 0,
+                    "version": hashlog.get_hash_string(json.dumps(sorted(values.items()))),
+                    "values": values,
+                }
+            if cache_file:
                 self.logger.debug(f"saving descriptor values to {cache_file}...")
-                header = ['descriptor', 'namespace', 'codeValue', 'shortDescription', 'description']
-                with open(cache_file, 'w', encoding='UTF8', newline='') as f:
-                    writer = csv.writer(f)
-                    writer.writerow(header)
-                    writer.writerows(self.descriptor_values)
-
-            self.lightbeam.results = []
-            self.lightbeam.selector = selector_backup
-            self.lightbeam.exclude = exclude_backup
-            self.lightbeam.keep_keys = keep_keys_backup
-            self.lightbeam.drop_keys = drop_keys_backup
-            self.prepare()
+                hashlog.save(cache_file, cache)
+
+        self.descriptor_values = { descriptor: cache[descriptor]["values"] for descriptor in descriptor_endpoints if descriptor in cache }
+        # (only changes to the values of these descriptors invalidate cached validation results; see `Validator`)
+        self.descriptor_values_version = hashlog.get_hash_string(json.dumps([
+            [descriptor, cache[descriptor]["version"]] for descriptor in descriptor_endpoints if descriptor in cache ]))
+
+    # Returns the descriptor endpoints whose values can occur in payloads of `endpoints`, per the descriptor
+    # paths of their EndpointPlans. The Swagger doesn't say which descriptor a property holds, but Ed-Fi names
+    # descriptor properties after their descriptor, possibly role-named (like `entryGradeLevelDescriptor`, which
+    # holds a `gradeLevelDescriptor`), so each matches every descriptor of the API whose name it ends with. If
+    # any property matches none, all descriptors are returned, so its values can still be checked.
+    def get_descriptor_endpoints(self, endpoints):
+        descriptors = [ x for x in self.lightbeam.all_endpoints if x.endswith("Descriptors") ]
+        properties = set(path[-1] for endpoint in endpoints for path in self.get_endpoint_plan(endpoint).descriptor_paths)
+        matched = set()
+        for prop in sorted(properties):
+            matches = [ descriptor for descriptor in descriptors if self.descriptor_matches_property(descriptor, prop) ]
+            if not matches:
+                self.logger.debug(f"(no descriptor matches the name of property {prop}, so values of all descriptors will be loaded)")
+                return descriptors
+            matched.update(matches)
+        return [ descriptor for descriptor in descriptors if descriptor in matched ]
+
+    # Returns whether a descriptor property (like `entryGradeLevelDescriptor`) can hold values of a descriptor
+    # endpoint (like `gradeLevelDescriptors`)
+    @staticmethod
+    def descriptor_matches_property(descriptor, prop):
+        return prop==descriptor[:-1] or prop.endswith(descriptor[0].upper() + descriptor[1:-1])
+
+    # Fetches all values of a descriptor (as `load_descriptors_values()` stores them, or None if they couldn't
+    # be loaded), and whether they all could be
+    async def fetch_descriptor_values(self, descriptor):
+        num_records = await self.lightbeam.counter.get_record_count(descriptor)
+        if num_records is None: return None, False
+        limit = self.lightbeam.config["fetch"]["page_size"]
+        pages = await asyncio.gather(*[ self.lightbeam.fetcher.get_records_page(descriptor, offset, limit) for offset in range(0, num_records, limit) ])
+        values = {}
+        for page in pages:
+            # (a page which failed to load comes back as None)
+            for v in page or []:
+                values[f"{v['namespace']}#{v['codeValue']}"] = (v["shortDescription"], v.get("description", ""))
+        if len(values)<num_records:
+            self.logger.warn(f"only {len(values)} of {num_records} values of {descriptor} could be loaded")
+            return values, False
+        return values, True
 
 
     # This function (and the helper below) walks through the swagger for a resource, following references,
@@ -350,19 +653,13 @@ class EdFiAPI:
     # (The first element is a required attribute of the assessmentItem; the other two are required elements
     # of the required nested assessmentReference.)
     def get_params_for_endpoint(self, endpoint, type='required'):
-        if "Descriptor" in endpoint: swagger = self.descriptors_swagger
-        else: swagger = self.resources_swagger
-        definition = util.get_swagger_ref_for_endpoint(self.lightbeam.get_namespace_for_endpoint(endpoint), swagger, endpoint)
+        plan = self.get_endpoint_plan(endpoint)
         if type=='required':
-            return self.get_required_params_from_swagger(swagger, definition)
+            return plan.required_params
         elif type=='all':
-            return self.get_all_params_from_swagger(swagger, definition)
+            return plan.all_params
         else:
-            # descriptor endpoints all have the same structure and identity fields:
-            if "Descriptor" in endpoint:
-                return { 'namespace':'namespace', 'codeValue':'codeValue', 'shortDescription':'shortDescription'}
-            else:
-                return self.get_identity_params_from_swagger(swagger, definition)
+            return plan.identity_params
 
     def get_required_params_from_swagger(self, swagger, definition, prefix=""):
         params = {}
@@ -370,13 +667,13 @@ class EdFiAPI:
         if not schema:
             self.logger.critical(f"Swagger contains neither `definitions` nor `components.schemas` - check that the Swagger is valid.")
         
-        for prop in schema["required"]:
+        for prop in schema.get("required", []):
             if "$ref" in schema["properties"][prop].keys():
                 sub_definition = schema["properties"][prop]["$ref"]
                 sub_params = self.get_required_params_from_swagger(swagger, sub_definition, prefix=prop+".")
                 for k,v in sub_params.items():
                     params[k] = v
-            elif schema["properties"][prop]["type"]!="array":
+            elif schema["properties"][prop].get("type", None)!="array":
                 params[prop] = prefix + prop
         return params
 
@@ -396,10 +693,12 @@ class EdFiAPI:
                 sub_params = self.get_all_params_from_swagger(swagger, sub_definition, prefix=prefix+prop+"_")
                 for k,v in sub_params.items():
                     params[prop_name][k] = v
-            elif schema["properties"][prop]["type"]!="array":
-                params[prop_name] = f"[{schema['properties'][prop]['type']}]" + prefix + prop
-            else:
+            elif schema["properties"][prop].get("type", None)!="array":
+                params[prop_name] = f"[{schema['properties'][prop].get('type', 'string')}]" + prefix + prop
+            elif "$ref" in schema["properties"][prop].get("items", {}).keys():
                 params[prop_name] = [self.get_all_params_from_swagger(swagger, schema["properties"][prop]["items"]["$ref"], prefix=prefix+prop+"-")]
+            else:
+                params[prop_name] = [f"[{schema['properties'][prop].get('items', {}).get('type', 'string')}]" + prefix + prop]
         return params
 
     def get_identity_params_from_swagger(self, swagger, definition, prefix=""):
@@ -417,15 +716,45 @@ class EdFiAPI:
             elif "type" in schema["properties"][prop].keys() and schema["properties"][prop]["type"]!="array" and "x-Ed-Fi-isIdentity" in schema["properties"][prop].keys():
                 params[prop] = prefix + prop
         return params
+
+    # Returns the paths (tuples of property names, with "*" for each item of an array) to all properties
+    # which contain descriptor values
+    def get_descriptor_paths_from_swagger(self, swagger, definition, prefix=(), seen=()):
+        paths = []
+        schema = util.resolve_swagger_ref(swagger, definition)
+        if not schema or definition in seen: return paths
+        for prop, prop_schema in schema.get("properties", {}).items():
+            if "$ref" in prop_schema.keys():
+                paths.extend(self.get_descriptor_paths_from_swagger(swagger, prop_schema["$ref"], prefix+(prop,), seen+(definition,)))
+            elif prop_schema.get("type", None)=="array" and "$ref" in prop_schema.get("items", {}).keys():
+                paths.extend(self.get_descriptor_paths_from_swagger(swagger, prop_schema["items"]["$ref"], prefix+(prop, "*"), seen+(definition,)))
+            elif prop.endswith("Descriptor") and prop_schema.get("type", None)=="string":
+                paths.append(prefix+(prop,))
+        return paths
+
+    # Returns the identity params structure for items of each array property (recursively)
+    def get_array_identities_from_swagger(self, swagger, definition, seen=()):
+        arrays = {}
+        schema = util.resolve_swagger_ref(swagger, definition)
+        if not schema or definition in seen: return arrays
+        for prop, prop_schema in schema.get("properties", {}).items():
+            if prop_schema.get("type", None)=="array" and "$ref" in prop_schema.get("items", {}).keys():
+                item_definition = prop_schema["items"]["$ref"]
+                arrays[prop] = {
+                    "identity": self.get_identity_params_from_swagger(swagger, item_definition),
+                    "arrays": self.get_array_identities_from_swagger(swagger, item_definition, seen+(definition,)),
+                }
+        return arrays
     
-    def get_with_protocol_fallback(self, url, url_type):
+    def get_with_protocol_fallback(self, url, url_type, headers=None):
+        import requests
         self.logger.debug(f"fetching {url_type}...")
         try:
-            return requests.get(url, verify=self.lightbeam.config.get("connection", {}).get("verify_ssl", True))
+            return requests.get(url, headers=headers, verify=self.lightbeam.config.get("connection", {}).get("verify_ssl", True))
         except Exception as e:
             try:
                 swapped_url = url.replace("http://", "https://") if "http://" in url else url.replace("https://", "http://")
-                return requests.get(swapped_url, verify=self.lightbeam.config.get("connection", {}).get("verify_ssl", True))
+                return requests.get(swapped_url, headers=headers, verify=self.lightbeam.config.get("connection", {}).get("verify_ssl", True))
             except Exception as e:
                 print(e)
                 self.logger.critical(f"could not reach {url_type} {url} ({str(e)})")
\ No newline at end of file
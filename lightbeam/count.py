@@ -1,6 +1,7 @@
 import os
 import json
 import asyncio
+import concurrent.futures
 from lightbeam import util
 
 class Counter:
@@ -10,8 +11,34 @@ class Counter:
         self.logger = self.lightbeam.logger
     
     def count(self):
+        # `count.mode` is `remote` (count records in the API), `local` (count records in `data_dir`), or
+        # `reconcile` (both, and the difference)
+        mode = self.lightbeam.config["count"]["mode"]
+        if mode not in ["remote", "local", "reconcile"]:
+            self.logger.critical("`config.count.mode` must be one of `remote` (default), `local`, or `reconcile`")
+        separator = self.lightbeam.config["count"]["separator"]
+
         self.lightbeam.results = []
-        asyncio.run(self.get_record_counts())
+        if mode!="local":
+            asyncio.run(self.get_record_counts())
+        if mode=="remote":
+            header = ["Records"]
+        else:
+            local_counts = self.get_local_record_counts(self.lightbeam.get_endpoints_with_data(self.lightbeam.endpoints))
+            if mode=="local":
+                header = ["Records"]
+                self.lightbeam.results = [ [endpoint, count] for endpoint, count in local_counts.items() ]
+            else:
+                header = ["Local", "Remote", "Delta"]
+                remote_counts = dict(self.lightbeam.results)
+                self.lightbeam.results = []
+                for endpoint in self.lightbeam.endpoints:
+                    local_count = local_counts.get(endpoint, 0)
+                    remote_count = remote_counts.get(endpoint, None)
+                    # (an endpoint whose remote count couldn't be loaded has no remote count or delta)
+                    delta = local_count - remote_count if remote_count is not None else None
+                    self.lightbeam.results.append([endpoint, local_count, remote_count, delta])
+
         # sort results into dependency order:
         sort_keys = self.lightbeam.api.get_sorted_endpoints()
         self.lightbeam.results = sorted(self.lightbeam.results ,key=lambda x:sort_keys.index(x[0]))
@@ -22,19 +49,40 @@ class Counter:
             os.makedirs(os.path.dirname(self.lightbeam.results_file), exist_ok=True)
             with open(self.lightbeam.results_file, 'w') as fp:
                 # write header
-                fp.write("Records" + self.lightbeam.config["count"]["separator"] + "Endpoint\n")
+                fp.write(separator.join(header + ["Endpoint"]) + "\n")
                 for result in self.lightbeam.results:
                     # write row
-                    fp.write(str(result[1]) + self.lightbeam.config["count"]["separator"] + result[0] + "\n")
+                    fp.write(self.format_row(result, separator) + "\n")
         # output to console
         else:
             # print header
-            print("Records" + self.lightbeam.config["count"]["separator"] + "Endpoint")
+            print(separator.join(header + ["Endpoint"]))
             for result in self.lightbeam.results:
-                # when printing to the console, only include endpoints with >0 records
-                if result[1] > 0:
+                # when printing to the console, only include endpoints with >0 records (or a delta)
+                if any(result[1:]):
                     # print row
-                    print(str(result[1]) + self.lightbeam.config["count"]["separator"] + result[0])
+                    print(self.format_row(result, separator))
+
+    # Formats a result ([endpoint, count, ...]) as a row of output, with counts first
+    def format_row(self, result, separator):
+        return separator.join([ "" if count is None else str(count) for count in result[1:] ] + [result[0]])
+
+    # Counts the records in the local data files of each of `endpoints` (reading files in parallel), re-using
+    # (and then caching) the counts of unchanged files (see `Lightbeam.record_counts`)
+    def get_local_record_counts(self, endpoints):
+        files = [ (endpoint, file_name) for endpoint in endpoints for file_name in self.lightbeam.get_data_files_for_endpoint(endpoint) ]
+        counts = { endpoint: 0 for endpoint in endpoints }
+        to_count = []
+        for endpoint, file_name in files:
+            count = self.lightbeam.get_record_count(file_name)
+            if count is None: to_count.append((endpoint, file_name))
+            else: counts[endpoint] += count
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            for (endpoint, file_name), count in zip(to_count, executor.map(util.count_records, [ file_name for _, file_name in to_count ])):
+                counts[endpoint] += count
+                self.lightbeam.set_record_count(file_name, count)
+        self.lightbeam.save_record_counts()
+        return counts
     
     async def get_record_counts(self):
         self.lightbeam.api.do_oauth()
@@ -45,23 +93,30 @@ class Counter:
         counter = 0
         for endpoint in self.lightbeam.endpoints:
             counter += 1
-            tasks.append(asyncio.create_task(self.get_record_count(endpoint)))
+            tasks.append(asyncio.create_task(self.add_record_count(endpoint)))
 
         await self.lightbeam.do_tasks(tasks, counter, log_status_counts=False)
-    
+
+    async def add_record_count(self, endpoint):
+        total_count = await self.get_record_count(endpoint)
+        if total_count is not None:
+            self.lightbeam.results.append([endpoint, total_count])
+
+    # Returns the number of records of an endpoint (matching `params`), or None if it couldn't be loaded
     async def get_record_count(self, endpoint, params={}):
         try:
             # don't bother with handling 401 token expiry (like `send` and `delete` do)
             # since `count` should finish _very_ quickly - way before expiry
-            params.update({ "limit": "0", "totalCount": "true" })
+            params = dict(params, limit="0", totalCount="true")
             async with self.lightbeam.api.client.get(
                 util.url_join(self.lightbeam.api.config["data_url"], self.lightbeam.get_namespace_for_endpoint(endpoint), endpoint),
                 params=params,
                 ssl=self.lightbeam.config["connection"]["verify_ssl"],
-                headers=self.lightbeam.api.headers
+                headers=await self.lightbeam.api.get_headers()
                 ) as response:
                 body = await response.text()
                 status = str(response.status)
+                self.lightbeam.num_finished += 1
                 if status not in ['200', '201']:
                     self.logger.warn(f"Unable to load counts for {endpoint}... {status} API response.")
                 else:
@@ -70,8 +125,7 @@ class Counter:
                         self.logger.warn(f"Unable to load counts for {endpoint}...")
                         self.lightbeam.num_errors += 1
                     else:
-                        self.lightbeam.results.append([endpoint, total_count])
-                self.lightbeam.num_finished += 1
+                        return total_count
 
         except Exception as e:
             self.logger.critical(f"Unable to load counts for {endpoint} from API... terminating. Check API connectivity.")
\ No newline at end of file
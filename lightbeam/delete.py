@@ -1,6 +1,7 @@
+import re
 import os
 import json
-import copy
+import math
 import asyncio
 
 from lightbeam import util
@@ -13,7 +14,9 @@ class Deleter:
         self.lightbeam = lightbeam
         self.lightbeam.reset_counters()
         self.logger = self.lightbeam.logger
+        # (endpoints of a dependency level are deleted concurrently, so these are per endpoint)
         self.hashlog_data = {}
+        self.id_indexes = {}
     
     # Deletes data matching payloads in config.data_dir for selected endpoints
     def delete(self):
@@ -28,54 +31,43 @@ class Deleter:
         if len(endpoints)==0:
             self.logger.critical("`data_dir` {0} has no *.jsonl files".format(self.lightbeam.config["data_dir"]) + " for selected endpoints")
         
-        # process endpoints in reverse-dependency order, so we don't get dependency errors
-        endpoints = copy.deepcopy(endpoints)
-        endpoints.reverse()
-
         # prompt to confirm this destructive operation
-        self.lightbeam.confirm_delete(endpoints)
+        self.lightbeam.confirm_delete(list(reversed(endpoints)))
 
-        for endpoint in endpoints:
-            asyncio.run(self.do_deletes(endpoint))
-            self.logger.info("finished processing endpoint {0}!".format(endpoint))
-            self.logger.info("  (final status counts: {0})".format(self.lightbeam.status_counts))
-            self.lightbeam.log_status_reasons()
+        # process endpoints in reverse-dependency order, so we don't get dependency errors
+        self.lightbeam.run_reverse_dependency_levels(endpoints, self.do_deletes)
 
     # Deletes data matching payloads in config.data_dir for single endpoint
     async def do_deletes(self, endpoint):
         # load the hashlog, since we delete previously-seen payloads from it after deleting them
+        self.hashlog_data[endpoint] = {}
         if self.lightbeam.track_state:
             hashlog_file = os.path.join(self.lightbeam.config["state_dir"], f"{endpoint}.dat")
-            self.hashlog_data = hashlog.load(hashlog_file)
-        
-        self.lightbeam.reset_counters()
+            self.hashlog_data[endpoint] = hashlog.load(hashlog_file)
+        hashlog_data = self.hashlog_data[endpoint]
         
         data_files = self.lightbeam.get_data_files_for_endpoint(endpoint)
         tasks = []
 
         # determine the fields that uniquely define a record for this endpoint
-        interpolation_type = 'required'
-        if self.lightbeam.api.reports_identity: interpolation_type = 'identity'
-        params_structure = self.lightbeam.api.get_params_for_endpoint(endpoint, type=interpolation_type)
+        plan = self.lightbeam.api.get_endpoint_plan(endpoint)
+        if self.lightbeam.api.reports_identity: params_structure = plan.identity_params
+        else: params_structure = plan.required_params
+        # (Descriptors are matched by just their namespace and codeValue)
+        if endpoint.endswith('Descriptors'): params_structure = {'namespace': 'namespace', 'codeValue': 'codeValue'}
         
-        # for Descriptors, we need to fetch all Descriptor values first, then we can look up the ID for deletion
-        if endpoint.endswith('Descriptors'):
-            self.logger.info("fetching current descriptors from endpoint {0} ...".format(endpoint))
-            selector_backup = self.lightbeam.selector
-            exclude_backup = self.lightbeam.exclude
-            drop_keys_backup = self.lightbeam.drop_keys
-            self.lightbeam.selector = endpoint
-            self.lightbeam.exclude = ""
-            self.lightbeam.drop_keys = "_etag,_lastModifiedDate"
-            self.lightbeam.endpoints = [endpoint]
-            await self.lightbeam.fetcher.get_records(do_write=False, log_status_counts=False)
-            self.lightbeam.reset_counters()
+        # The `id` of each payload to delete (unless saved when it was sent) is either found by searching the
+        # API for it, or (when deleting many of an endpoint's records) looked up in an index of all the
+        # endpoint's records
+        if await self.use_id_index(endpoint, data_files):
+            self.logger.info("indexing current records of endpoint {0} ...".format(endpoint))
+            await self.load_id_index(endpoint, params_structure)
 
         self.logger.info("deleting data from endpoint {0} ...".format(endpoint))
         # process each file
         counter = 0
         for file_name in data_files:
-            with open(file_name) as file:
+            with util.open_data_file(file_name) as file:
                 # process each payload
                 for line in file:
                     counter += 1
@@ -87,9 +79,9 @@ class Deleter:
 
                     # check if we've posted this data before
                     data_hash = hashlog.get_hash(data)
-                    if self.lightbeam.track_state and data_hash in self.hashlog_data.keys():
+                    if self.lightbeam.track_state and data_hash in hashlog_data.keys():
                         # check if the last post meets criteria for a delete
-                        if self.lightbeam.meets_process_criteria(self.hashlog_data[data_hash]):
+                        if self.lightbeam.meets_process_criteria(hashlog_data[data_hash]):
                             # yes, we need to delete it; append to task queue
                             tasks.append(asyncio.create_task(
                                 self.do_delete(endpoint, file_name, params, counter, data_hash)))
@@ -108,77 +100,132 @@ class Deleter:
                     
             if len(tasks)>0: await self.lightbeam.do_tasks(tasks, counter)
 
-        if endpoint.endswith('Descriptors'):
-            self.lightbeam.results = []
-            self.lightbeam.selector = selector_backup
-            self.lightbeam.exclude = exclude_backup
-            self.lightbeam.drop_keys = drop_keys_backup
-            self.lightbeam.api.prepare()
+        self.id_indexes.pop(endpoint, None)
 
         # any task may have updated the hashlog, so we need to re-save it out to disk
+        hashlog_data = self.hashlog_data.pop(endpoint)
         if self.lightbeam.track_state:
-            hashlog.save(hashlog_file, self.hashlog_data)
+            hashlog.save(hashlog_file, hashlog_data)
+        self.logger.info("finished processing endpoint {0}!".format(endpoint))
+
+    # Returns whether to look up the `id`s of payloads to delete in an index of an endpoint's records (per
+    # `config.delete.lookup`); by default, only if indexing would take fewer requests than searching for
+    # each payload
+    async def use_id_index(self, endpoint, data_files):
+        lookup = self.lightbeam.config["delete"]["lookup"]
+        if lookup not in ["auto", "search", "index"]:
+            self.logger.critical("`config.delete.lookup` must be one of `auto` (default), `search`, or `index`")
+        # (payloads with a saved `id` needn't be looked up; they're estimated from the hashlog, rather than
+        # by reading and hashing every payload before they're all read again to be deleted)
+        # (and counted - if not already, by `count` or an earlier command - only to be cached for next time)
+        num_payloads = self.lightbeam.counter.get_local_record_counts([endpoint])[endpoint]
+        num_payloads -= sum(1 for entry in self.hashlog_data[endpoint].values() if len(entry)>2)
+        if num_payloads<=0: return False
+        # (Descriptors can't be searched for, so are always indexed)
+        if endpoint.endswith('Descriptors'): return True
+        if lookup!="auto": return lookup=="index"
+        num_records = await self.lightbeam.counter.get_record_count(endpoint)
+        if num_records is None: return False
+        # (indexing takes a GET per page of the endpoint's records, searching a GET per payload)
+        return math.ceil(num_records / self.lightbeam.config["fetch"]["page_size"]) < num_payloads
+
+    # Fetches all of an endpoint's records (a page at a time, keeping only their identity and `id`) to build
+    # an index from the hash of each one's identity to its `id`. Pages are fetched by `pool_size` workers,
+    # so only that many requests (and pages of records) are in flight at once.
+    async def load_id_index(self, endpoint, params_structure):
+        self.id_indexes[endpoint] = {}
+        num_records = await self.lightbeam.counter.get_record_count(endpoint)
+        if num_records is None: return
+        limit = self.lightbeam.config["fetch"]["page_size"]
+        offsets = iter(range(0, num_records, limit))
+        await asyncio.gather(*[ self.index_pages(endpoint, params_structure, offsets, limit)
+            for _ in range(self.lightbeam.config["connection"]["pool_size"]) ])
+
+    # Adds the records of pages (at `offsets`, shared with other workers) to an endpoint's index of `id`s
+    async def index_pages(self, endpoint, params_structure, offsets, limit):
+        id_index = self.id_indexes[endpoint]
+        for offset in offsets:
+            # (records of a page which failed to load are reported as not found, when they're deleted)
+            for record in await self.lightbeam.fetcher.get_records_page(endpoint, offset, limit) or []:
+                try:
+                    identity_hash = self.get_identity_hash(util.interpolate_params(params_structure, record))
+                except (KeyError, TypeError):
+                    continue
+                # (an identity that matches more than one record can't be deleted by it)
+                id_index[identity_hash] = record["id"] if identity_hash not in id_index else None
+
+    # (values are normalized, so payloads match records as the API's search would find them despite differences
+    # in formatting - like `"255901"` for `255901`, different casing of a descriptor, or a date with a time of
+    # midnight - although a payload not found in the index is still searched for; see `do_delete()`)
+    @classmethod
+    def get_identity_hash(cls, params):
+        return hashlog.get_hash(json.dumps({ k: cls.normalize_identity_value(v) for k, v in params.items() }, sort_keys=True))
+
+    @staticmethod
+    def normalize_identity_value(value):
+        value = str(value).strip().lower()
+        return re.sub(r"^(\d{4}-\d{2}-\d{2})[t ]00:00(:00(\.0+)?)?z?$", r"\1", value)
 
     # Deletes a single payload for a single endpoint
     async def do_delete(self, endpoint, file_name, params, line, data_hash=None):
+        # payloads previously sent (from this `state_dir`) can be deleted by the `id` saved then - unless the
+        # record has since been deleted (and maybe re-created), in which case it's looked up as usual
+        if data_hash is not None and len(self.hashlog_data[endpoint].get(data_hash, ()))>2:
+            saved_id = hashlog.unpack_id(self.hashlog_data[endpoint][data_hash][2])
+            if await self.do_delete_id(endpoint, saved_id, file_name, line, data_hash, not_found_ok=True): return
+
+        # with an index of the endpoint's records, the `id` is looked up there; a payload not found in it (which
+        # the API's search might still match, or which may have been created since the index was loaded) is
+        # searched for as usual - except a Descriptor, which can't be searched for
+        if endpoint in self.id_indexes:
+            id_index = self.id_indexes[endpoint]
+            identity_hash = self.get_identity_hash(params)
+            if id_index.get(identity_hash, None) is not None:
+                await self.do_delete_id(endpoint, id_index[identity_hash], file_name, line, data_hash)
+                return
+            if identity_hash in id_index or endpoint.endswith('Descriptors'):
+                skip_reason = "multiple matching payloads found in API" if identity_hash in id_index else "payload not found in API"
+                self.lightbeam.num_skipped += 1
+                self.lightbeam.increment_status_reason(skip_reason)
+                return
+
         curr_token_version = int(str(self.lightbeam.token_version))
         while True: # this is not great practice, but an effective way (along with the `break` below) to achieve a do:while loop
             try:
-                if endpoint.endswith('Descriptors'):
-                    skip_reason = None
-                    matching_descriptors = [x for x in self.lightbeam.results if x['namespace']==params['namespace'] and x['codeValue']==params['codeValue']]
-                    if len(matching_descriptors)==1:
-                        the_id = matching_descriptors[0]['id']
-                        await self.do_delete_id(endpoint, the_id, file_name, line)
-                        break
-                    elif len(matching_descriptors)>1: skip_reason = "multiple matching payloads found in API"
-                    else: skip_reason = "payload not found in API"
-                    if skip_reason:
-                        self.lightbeam.num_skipped += 1
-                        self.lightbeam.increment_status_reason(skip_reason)
-                        break # (out of while loop)
-                else:
-
-                    # we have to get the `id` for a particular resource by first searching for its natural keys
-                    async with self.lightbeam.api.client.get(
-                        util.url_join(self.lightbeam.api.config["data_url"], self.lightbeam.get_namespace_for_endpoint(endpoint), endpoint),
-                        params=params,
-                        ssl=self.lightbeam.config["connection"]["verify_ssl"],
-                        headers=self.lightbeam.api.headers
-                        ) as get_response:
-                        body = await get_response.text()
-                        status = get_response.status
-                        if status!=401:
-                            skip_reason = None
-                            if status in [200, 201]:
-                                j = json.loads(body)
-                                if type(j)==list and len(j)==1:
-                                    the_id = j[0]['id']
-                                    # now we can delete by `id`
-                                    await self.do_delete_id(endpoint, the_id, file_name, line, data_hash)
-                                    break
-                                    
-                                elif type(j)==list and len(j)==0: skip_reason = "payload not found in API"
-                                elif type(j)==list and len(j)>1: skip_reason = "multiple matching payloads found in API"
-                                else: skip_reason = "searching API for payload returned a response that is not a list"
-                            
-                            else: skip_reason = f"searching API for payload returned a {status} response"
-                            
-                            if skip_reason:
-                                self.lightbeam.num_skipped += 1
-                                self.lightbeam.increment_status_reason(skip_reason)
-                                break # (out of while loop)
-                        else:
-                            # this could be broken out to a separate function call,
-                            # but not doing so should help keep the critical section small
-                            if self.lightbeam.token_version == curr_token_version:
-                                self.lightbeam.lock.acquire()
-                                self.lightbeam.api.update_oauth()
-                                self.lightbeam.lock.release()
-                            else:
-                                await asyncio.sleep(1)
-                            curr_token_version = int(str(self.lightbeam.token_version))
-                    
+                # we have to get the `id` for a particular resource by first searching for its natural keys
+                async with self.lightbeam.api.client.get(
+                    self.lightbeam.api.get_endpoint_plan(endpoint).url,
+                    params=params,
+                    ssl=self.lightbeam.config["connection"]["verify_ssl"],
+                    headers=await self.lightbeam.api.get_headers()
+                    ) as get_response:
+                    body = await get_response.text()
+                    status = get_response.status
+                    if status!=401:
+                        skip_reason = None
+                        if status in [200, 201]:
+                            j = json.loads(body)
+                            if type(j)==list and len(j)==1:
+                                the_id = j[0]['id']
+                                # now we can delete by `id`
+                                await self.do_delete_id(endpoint, the_id, file_name, line, data_hash)
+                                break
+                                
+                            elif type(j)==list and len(j)==0: skip_reason = "payload not found in API"
+                            elif type(j)==list and len(j)>1: skip_reason = "multiple matching payloads found in API"
+                            else: skip_reason = "searching API for payload returned a response that is not a list"
+                        
+                        else: skip_reason = f"searching API for payload returned a {status} response"
+                        
+                        if skip_reason:
+                            self.lightbeam.num_skipped += 1
+                            self.lightbeam.increment_status_reason(skip_reason)
+                            break # (out of while loop)
+                    else:
+                        # refresh the token (unless another task already did)
+                        await self.lightbeam.api.refresh_oauth(curr_token_version)
+                        curr_token_version = int(str(self.lightbeam.token_version))
+                
             except RuntimeError as e:
                 await asyncio.sleep(1)
             except Exception as e:
@@ -187,18 +234,21 @@ class Deleter:
                 self.logger.error("  (at line {0} of {1}; ID: {2} )".format(line, file_name, id))
                 break
 
-    async def do_delete_id(self, endpoint, id, file_name=None, line=None, data_hash=None):
+    # Deletes a single record by `id`; returns False if (with `not_found_ok`) it wasn't found, otherwise True
+    async def do_delete_id(self, endpoint, id, file_name=None, line=None, data_hash=None, not_found_ok=False):
         curr_token_version = int(str(self.lightbeam.token_version))
         while True: # this is not great practice, but an effective way (along with the `break` below) to achieve a do:while loop
             try:
                 async with self.lightbeam.api.client.delete(
                     util.url_join(self.lightbeam.api.config["data_url"], self.lightbeam.get_namespace_for_endpoint(endpoint), endpoint, id),
                     ssl=self.lightbeam.config["connection"]["verify_ssl"],
-                    headers=self.lightbeam.api.headers
+                    headers=await self.lightbeam.api.get_headers()
                     ) as delete_response:
                     body = await delete_response.text()
                     status = delete_response.status
-                    if status!=401:
+                    if status==404 and not_found_ok:
+                        return False
+                    elif status!=401:
                         self.lightbeam.num_finished += 1
                         self.lightbeam.increment_status_counts(status)
                         if status not in [ 204 ]:
@@ -209,17 +259,11 @@ class Deleter:
                             if self.lightbeam.track_state and data_hash is not None:
                                 # if we're certain delete was successful, remove this
                                 # line of data from internal tracking
-                                del self.hashlog_data[data_hash]
+                                del self.hashlog_data[endpoint][data_hash]
                         break # (out of while loop)
                     else:
-                        # this could be broken out to a separate function call,
-                        # but not doing so should help keep the critical section small
-                        if self.lightbeam.token_version == curr_token_version:
-                            self.lightbeam.lock.acquire()
-                            self.lightbeam.api.update_oauth()
-                            self.lightbeam.lock.release()
-                        else:
-                            await asyncio.sleep(1)
+                        # refresh the token (unless another task already did)
+                        await self.lightbeam.api.refresh_oauth(curr_token_version)
                         curr_token_version = int(str(self.lightbeam.token_version))
             except RuntimeError as e:
                 await asyncio.sleep(1)
@@ -229,3 +273,4 @@ class Deleter:
                 if line and file_name:
                     self.logger.error("  (at line {0} of {1}; ID: {2} )".format(line, file_name, id))
                 break
+        return True
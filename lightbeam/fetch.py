@@ -1,12 +1,21 @@
 import os
+import glob
 import math
 import json
 import asyncio
-from urllib.parse import urlencode
+import functools
+import itertools
+import importlib.util
 from lightbeam import util
+from lightbeam import hashlog
+from lightbeam.writer import EndpointWriter, Compressor
+from lightbeam.splitter import JSONArraySplitter
 
 class Fetcher:
 
+    MAX_PARTITIONS = 200 # (the most the Ed-Fi API allows)
+    CHUNK_SIZE = 65536 # bytes of a response to read at a time, when records are passed straight through
+
     def __init__(self, lightbeam=None):
         self.lightbeam = lightbeam
         self.logger = self.lightbeam.logger
@@ -20,104 +29,605 @@ class Fetcher:
         self.lightbeam.reset_counters()
         self.logger.debug(f"fetching records...")
 
+        # (with a `--query-file`, records are fetched for each query in it; see `get_query_file_records()`)
+        # (internal fetches, like for `truncate`, always get all records)
+        self.queries = self.load_queries() if self.lightbeam.query_file and do_write else None
+        self.incremental = do_write and self.lightbeam.config["fetch"].get("incremental", False)
+        if self.incremental and self.queries is not None:
+            self.logger.critical("`config.fetch.incremental` isn't supported with `--query-file`")
+        # (with a state_dir, progress is saved as the fetch goes, so an interrupted fetch can be `--resume`d)
+        self.checkpoints = do_write and self.lightbeam.track_state and self.queries is None
+        self.load_output_settings()
+        if self.checkpoints:
+            self.load_progress()
+        elif self.lightbeam.resume and do_write:
+            if self.queries is not None:
+                self.logger.critical("`--resume` isn't supported with `--query-file`")
+            self.logger.critical("`--resume` requires a `state_dir`, where the progress of a fetch is saved")
+        if self.incremental:
+            await self.load_change_versions()
+
+        # Without key filtering, records are written exactly as the API returns them, so they needn't be
+        # parsed (and re-serialized); see `read_raw_records()`. (Records fetched for a `--query-file` are
+        # parsed, to de-duplicate them by `id`.)
+        self.pass_through = do_write and self.lightbeam.keep_keys=="*" and self.lightbeam.drop_keys=="" and self.queries is None
+
+        # Pages are requested lazily: at most this many pages are in flight (or waiting for earlier pages
+        # to be written) at once, so memory use stays flat no matter how many records are fetched.
+        self.window = asyncio.Semaphore(self.lightbeam.config["fetch"].get("max_pages_in_flight", 2*self.lightbeam.config["connection"]["pool_size"]))
+        self.max_pages_per_endpoint = self.lightbeam.config["fetch"].get("max_pages_per_endpoint", self.lightbeam.config["connection"]["pool_size"])
+        self.endpoint_windows = {}
+        # (endpoints some of whose pages couldn't be loaded; see `skip_page()`)
+        self.incomplete_endpoints = set()
+
+        pagination = self.lightbeam.config["fetch"]["pagination"]
+        if pagination not in ["auto", "cursor", "offset"]:
+            self.logger.critical("`config.fetch.pagination` must be one of `auto` (default), `cursor`, or `offset`")
+
         tasks = []
-        counter = 0
         limit = self.lightbeam.config["fetch"]["page_size"]
         params = json.loads(self.lightbeam.query)
+        # (the queries of a `--query-file` which apply to each endpoint; queries are checked by their set of
+        # keys, so once per endpoint however many queries there are)
+        self.endpoint_queries = {}
+        queries_by_keys = {}
+        for query in self.queries or []:
+            queries_by_keys.setdefault(frozenset(query.keys()), []).append(query)
+        if self.lightbeam.query != '':
+            self.lightbeam.api.load_swagger_docs()
         for endpoint in self.lightbeam.endpoints:
             
             # test the query for invalid params (otherwise a typo will
             # return _all_ records, which might be bad!)
             if self.lightbeam.query != '':
-                self.lightbeam.api.load_swagger_docs()
                 swagger = self.lightbeam.api.resources_swagger
                 namespace = self.lightbeam.get_namespace_for_endpoint(endpoint)
                 supported_params = swagger.get("paths", {}).get(f"/{namespace}/{endpoint}", {}).get("get", {}).get("parameters", [])
                 supported_param_names = [ x["name"] for x in supported_params if "name" in x.keys() and "in" in x.keys() and x["in"]=="query" ]
+                if self.queries is not None:
+                    self.endpoint_queries[endpoint] = [ query for keys, queries in queries_by_keys.items()
+                        if keys.issubset(set(supported_param_names)) for query in queries ]
+                    num_skipped = len(self.queries) - len(self.endpoint_queries[endpoint])
+                    if num_skipped>0:
+                        self.logger.warn(f"{num_skipped} queries contain keys that are not params for the endpoint {endpoint}... skipping them! (Supported params: {(', '.join(supported_param_names))})")
+                    if len(self.endpoint_queries[endpoint])==0:
+                        del self.endpoint_queries[endpoint]
+                    continue
                 if not set(params.keys()).issubset(set(supported_param_names)):
                     self.logger.warn(f"Query contains keys that are not params for the endpoint {endpoint}... skipping! (Supported params: {(', '.join(supported_param_names))})")
                     continue
             
-            # figure out how many (paginated) requests we must make
-            tasks.append(asyncio.create_task(self.lightbeam.counter.get_record_count(endpoint, params)))
-        
-        if len(tasks) > 0:
-            await self.lightbeam.do_tasks(tasks, counter, log_status_counts=log_status_counts)
+            if self.incremental and self.get_fetched_change_version(endpoint)==self.newest_change_version:
+                self.logger.debug(f"(no changes to {endpoint} since the last fetch)")
+                continue
+
+            if self.checkpoints and self.progress["endpoints"].get(endpoint, {}).get("done", False):
+                self.logger.info(f"(skipping {endpoint}, which was already fetched)")
+                continue
+
+            tasks.append(asyncio.create_task(self.get_endpoint(endpoint, limit, pagination, do_write)))
         
+        if self.queries is not None:
+            await self.get_query_file_records(limit, do_write, log_status_counts)
+        else:
+            # (the client is held open while endpoints are counted, partitioned, and paged through)
+            async with self.lightbeam.open_client():
+                if len(tasks)>0:
+                    await asyncio.wait(tasks)
+                    if log_status_counts:
+                        self.logger.info("  (... status counts: {0}) ".format(str(self.lightbeam.status_counts)))
+
+            # the fetch is complete, so there's nothing to resume (unless some endpoints are incomplete)
+            if self.checkpoints and not self.incomplete_endpoints and os.path.isfile(self.progress_file):
+                os.remove(self.progress_file)
+
+        if self.incomplete_endpoints:
+            self.logger.critical("{0} could not be completely fetched (see above); re-run `fetch`{1} to fetch {2} again".format(
+                ", ".join(sorted(self.incomplete_endpoints)), " --resume" if self.checkpoints else "",
+                "just them" if self.checkpoints else "them"))
+
+    # Fetches an endpoint's records: as soon as its count arrives (while other endpoints are still being
+    # counted or fetched), its pages are requested. Endpoints share `self.window` fairly (see `acquire_window()`).
+    async def get_endpoint(self, endpoint, limit, pagination, do_write):
+        num_records = await self.lightbeam.counter.get_record_count(endpoint, self.get_query_params(endpoint))
+        if num_records is None:
+            self.incomplete_endpoints.add(endpoint)
+            return
+        num_pages = math.ceil(num_records / limit)
+        # (an incremental fetch may still find deletes, even with no new or changed records)
+        if num_pages==0 and not self.incremental: return
+
+        # pick up where an interrupted fetch of this endpoint left off (if its temporary files are still there)
+        writer = self.get_writer(endpoint) if do_write and num_pages>0 else None
+        endpoint_progress = None
+        if self.checkpoints:
+            endpoint_progress = self.progress["endpoints"].get(endpoint, None)
+            if endpoint_progress and not (writer and writer.can_resume(endpoint_progress["streams"] or [])):
+                endpoint_progress = None
+
+        # Where the API supports it (Ed-Fi ODS/API 7.3+), split the endpoint's records into partitions
+        # which are each paged through with a cursor (`pageToken`); deep `offset`s are slow for the API,
+        # and records can be duplicated or missed if they change between requests for different offsets.
+        page_tokens = None
+        if endpoint_progress:
+            # (a resumed fetch must use the same partitions)
+            page_tokens = endpoint_progress["page_tokens"]
+        elif pagination!="offset" and num_pages>0:
+            num_partitions = min(self.lightbeam.config["fetch"].get("partitions", self.lightbeam.config["connection"]["pool_size"]), num_pages, self.MAX_PARTITIONS)
+            page_tokens = await self.get_page_tokens(endpoint, num_partitions)
+            if page_tokens is None:
+                if pagination=="cursor":
+                    self.logger.critical(f"Unable to load partitions for {endpoint}; the API may not support cursor paging (try `config.fetch.pagination: offset`)")
+                self.logger.debug(f"(the API doesn't support cursor paging for {endpoint}; using offset paging instead)")
+
+        # do the requests
+        num_streams = len(page_tokens) if page_tokens is not None else 1
+        streams_progress = [ None ] * num_streams
+        if writer:
+            on_checkpoint = None
+            if self.checkpoints:
+                if endpoint_progress:
+                    self.logger.info(f"resuming fetch of {endpoint}...")
+                    streams_progress = endpoint_progress["streams"] or streams_progress
+                self.progress["endpoints"][endpoint] = {"done": False, "page_tokens": page_tokens, "streams": streams_progress}
+                on_checkpoint = lambda streams: self.save_checkpoint(endpoint, streams)
+            # (records are written in page order - partition by partition, for cursor paging - so output is deterministic)
+            writer.start(num_streams=num_streams, resume_from=streams_progress, on_checkpoint=on_checkpoint)
+        endpoint_tasks = []
+        if self.incremental and self.get_fetched_change_version(endpoint) is not None:
+            endpoint_tasks.append(asyncio.create_task(self.get_deletes(endpoint, limit)))
+        if page_tokens is not None:
+            for partition, page_token in enumerate(page_tokens):
+                # (the checkpoint of each partition is the token for its next page; None once it's done)
+                partition_progress = streams_progress[partition]
+                if partition_progress: page_token = partition_progress["checkpoint"]
+                if not page_token: continue
+                endpoint_tasks.append(asyncio.create_task(self.get_partition_records(endpoint, partition, page_token, limit, writer,
+                    index=partition_progress["pages"] if partition_progress else 0)))
+        else:
+            for p in range(streams_progress[0]["pages"] if streams_progress[0] else 0, num_pages):
+                await self.acquire_window(endpoint)
+                endpoint_tasks.append(asyncio.create_task(self.get_endpoint_records(endpoint, p, limit, writer)))
+        # (the endpoint's file is closed as soon as its pages are done, while other endpoints' pages are fetched)
+        await self.finish_endpoint(endpoint, endpoint_tasks, writer)
+
+    # Waits for a slot in the window of pages in flight, and in the endpoint's own share of it. Waiting
+    # requests get slots in turn (first come, first served), so endpoints' pages are interleaved; and as
+    # no endpoint may hold more than `fetch.max_pages_per_endpoint` slots, a huge endpoint can't crowd
+    # out the rest.
+    async def acquire_window(self, endpoint):
+        if endpoint not in self.endpoint_windows:
+            self.endpoint_windows[endpoint] = asyncio.Semaphore(self.max_pages_per_endpoint)
+        await self.endpoint_windows[endpoint].acquire()
+        await self.window.acquire()
+
+    def release_window(self, endpoint):
+        self.window.release()
+        self.endpoint_windows[endpoint].release()
+
+    # Loads the queries (JSON dictionaries of query params) in a `--query-file`, one per line
+    def load_queries(self):
+        queries = {}
+        try:
+            with open(self.lightbeam.query_file) as file:
+                for i, line in enumerate(file):
+                    if line.strip()=="": continue
+                    query = json.loads(line)
+                    if type(query)!=dict:
+                        raise ValueError(f"line {i+1} is not a JSON dictionary")
+                    # (a query repeated in the file is only fetched once)
+                    queries[json.dumps(query, sort_keys=True)] = query
+        except (OSError, ValueError) as e:
+            self.logger.critical(f"Unable to load queries from `--query-file` {self.lightbeam.query_file} ({str(e)})")
+        if len(queries)==0:
+            self.logger.critical(f"`--query-file` {self.lightbeam.query_file} contains no queries")
+        self.logger.debug(f"loaded {len(queries)} queries from {self.lightbeam.query_file}")
+        return list(queries.values())
+
+    # With a `--query-file`, fetches each endpoint's records for every query in it, in one session: a pool
+    # of workers per endpoint takes queries in turn, and pages through each (with offsets) until a page
+    # isn't full, so no counts are needed. Each endpoint's records are written to a single file (in the
+    # order pages were requested); records returned for more than one query are only written once.
+    async def get_query_file_records(self, limit, do_write, log_status_counts):
+        num_workers = self.lightbeam.config["fetch"].get("max_pages_in_flight", 2*self.lightbeam.config["connection"]["pool_size"])
         tasks = []
-        record_counts = self.lightbeam.results
-        self.lightbeam.results = []
-        for endpoint in self.lightbeam.endpoints:
+        async with self.lightbeam.open_client():
+            for endpoint, endpoint_queries in self.endpoint_queries.items():
+                writer = None
+                if do_write:
+                    writer = self.get_writer(endpoint)
+                    writer.start()
+                queries = iter(endpoint_queries)
+                page_indexes = itertools.count()
+                seen_ids = set()
+                endpoint_tasks = [
+                    asyncio.create_task(self.get_queries_records(endpoint, queries, limit, writer, page_indexes, seen_ids))
+                    for _ in range(min(num_workers, len(endpoint_queries)))
+                ]
+                tasks.append(asyncio.create_task(self.finish_endpoint(endpoint, endpoint_tasks, writer)))
+
+            if len(tasks)>0:
+                await asyncio.wait(tasks)
+                if log_status_counts:
+                    self.logger.info("  (... status counts: {0}) ".format(str(self.lightbeam.status_counts)))
+
+    # Fetches all records of an endpoint for each of `queries` (an iterator shared between workers)
+    async def get_queries_records(self, endpoint, queries, limit, writer, page_indexes, seen_ids):
+        for query in queries:
+            page = 0
+            while True:
+                await self.acquire_window(endpoint)
+                page_params = dict(query, limit=str(limit), offset=str(page*limit))
+                num_records, _ = await self.get_page(endpoint, page_params, writer, 0, next(page_indexes), seen_ids=seen_ids)
+                page += 1
+                if num_records < limit: break
+            self.lightbeam.num_finished += 1
+
+    # Waits for all page requests of an endpoint, then flushes and closes its file
+    async def finish_endpoint(self, endpoint, tasks, writer=None):
+        if len(tasks)>0: await asyncio.wait(tasks)
+        if writer:
             try:
-                num_records = [x for x in record_counts if x[0] == endpoint][0][1]
-            except IndexError:
-                continue
-            num_pages = math.ceil(num_records / limit)
-            
-            # do the requests
-            file_handle = None
-            if do_write and num_records>0:
-                file_handle = open(os.path.join(self.lightbeam.config["data_dir"], endpoint + ".jsonl"), "w")
-            for p in range(0, num_pages):
-                counter += 1
-                tasks.append(asyncio.create_task(self.get_endpoint_records(endpoint, limit, p*limit, file_handle)))
-
-        if len(tasks)>0:
-            await self.lightbeam.do_tasks(tasks, counter, log_status_counts=log_status_counts)
-    
-    # Fetches records for a specific endpoint
-    async def get_endpoint_records(self, endpoint, limit, offset, file_handle=None):
+                await writer.close()
+            except Exception as e:
+                self.logger.critical(f"Unable to write records for {endpoint} to {writer.file_name} ({str(e)})")
+            if not self.incremental: self.remove_other_output_files(endpoint, writer)
+        # (an incomplete endpoint is neither marked done - so `--resume` fetches it again, from scratch - nor
+        # has its change version advanced - so the next incremental fetch fetches the same changes again)
+        if endpoint in self.incomplete_endpoints:
+            if self.checkpoints:
+                self.progress["endpoints"].pop(endpoint, None)
+                hashlog.save(self.progress_file, self.progress)
+            return
+        if self.checkpoints:
+            self.progress["endpoints"][endpoint] = {"done": True}
+            hashlog.save(self.progress_file, self.progress)
+        if self.incremental:
+            # (saved after each endpoint, so an interrupted fetch doesn't re-fetch endpoints it finished)
+            self.change_versions[endpoint] = self.newest_change_version
+            hashlog.save(self.change_versions_file, self.all_change_versions)
+
+    # Loads the progress of an interrupted fetch (for `--resume`), or starts anew. Progress is kept per
+    # endpoint: whether it's done, its partitions' page tokens (for cursor paging), and the writer's
+    # progress for each partition (see `EndpointWriter`)
+    def load_progress(self):
+        self.progress_file = os.path.join(self.lightbeam.config["state_dir"], "fetch-progress.dat")
+        # (a fetch can only be resumed with the same settings)
+        settings = {
+            "data_dir": os.path.abspath(self.lightbeam.config["data_dir"]),
+            "query": self.lightbeam.query,
+            "keep_keys": self.lightbeam.keep_keys,
+            "drop_keys": self.lightbeam.drop_keys,
+            "page_size": self.lightbeam.config["fetch"]["page_size"],
+            "incremental": self.incremental,
+            "compression": self.compression,
+            "shard_records": self.shard_records,
+            "shard_bytes": self.shard_bytes,
+        }
+        self.progress = {}
+        if self.lightbeam.resume:
+            self.progress = hashlog.load(self.progress_file)
+            if not self.progress:
+                self.logger.warning("there's no interrupted fetch to `--resume`; fetching everything")
+            elif self.progress["settings"]!=settings:
+                self.logger.critical("can't `--resume` a fetch with different settings (`data_dir`, `--query`, `--keep-keys`, `--drop-keys`, or `fetch.page_size`, `fetch.incremental`, `fetch.compression`, `fetch.shard_records`, or `fetch.shard_bytes`)")
+        if not self.progress:
+            self.progress = {"settings": settings, "endpoints": {}}
+            hashlog.save(self.progress_file, self.progress)
+
+    def save_checkpoint(self, endpoint, streams):
+        self.progress["endpoints"][endpoint]["streams"] = streams
+        hashlog.save(self.progress_file, self.progress)
+
+    # For an incremental fetch, loads the newest change version already fetched for each endpoint (from the
+    # state_dir) and the API's current newest change version; only changes in between are fetched.
+    async def load_change_versions(self):
+        if not self.lightbeam.track_state:
+            self.logger.critical("`config.fetch.incremental` requires a `state_dir`, in which to save the change versions fetched so far")
+        self.change_versions_file = os.path.join(self.lightbeam.config["state_dir"], "fetch-change-versions.dat")
+        self.all_change_versions = hashlog.load(self.change_versions_file)
+        # (the data_dir and query are part of the key, since each incremental fetch builds on the files of the previous one)
+        key = (os.path.abspath(self.lightbeam.config["data_dir"]), self.lightbeam.query)
+        self.change_versions = self.all_change_versions.setdefault(key, {})
+
+        # (a resumed fetch must fetch the same changes)
+        if self.checkpoints and "newest_change_version" in self.progress:
+            self.newest_change_version = self.progress["newest_change_version"]
+            return
+
         curr_token_version = int(str(self.lightbeam.token_version))
-        while True: # this is not great practice, but an effective way (along with the `break` below) to achieve a do:while loop
+        async with self.lightbeam.open_client():
+            while True: # (until a `return` below)
+                try:
+                    async with self.lightbeam.api.client.get(
+                        util.url_join(self.lightbeam.api.config["change_queries_url"], "availableChangeVersions"),
+                        ssl=self.lightbeam.config["connection"]["verify_ssl"],
+                        headers=await self.lightbeam.api.get_headers()
+                        ) as response:
+                        body = await response.text()
+                        status = str(response.status)
+                        if status=='401':
+                            # refresh the token (unless another task already did)
+                            await self.lightbeam.api.refresh_oauth(curr_token_version)
+                            curr_token_version = int(str(self.lightbeam.token_version))
+                            continue
+                        if status!='200':
+                            self.logger.critical(f"Unable to load available change versions ({status} API response); the API may not support Change Queries")
+                        self.newest_change_version = int(json.loads(body)["newestChangeVersion"])
+                        if self.checkpoints:
+                            self.progress["newest_change_version"] = self.newest_change_version
+                            hashlog.save(self.progress_file, self.progress)
+                        return
+                except RuntimeError as e:
+                    await asyncio.sleep(1)
+                except Exception as e:
+                    self.logger.critical(f"Unable to load available change versions from API ({str(e)})... terminating. Check API connectivity.")
+
+    # Returns the newest change version fetched for an endpoint by a previous incremental fetch, if any
+    def get_fetched_change_version(self, endpoint):
+        return self.change_versions.get(endpoint, None)
+
+    # Returns the query params for requests to an endpoint (including, for an incremental fetch, the
+    # window of change versions to fetch)
+    def get_query_params(self, endpoint):
+        params = json.loads(self.lightbeam.query)
+        if self.incremental:
+            fetched_change_version = self.get_fetched_change_version(endpoint)
+            if fetched_change_version is not None:
+                params["minChangeVersion"] = fetched_change_version + 1
+            params["maxChangeVersion"] = self.newest_change_version
+        return params
+
+    # Loads (and checks) the settings for how fetched records are written: optional compression, and
+    # optionally splitting each endpoint's records into shards (see `EndpointWriter`)
+    def load_output_settings(self):
+        self.compression = self.lightbeam.config["fetch"].get("compression", "none")
+        if self.compression not in ["none", "gzip", "zstd"]:
+            self.logger.critical("`config.fetch.compression` must be one of `none` (default), `gzip`, or `zstd`")
+        if self.compression=="none": self.compression = None
+        # (checked up front, so a fetch doesn't fail once under way; `EndpointWriter` imports it when used)
+        if self.compression=="zstd" and importlib.util.find_spec("zstandard") is None:
+            self.logger.critical("`config.fetch.compression: zstd` requires the `zstandard` package (`pip install lightbeam[zstd]`)")
+        self.shard_records = self.lightbeam.config["fetch"].get("shard_records", None)
+        self.shard_bytes = self.lightbeam.config["fetch"].get("shard_bytes", None)
+        for key in ["shard_records", "shard_bytes"]:
+            value = getattr(self, key)
+            if value is not None and (not isinstance(value, int) or value<=0):
+                self.logger.critical(f"`config.fetch.{key}` must be a positive integer")
+
+    def get_writer(self, endpoint, deletes=False):
+        return EndpointWriter(self.get_output_file(endpoint, deletes), compression=self.compression,
+            # (deletes are few, so they aren't sharded)
+            shard_records=None if deletes else self.shard_records, shard_bytes=None if deletes else self.shard_bytes)
+
+    # Returns the file to write an endpoint's records to (before any compression extension, or shard number);
+    # an incremental fetch writes a new file of changes in the endpoint's directory each time, named so they
+    # sort in the order they were fetched. Sharded records are written to the endpoint's directory too.
+    def get_output_file(self, endpoint, deletes=False):
+        if not self.incremental:
+            if not (self.shard_records or self.shard_bytes):
+                return os.path.join(self.lightbeam.config["data_dir"], endpoint + ".jsonl")
+            directory = os.path.join(self.lightbeam.config["data_dir"], endpoint)
+            os.makedirs(directory, exist_ok=True)
+            return os.path.join(directory, "part.jsonl")
+        directory = os.path.join(self.lightbeam.config["data_dir"], endpoint + (".deletes" if deletes else ""))
+        os.makedirs(directory, exist_ok=True)
+        min_change_version = (self.get_fetched_change_version(endpoint) or -1) + 1
+        return os.path.join(directory, f"{min_change_version:012d}-{self.newest_change_version:012d}.jsonl")
+
+    # A (non-incremental) fetch replaces an endpoint's records, so removes any written in another format
+    # (compressed or not, sharded or not) by a previous fetch
+    def remove_other_output_files(self, endpoint, writer):
+        data_dir = self.lightbeam.config["data_dir"]
+        shards_glob = os.path.join(glob.escape(os.path.join(data_dir, endpoint)), "part-[0-9]*.jsonl")
+        for extension in Compressor.EXTENSIONS.values():
+            for file_name in [ os.path.join(data_dir, endpoint + ".jsonl" + extension) ] + glob.glob(shards_glob + extension):
+                if os.path.isfile(file_name) and file_name not in writer.output_file_names:
+                    os.remove(file_name)
+        directory = os.path.join(data_dir, endpoint)
+        if os.path.isdir(directory) and len(os.listdir(directory))==0: os.rmdir(directory)
+
+    # Fetches the records deleted from an endpoint (in the window of change versions of an incremental fetch)
+    # and writes them to (for example) `schools.deletes/`, which isn't treated as data to `send`
+    async def get_deletes(self, endpoint, limit):
+        writer = self.get_writer(endpoint, deletes=True)
+        writer.start()
+        page = 0
+        num_deletes = 0
+        while True:
+            await self.acquire_window(endpoint)
+            num_records, _ = await self.get_page(endpoint, {"limit": str(limit), "offset": str(page*limit)}, writer, 0, page, deletes=True)
+            num_deletes += num_records
+            page += 1
+            if num_records < limit: break
+        await writer.close()
+        # (don't leave empty files behind when nothing was deleted)
+        if num_deletes==0:
+            file_name = writer.get_output_file_name()
+            os.remove(file_name)
+            if len(os.listdir(os.path.dirname(file_name)))==0: os.rmdir(os.path.dirname(file_name))
+
+    # Returns page tokens for (up to) `number` partitions of an endpoint's records, or None if the API
+    # doesn't support partitions
+    async def get_page_tokens(self, endpoint, number):
+        curr_token_version = int(str(self.lightbeam.token_version))
+        while True: # (until a `return` below)
             try:
-                # construct the URL query params:
-                params = json.loads(self.lightbeam.query)
-                params.update({"limit": str(limit), "offset": str(offset)})
+                params = self.get_query_params(endpoint)
+                params.update({"number": str(number)})
+                async with self.lightbeam.api.client.get(
+                    util.url_join(self.lightbeam.api.config["data_url"], self.lightbeam.get_namespace_for_endpoint(endpoint), endpoint, "partitions"),
+                    params={k: str(v) for k,v in params.items()}, # (not `urlencode()`d, since aiohttp would re-encode page tokens' `=` padding)
+                    ssl=self.lightbeam.config["connection"]["verify_ssl"],
+                    headers=await self.lightbeam.api.get_headers()
+                    ) as response:
+                    body = await response.text()
+                    status = str(response.status)
+                    if status=='401':
+                        # refresh the token (unless another task already did)
+                        await self.lightbeam.api.refresh_oauth(curr_token_version)
+                        curr_token_version = int(str(self.lightbeam.token_version))
+                        continue
+                    if status!='200': return None
+                    page_tokens = json.loads(body).get("pageTokens", None)
+                    if type(page_tokens)!=list: return None
+                    return page_tokens
+            except RuntimeError as e:
+                await asyncio.sleep(1)
+            except Exception as e:
+                return None
 
-                # send GET request
+    # Fetches all records in one partition of an endpoint, following each page's `Next-Page-Token`
+    async def get_partition_records(self, endpoint, partition, page_token, limit, writer=None, index=0):
+        while page_token:
+            await self.acquire_window(endpoint)
+            _, page_token = await self.get_page(endpoint, {"pageToken": page_token, "pageSize": str(limit)}, writer, partition, index)
+            index += 1
+        self.lightbeam.num_finished += 1
+
+    # Returns a page of an endpoint's records, as dicts (or None, if they couldn't be loaded). This is for
+    # internal use (like by `truncate` and `delete`) and, unlike `get_records()`, may be called for several
+    # endpoints at once.
+    async def get_records_page(self, endpoint, offset, limit):
+        curr_token_version = int(str(self.lightbeam.token_version))
+        while True: # (until a `return` below)
+            try:
                 async with self.lightbeam.api.client.get(
                     util.url_join(self.lightbeam.api.config["data_url"], self.lightbeam.get_namespace_for_endpoint(endpoint), endpoint),
-                    params=urlencode(params),
+                    params={"offset": str(offset), "limit": str(limit)},
                     ssl=self.lightbeam.config["connection"]["verify_ssl"],
-                    headers=self.lightbeam.api.headers
+                    headers=await self.lightbeam.api.get_headers()
                     ) as response:
                     body = await response.text()
                     status = str(response.status)
                     if status=='401':
-                        # this could be broken out to a separate function call,
-                        # but not doing so should help keep the critical section small
-                        if self.lightbeam.token_version == curr_token_version:
-                            self.lightbeam.lock.acquire()
-                            self.lightbeam.api.update_oauth()
-                            self.lightbeam.lock.release()
-                        else:
-                            await asyncio.sleep(1)
+                        # refresh the token (unless another task already did)
+                        await self.lightbeam.api.refresh_oauth(curr_token_version)
                         curr_token_version = int(str(self.lightbeam.token_version))
+                        continue
+                    values = json.loads(body) if status=='200' else None
+                    if type(values)!=list:
+                        self.logger.warn(f"Unable to load records for {endpoint}... {status} API response.")
+                        self.lightbeam.num_errors += 1
+                        return None
+                    return values
+            except RuntimeError as e:
+                await asyncio.sleep(1)
+            except Exception as e:
+                self.logger.warn(f"Unable to load records for {endpoint}... {e}")
+                self.lightbeam.num_errors += 1
+                return None
+
+    # Fetches the `page`th page of records for a specific endpoint
+    async def get_endpoint_records(self, endpoint, page, limit, writer=None):
+        await self.get_page(endpoint, {"limit": str(limit), "offset": str(page*limit)}, writer, 0, page)
+        self.lightbeam.num_finished += 1
+
+    # Fetches a single page of records (or, with `deletes=True`, deleted records) per `page_params`, which
+    # is page `index` of `stream` for the writer; returns the number of records and the token for the next
+    # page, if any. (Releases its slot in the window - see `acquire_window()` - when done.) Records whose
+    # `id` is in `seen_ids` (if given) are skipped, and the others' are added to it. A page which can't be
+    # loaded within `connection.num_retries` attempts is skipped (see `skip_page()`).
+    async def get_page(self, endpoint, page_params, writer=None, stream=0, index=0, deletes=False, seen_ids=None):
+        curr_token_version = int(str(self.lightbeam.token_version))
+        num_attempts = 0
+        while True: # this is not great practice, but an effective way (along with the `return` below) to achieve a do:while loop
+            try:
+                # construct the URL query params:
+                params = self.get_query_params(endpoint)
+                params.update(page_params)
+                url = util.url_join(self.lightbeam.api.config["data_url"], self.lightbeam.get_namespace_for_endpoint(endpoint), endpoint)
+                if deletes:
+                    url = util.url_join(url, "deletes")
+
+                # send GET request
+                async with self.lightbeam.api.client.get(
+                    url,
+                    params={k: str(v) for k,v in params.items()},
+                    ssl=self.lightbeam.config["connection"]["verify_ssl"],
+                    headers=await self.lightbeam.api.get_headers()
+                    ) as response:
+                    status = str(response.status)
+                    if status=='401':
+                        # refresh the token (unless another task already did)
+                        await self.lightbeam.api.refresh_oauth(curr_token_version)
+                        curr_token_version = int(str(self.lightbeam.token_version))
+                        continue
                     elif status not in ['200', '201']:
                         self.logger.warn(f"Unable to load records for {endpoint}... {status} API response.")
+                        # (statuses in `connection.retry_statuses` were already retried by the client)
+                        if response.status in self.lightbeam.config["connection"]["retry_statuses"]:
+                            return self.skip_page(endpoint, writer, stream, index)
                     else:
-                        if response.content_type == "application/json":
+                        if response.content_type == "application/json" and writer and (self.pass_through or deletes):
+                            lines = await self.read_raw_records(response)
+                            if lines is None:
+                                self.logger.warn(f"Unable to load records for {endpoint}... API JSON response was not a list of records.")
+                            else:
+                                if not deletes: self.lightbeam.increment_status_counts(status, len(lines))
+                                next_page_token = response.headers.get("Next-Page-Token", None) if len(lines)>0 else None
+                                writer.write(stream, index, b"".join(lines), on_written=functools.partial(self.release_window, endpoint), checkpoint=next_page_token)
+                                return (len(lines), next_page_token)
+                        elif response.content_type == "application/json":
+                            body = await response.text()
                             values = json.loads(body)
                             if type(values) != list:
                                 self.logger.warn(f"Unable to load records for {endpoint}... API JSON response was not a list of records.")
                             else:
-                                payload_keys = list(values[0].keys())
-                                final_keys = util.apply_selections(payload_keys, self.lightbeam.keep_keys, self.lightbeam.drop_keys)
-                                do_key_filtering = len(payload_keys) != len(final_keys)
+                                lines = []
+                                do_key_filtering = False
+                                if len(values)>0 and not deletes:
+                                    payload_keys = list(values[0].keys())
+                                    final_keys = util.apply_selections(payload_keys, self.lightbeam.keep_keys, self.lightbeam.drop_keys)
+                                    do_key_filtering = len(payload_keys) != len(final_keys)
 
                                 for v in values:
+                                    if seen_ids is not None and v.get("id", None) is not None:
+                                        if v["id"] in seen_ids: continue
+                                        seen_ids.add(v["id"])
                                     if do_key_filtering: row = {k: v.get(k, None) for k in final_keys} #v.get() to account for missing keys
                                     else: row = v
-                                    if file_handle: file_handle.write(json.dumps(row)+"\n")
+                                    if writer: lines.append(json.dumps(row)+"\n")
                                     else: self.lightbeam.results.append(row)
-                                    self.lightbeam.increment_status_counts(status)
-                                break
+                                    if not deletes: self.lightbeam.increment_status_counts(status)
+                                # (even an empty page is passed to the writer, so later pages aren't held waiting for it)
+                                next_page_token = response.headers.get("Next-Page-Token", None) if len(values)>0 else None
+                                if writer: writer.write(stream, index, "".join(lines).encode("utf-8"), on_written=functools.partial(self.release_window, endpoint), checkpoint=next_page_token)
+                                else: self.release_window(endpoint)
+                                return (len(values), next_page_token)
                         else:
                             self.logger.warn(f"Unable to load records for {endpoint}... API response was not JSON.")
+                num_attempts += 1
+                if num_attempts>=self.lightbeam.config["connection"]["num_retries"]:
+                    return self.skip_page(endpoint, writer, stream, index)
 
             except RuntimeError as e:
                 await asyncio.sleep(1)
             except Exception as e:
                 self.logger.critical(f"Unable to load records for {endpoint} from API... terminating. Check API connectivity.")
-        
-        self.lightbeam.num_finished += 1
\ No newline at end of file
+
+    # Gives up on a page which couldn't be loaded: counts an error, and marks the endpoint as incomplete
+    # (see `finish_endpoint()`). An empty page is passed to the writer in its place, so later pages aren't
+    # held waiting for it (and its slot in the window is released). With cursor paging, the rest of the page's
+    # partition is skipped too, since there's no token for its next page.
+    def skip_page(self, endpoint, writer, stream, index):
+        self.logger.warn(f"... giving up on a page of {endpoint}.")
+        self.lightbeam.num_errors += 1
+        self.incomplete_endpoints.add(endpoint)
+        if writer: writer.write(stream, index, b"", on_written=functools.partial(self.release_window, endpoint), checkpoint=None)
+        else: self.release_window(endpoint)
+        return (0, None)
+
+    # Reads the records in a response as they arrive, returning the (bytes of the) JSONL line for each,
+    # or None if the response isn't a JSON list of records
+    async def read_raw_records(self, response):
+        splitter = JSONArraySplitter()
+        lines = []
+        try:
+            async for chunk in response.content.iter_chunked(self.CHUNK_SIZE):
+                for record in splitter.feed(chunk):
+                    lines.append(record + b"\n")
+            splitter.close()
+        except ValueError as e:
+            return None
+        return lines
\ No newline at end of file
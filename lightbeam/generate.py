@@ -0,0 +1,386 @@
+import os
+import json
+import time
+import zlib
+import random
+import asyncio
+import datetime
+import functools
+from lightbeam import util
+
+
+# Generates synthetic payloads for (selected) endpoints from the API's Swagger, for load-testing an Ed-Fi
+# API (and lightbeam) with realistic volumes of data without using real student data.
+#
+# Payloads are valid against the Swagger: required properties are always present (optional ones, with a
+# probability of `generate.optional`), strings respect their `maxLength`, dates are dates, and so on.
+# Descriptor values are drawn from those in the API (as cached by `EdFiAPI.load_descriptors_values()`).
+# References resolve: endpoints referenced (as part of the identity) by selected endpoints are generated
+# too, and each reference is to a record which is generated.
+#
+# To make this possible without keeping every generated record in memory, the identity (natural key) of
+# each record is a function of only its index (and `generate.seed`); see `get_identity()`. So a reference
+# to a record of another endpoint is made by picking an index of that endpoint and computing its identity.
+# Records are written (one at a time) to `{data_dir}/{endpoint}.jsonl`.
+class Generator:
+
+    MASK = 2**64 - 1
+    DATES_START = datetime.date(2015, 1, 1)
+    DATES_SPAN = 3650 # days
+    MAX_ARRAY_ITEMS = 3
+    LOG_EVERY = 100000 # records
+    SKIP_PROPERTIES = ["id", "link"]
+    WORDS = ["Alder", "Birch", "Cedar", "Dogwood", "Elm", "Fir", "Ginkgo", "Hazel", "Ivy", "Juniper", "Kapok",
+        "Linden", "Maple", "Nutmeg", "Oak", "Pine", "Quince", "Redwood", "Spruce", "Tamarack", "Upas", "Willow"]
+
+    def __init__(self, lightbeam=None):
+        self.lightbeam = lightbeam
+        self.logger = self.lightbeam.logger
+        self.endpoints = []
+        self.endpoint = None    # the endpoint being generated
+        self.counts = {}        # endpoint -> number of records to generate
+        self.components = {}    # endpoint -> identity components (see `get_identity_components()`)
+        self.warnings = set()
+
+    def generate(self):
+        api = self.lightbeam.api
+        api.load_swagger_docs()
+        config = self.lightbeam.config["generate"]
+        self.seed = int(config["seed"])
+        self.optional = float(config["optional"])
+        self.swagger = api.resources_swagger
+
+        selected = [ endpoint for endpoint in self.lightbeam.endpoints if not endpoint.endswith("Descriptors") ]
+        if len(selected)<len(self.lightbeam.endpoints):
+            self.logger.info("(descriptors are not generated; descriptor values are drawn from those in the API)")
+        if not selected:
+            self.logger.critical("no (non-descriptor) endpoints selected to generate")
+        self.endpoints = self.get_endpoints_to_generate(selected)
+
+        for endpoint in self.endpoints:
+            file_name = os.path.join(self.lightbeam.config["data_dir"], f"{endpoint}.jsonl")
+            if os.path.isfile(file_name) and not self.lightbeam.force:
+                self.logger.critical(f"The file `{file_name}` already exists; to re-generate it, please first manually delete it (or use `--force`).")
+            self.counts[endpoint] = int((config["counts"] or {}).get(endpoint, config["records"]))
+
+        asyncio.run(api.load_descriptors_values(self.endpoints))
+
+        # (in dependency-order, so the number of records of each referenced endpoint is known)
+        for endpoint in self.endpoints:
+            self.components[endpoint] = self.get_identity_components(endpoint)
+        for endpoint in self.endpoints:
+            self.generate_endpoint(endpoint)
+
+    # Returns `endpoints`, plus any endpoints they (recursively) require references to, in dependency-order
+    def get_endpoints_to_generate(self, endpoints):
+        to_generate = set(endpoints)
+        queue = list(endpoints)
+        while queue:
+            endpoint = queue.pop()
+            schema = self.get_endpoint_schema(endpoint)
+            for prop in schema.get("required", []):
+                if not prop.endswith("Reference") or "$ref" not in schema["properties"][prop]: continue
+                targets = self.get_reference_targets(schema["properties"][prop]["$ref"])
+                if targets and not to_generate.intersection(targets):
+                    self.logger.info(f"(also generating {targets[0]}, which {endpoint} references)")
+                    to_generate.add(targets[0])
+                    queue.append(targets[0])
+        return [ endpoint for endpoint in self.lightbeam.all_endpoints if endpoint in to_generate ]
+
+    def get_endpoint_schema(self, endpoint):
+        namespace = self.lightbeam.get_namespace_for_endpoint(endpoint)
+        return util.resolve_swagger_ref(self.swagger, util.get_swagger_ref_for_endpoint(namespace, self.swagger, endpoint))
+
+    # Returns the endpoints a reference (like `#/definitions/edFi_schoolReference`) can be to
+    @functools.lru_cache(maxsize=None)
+    def get_reference_targets(self, ref):
+        endpoint = util.resolve_reference_to_endpoint(ref.split("/")[-1].split("_", 1)[-1])
+        targets = util.EDFI_GENERICS_TO_RESOURCES_MAPPING.get(endpoint, [endpoint])
+        return [ target for target in targets if target in self.lightbeam.all_endpoints ]
+
+    # Returns the (required) properties of a reference, like ["schoolId"] for `#/definitions/edFi_schoolReference`
+    @functools.lru_cache(maxsize=None)
+    def get_reference_properties(self, ref):
+        schema = util.resolve_swagger_ref(self.swagger, ref)
+        return [ prop for prop in schema.get("required", []) if prop not in self.SKIP_PROPERTIES ]
+
+    # Returns the components of an endpoint's identity, in the order they're derived from a record's index
+    # (see `get_identity()`). Most take one of a fixed number (their `radix`) of values: references (to one
+    # of the records of the referenced endpoints), descriptors, dates, times, and booleans. A reference whose
+    # properties are all determined by other references (like the `schoolReference` of a `courseOffering`,
+    # whose `sessionReference` also contains the `schoolId`) is `derived` from them instead. A string or
+    # integer property, if any, is the `carrier`, which takes what's left of the index.
+    def get_identity_components(self, endpoint):
+        schema = self.get_endpoint_schema(endpoint)
+        references = []
+        components = []
+        scalars = []
+        for prop, prop_schema in schema["properties"].items():
+            if prop.endswith("Reference") and prop in schema.get("required", []) and "$ref" in prop_schema:
+                targets = [ target for target in self.get_reference_targets(prop_schema["$ref"]) if target in self.counts ]
+                references.append({"type": "reference", "property": prop, "targets": targets,
+                    "properties": self.get_reference_properties(prop_schema["$ref"]),
+                    "radix": sum(self.counts[target] for target in targets)})
+            elif prop_schema.get("x-Ed-Fi-isIdentity", False) and prop_schema.get("type", None)!="array":
+                scalars.append((prop, prop_schema))
+
+        # (references with the most properties first, so others can be derived from them)
+        determined = set()
+        for reference in sorted(references, key=lambda r: -len(r["properties"])):
+            if determined.issuperset(reference["properties"]):
+                reference["type"] = "derived"
+            elif determined.intersection(reference["properties"]):
+                self.warn(f"references of {endpoint} overlap only partly, so {reference['property']} may not match the other references")
+            determined.update(reference["properties"])
+            components.append(reference)
+
+        carrier = None
+        for prop, prop_schema in scalars:
+            component = {"type": "scalar", "property": prop, "schema": prop_schema}
+            format = prop_schema.get("format", None)
+            if prop.endswith("Descriptor"):
+                component.update({"type": "descriptor", "values": self.get_descriptor_values(prop)})
+                component["radix"] = len(component["values"])
+            elif format in ["date", "date-time"]: component.update({"type": "date", "radix": self.DATES_SPAN})
+            elif format=="time": component.update({"type": "time", "radix": 24 * 60})
+            elif prop_schema.get("type", None)=="boolean": component.update({"type": "boolean", "radix": 2})
+            elif carrier is None or self.get_carrier_capacity(endpoint, component) > self.get_carrier_capacity(endpoint, carrier):
+                carrier = component
+                continue
+            components.append(component)
+        # (any other string or integer properties of the identity are just random)
+        for prop, prop_schema in scalars:
+            if carrier is not None and prop!=carrier["property"] and not any(c["property"]==prop for c in components):
+                components.append({"type": "scalar", "property": prop, "schema": prop_schema})
+        if carrier is not None:
+            carrier["type"] = "carrier"
+            components.append(carrier)
+
+        # make sure the identities of all the records can be distinct
+        capacity = self.get_carrier_capacity(endpoint, carrier) if carrier else 1
+        for component in components:
+            if "radix" in component and component["type"]!="derived": capacity *= component["radix"]
+        if capacity==0:
+            self.warn(f"{endpoint} has no possible identities (is a descriptor it requires empty?), so none will be generated")
+            self.counts[endpoint] = 0
+        elif self.counts[endpoint] > capacity:
+            self.warn(f"only {capacity} distinct {endpoint} can be generated (with the number of records it references)")
+            self.counts[endpoint] = capacity
+        return components
+
+    # Returns the number of distinct values a carrier property can take
+    def get_carrier_capacity(self, endpoint, component):
+        if component["schema"].get("type", "string")=="string":
+            return 10**min(component["schema"].get("maxLength", 18), 18)
+        return self.get_integer_range(endpoint)[1]
+
+    # Returns the first value, and the number of values, of integer identities of an endpoint; each endpoint
+    # gets a different range (since the IDs of schools, local education agencies, etc. must be distinct)
+    def get_integer_range(self, endpoint):
+        size = (2**31 - 1) // (len(self.endpoints) + 1)
+        return (self.endpoints.index(endpoint) + 1) * size, size - 1
+
+    # Returns a (deterministic, well-distributed) 64-bit hash of the seed and integer `values`
+    def mix(self, *values):
+        hash = self.seed & self.MASK
+        for value in values:
+            # (the SplitMix64 finalizer)
+            hash = (hash + 0x9E3779B97F4A7C15 + value) & self.MASK
+            hash = ((hash ^ (hash >> 30)) * 0xBF58476D1CE4E5B9) & self.MASK
+            hash = ((hash ^ (hash >> 27)) * 0x94D049BB133111EB) & self.MASK
+            hash = hash ^ (hash >> 31)
+        return hash
+
+    # Returns the identity properties of record `index` of an endpoint (as a dictionary of property -> value,
+    # with references as dictionaries), and its (flattened) identity values, like `{"schoolId": 255901001}`.
+    #
+    # The index is split into a digit for each component of the identity (`get_identity_components()`),
+    # like a number in a mixed-radix system: the first digit is `index % radix` of the first component, the
+    # next is `(index // radix) % radix2` of the second, and so on, with the carrier taking what's left. So
+    # different indexes get different identities. (Each digit is also offset by a hash of the digits before
+    # it, so, for example, a record's references aren't all to the first records of other endpoints.)
+    @functools.lru_cache(maxsize=100000)
+    def get_identity(self, endpoint, index):
+        values = {}
+        flat = {}
+        digits = []
+        remainder = index
+        endpoint_hash = zlib.crc32(endpoint.encode())
+        for component in self.components[endpoint]:
+            prop = component["property"]
+            if component["type"]=="derived":
+                values[prop] = { p: flat[p] for p in component["properties"] }
+                continue
+            if component["type"]=="carrier":
+                if component["schema"].get("type", "string")=="string":
+                    values[prop] = str(remainder).zfill(min(component["schema"].get("maxLength", 10), 10))
+                else:
+                    values[prop] = self.get_integer_range(endpoint)[0] + remainder
+                flat[prop] = values[prop]
+                continue
+            if component["type"]=="scalar":
+                values[prop] = self.generate_scalar(prop, component["schema"], random.Random(self.mix(endpoint_hash, index, len(digits))))
+                flat[prop] = values[prop]
+                continue
+            radix = component["radix"]
+            digit = (remainder + self.mix(endpoint_hash, len(digits), *digits)) % radix
+            remainder //= radix
+            digits.append(digit)
+            if component["type"]=="reference":
+                target, target_index = self.locate(component["targets"], digit)
+                values[prop] = self.resolve_reference(component["properties"], target, self.get_identity(target, target_index)[1])
+                flat.update(values[prop])
+                continue
+            if component["type"]=="descriptor": values[prop] = component["values"][digit]
+            elif component["type"]=="date": values[prop] = self.format_date(digit, component["schema"])
+            elif component["type"]=="time": values[prop] = f"{digit // 60:02d}:{digit % 60:02d}:00"
+            elif component["type"]=="boolean": values[prop] = digit==1
+            flat[prop] = values[prop]
+        return values, flat
+
+    # Returns (target endpoint, index of record in it) of the `number`th record of several endpoints
+    def locate(self, targets, number):
+        for target in targets:
+            if number < self.counts[target]: return target, number
+            number -= self.counts[target]
+
+    # Returns the value of a reference (with `properties`) to a record of `target` with identity `flat`
+    def resolve_reference(self, properties, target, flat):
+        reference = {}
+        generic_properties = util.EDFI_GENERIC_REFS_TO_PROPERTIES_MAPPING
+        for prop in properties:
+            if prop in flat:
+                reference[prop] = flat[prop]
+            elif generic_properties.get(prop, {}).get(target, None) in flat:
+                reference[prop] = flat[generic_properties[prop][target]]
+            else:
+                self.warn(f"could not match `{prop}` of a reference to the identity of {target}; references to it may not resolve")
+                reference[prop] = None
+        return reference
+
+    def format_date(self, days, schema):
+        date = (self.DATES_START + datetime.timedelta(days=days)).isoformat()
+        return date + "T00:00:00Z" if schema.get("format", None)=="date-time" else date
+
+    # Returns the (sorted) descriptor values which a property (like `entryGradeLevelDescriptor`) can take
+    @functools.lru_cache(maxsize=None)
+    def get_descriptor_values(self, prop):
+        api = self.lightbeam.api
+        # (prefer the most specific descriptor, like `gradeLevelDescriptors` over `levelDescriptors`)
+        descriptors = sorted(( descriptor for descriptor in api.descriptor_values.keys()
+            if api.descriptor_matches_property(descriptor, prop) ), key=len, reverse=True)
+        if not descriptors or not api.descriptor_values[descriptors[0]]:
+            self.warn(f"no descriptor values found for `{prop}`")
+            return []
+        return sorted(api.descriptor_values[descriptors[0]].keys())
+
+    def warn(self, message):
+        if message not in self.warnings:
+            self.warnings.add(message)
+            self.logger.warning(message)
+
+    # Writes out the records of an endpoint, to `{data_dir}/{endpoint}.jsonl`
+    def generate_endpoint(self, endpoint):
+        file_name = os.path.join(self.lightbeam.config["data_dir"], f"{endpoint}.jsonl")
+        self.endpoint = endpoint
+        count = self.counts[endpoint]
+        schema = self.get_endpoint_schema(endpoint)
+        # (non-identity values come from one random sequence per endpoint, so they're reproducible too)
+        rand = random.Random(self.mix(zlib.crc32(endpoint.encode())))
+        self.logger.info(f"generating {count} records for {endpoint} ...")
+        start = time.time()
+        with open(file_name, "w", buffering=2**20) as file:
+            for index in range(count):
+                values, flat = self.get_identity(endpoint, index)
+                file.write(json.dumps(self.generate_object(schema, rand, flat, values)) + "\n")
+                if (index+1)%self.LOG_EVERY==0:
+                    self.logger.info(f"  (... {index+1} records, {(index+1)/(time.time()-start):.0f} records/second)")
+        self.logger.info(f"finished generating {count} records for {endpoint} in {time.time()-start:.1f} seconds")
+
+    # Returns a generated object for a schema, with `fixed` values for some properties; `determined` is the
+    # (flattened) identity values of the record, which any other references in it must agree with
+    def generate_object(self, schema, rand, determined, fixed={}, seen=()):
+        generated = {}
+        for prop, prop_schema in schema.get("properties", {}).items():
+            if prop in fixed:
+                generated[prop] = fixed[prop]
+                continue
+            if prop in self.SKIP_PROPERTIES or prop.startswith("_"): continue
+            required = prop in schema.get("required", [])
+            if not required and rand.random()>=self.optional: continue
+            value = self.generate_property(prop, prop_schema, required, rand, determined, seen)
+            if value is not None: generated[prop] = value
+        return generated
+
+    def generate_property(self, prop, prop_schema, required, rand, determined, seen):
+        if "$ref" in prop_schema:
+            if prop.endswith("Reference"):
+                return self.generate_reference(prop, prop_schema["$ref"], required, rand, determined)
+            if prop_schema["$ref"] in seen: return None
+            schema = util.resolve_swagger_ref(self.swagger, prop_schema["$ref"])
+            return self.generate_object(schema, rand, determined, seen=seen+(prop_schema["$ref"],))
+        if prop_schema.get("type", None)=="array":
+            items_schema = prop_schema.get("items", {})
+            items = []
+            item_identities = set()
+            for _ in range(rand.randint(1 if required else 0, self.MAX_ARRAY_ITEMS)):
+                item = self.generate_property(prop, items_schema, True, rand, determined, seen)
+                if item is None: continue
+                # (items of an array must be distinct by their identity)
+                identity = json.dumps(self.get_item_identity(items_schema.get("$ref", None), item), sort_keys=True)
+                if identity in item_identities: continue
+                item_identities.add(identity)
+                items.append(item)
+            return items or None
+        return self.generate_scalar(prop, prop_schema, rand, required)
+
+    # Returns the identity values of an array item (or the whole item, if its schema doesn't have identity properties)
+    def get_item_identity(self, ref, item):
+        params = self.get_item_identity_params(ref) if ref else {}
+        try:
+            return util.interpolate_params(params, item) if params else item
+        except KeyError:
+            return item
+
+    @functools.lru_cache(maxsize=None)
+    def get_item_identity_params(self, ref):
+        return self.lightbeam.api.get_identity_params_from_swagger(self.swagger, ref)
+
+    # Returns a reference (which isn't part of the identity) to a generated record
+    def generate_reference(self, prop, ref, required, rand, determined):
+        properties = self.get_reference_properties(ref)
+        # (a reference must agree with the identity of the record, if they share properties)
+        if determined.keys() >= set(properties):
+            return { p: determined[p] for p in properties }
+        if determined.keys() & set(properties):
+            if not required: return None
+            self.warn(f"`{prop}` only partly overlaps the identity of its record, so may not resolve")
+        # (optional references to the same endpoint, like `parentLocalEducationAgencyReference`, are left out,
+        # since the referenced record may not have been sent yet)
+        targets = [ target for target in self.get_reference_targets(ref) if self.counts.get(target, 0)>0
+            and (required or target!=self.endpoint) ]
+        if not targets:
+            if not required: return None
+            self.warn(f"references in `{prop}` will not resolve, since none of {', '.join(self.get_reference_targets(ref))} are being generated (select them too?)")
+            schema = util.resolve_swagger_ref(self.swagger, ref)
+            return { p: self.generate_scalar(p, schema["properties"][p], rand, True) for p in properties }
+        target, index = self.locate(targets, rand.randrange(sum(self.counts[target] for target in targets)))
+        return self.resolve_reference(properties, target, self.get_identity(target, index)[1])
+
+    def generate_scalar(self, prop, schema, rand, required=True):
+        type = schema.get("type", "string")
+        format = schema.get("format", None)
+        if type=="string" and prop.endswith("Descriptor"):
+            values = self.get_descriptor_values(prop)
+            if values: return rand.choice(values)
+            # (a made-up value, which won't pass validation, but is better than an invalid payload)
+            return f"uri://ed-fi.org/{prop[0].upper()}{prop[1:]}#{rand.choice(self.WORDS)}" if required else None
+        if type=="boolean": return rand.random()<0.5
+        if type=="integer": return rand.randint(schema.get("minimum", 1), schema.get("maximum", 100))
+        if type=="number": return round(rand.uniform(schema.get("minimum", 0), schema.get("maximum", 100)), 2)
+        if "enum" in schema: return rand.choice(schema["enum"])
+        if format in ["date", "date-time"]: return self.format_date(rand.randrange(self.DATES_SPAN), schema)
+        if format=="time": return f"{rand.randrange(24):02d}:{rand.randrange(60):02d}:00"
+        value = " ".join(rand.choice(self.WORDS) for _ in range(rand.randint(1, 3)))
+        value = value[:schema.get("maxLength", len(value))]
+        return value.ljust(schema.get("minLength", 0), "x")
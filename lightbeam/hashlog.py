@@ -18,8 +18,22 @@ def save(file, data):
     state_dir = os.path.dirname(file)
     if not os.path.isdir(state_dir):
         os.mkdir(state_dir)
-    with open(file, 'wb') as f:
+    # (written to a temporary file, then renamed over the original, so an interruption can't leave it incomplete)
+    with open(file + '.tmp', 'wb') as f:
         pickle.dump(data, f)
+    os.replace(file + '.tmp', file)
+
+# Packs the `id` of a resource (usually a GUID, as 32 hex digits) into 16 bytes, to store in a hashlog
+def pack_id(id):
+    try:
+        packed = bytes.fromhex(id)
+        if packed.hex()==id: return packed
+    except ValueError:
+        pass
+    return id
+
+def unpack_id(id):
+    return id.hex() if isinstance(id, bytes) else id
 
 def get_hash(data):
     return hashlib.md5(data.encode()).digest()
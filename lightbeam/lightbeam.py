@@ -1,22 +1,18 @@
 import os
 import re
 import json
+import time
 import yaml
 import logging
 import asyncio
-import dateutil.parser
+import functools
+import contextlib
 from datetime import datetime
 from yaml.loader import SafeLoader
 
 from lightbeam import util
+from lightbeam import hashlog
 from lightbeam.api import EdFiAPI
-from lightbeam.count import Counter
-from lightbeam.create import Creator
-from lightbeam.fetch import Fetcher
-from lightbeam.validate import Validator
-from lightbeam.send import Sender
-from lightbeam.delete import Deleter
-from lightbeam.truncate import Truncator
 
 
 class Lightbeam:
@@ -44,10 +40,21 @@ class Lightbeam:
             "retry_statuses": [429, 500, 501, 503, 504],
         },
         "count": {
-            "separator": "\t"
+            "separator": "\t",
+            "mode": "remote"
         },
         "fetch": {
-            "page_size": 100
+            "page_size": 100,
+            "pagination": "auto"
+        },
+        "delete": {
+            "lookup": "auto"
+        },
+        "generate": {
+            "records": 100,
+            "counts": {},
+            "seed": 0,
+            "optional": 0.5
         },
         "log_level": "INFO",
         "show_stacktrace": False
@@ -55,8 +62,10 @@ class Lightbeam:
     MAX_TASK_QUEUE_SIZE = 2000
     MAX_STATUS_REASONS_TO_DISPLAY = 10
     DATA_FILE_EXTENSIONS = ['json', 'jsonl', 'ndjson']
+    # data files may also be compressed (like `schools.jsonl.gz`), as `fetch` can write them
+    COMPRESSED_FILE_EXTENSIONS = ['gz', 'zst']
     
-    def __init__(self, config_file, logger=None, selector="*", exclude="", keep_keys="*", drop_keys="", query="{}", params="", wipe=False, force=False, older_than="", newer_than="", resend_status_codes="", results_file="", overrides={}):
+    def __init__(self, config_file, logger=None, selector="*", exclude="", keep_keys="*", drop_keys="", query="{}", query_file="", params="", wipe=False, force=False, older_than="", newer_than="", resend_status_codes="", resume=False, offline=False, results_file="", overrides={}):
         self.config_file = config_file
         self.logger = logger
         self.errors = 0
@@ -67,21 +76,18 @@ class Lightbeam:
         self.keep_keys = keep_keys
         self.drop_keys = drop_keys
         self.query = query
+        self.query_file = query_file
         self.wipe = wipe
         self.older_than=older_than
         self.newer_than=newer_than
         self.resend_status_codes=resend_status_codes
+        self.resume = resume
+        self.offline = offline
         self.endpoints = []
         self.results = []
-        self.counter = Counter(self)
-        self.creator = Creator(self)
-        self.fetcher = Fetcher(self)
-        self.validator = Validator(self)
-        self.sender = Sender(self)
-        self.deleter = Deleter(self)
-        self.truncator = Truncator(self)
         self.api = EdFiAPI(self)
         self.token_version = 0        
+        self.record_counts_changed = False
         self.results_file = os.path.abspath(results_file) if results_file else None
         self.start_timestamp = datetime.now()
         self.overrides = overrides
@@ -115,8 +121,10 @@ class Lightbeam:
         self.api.prepare()
 
         # parse timestamps and/or status codes for state-based filtering
-        if self.older_than!='': self.older_than = dateutil.parser.parse(self.older_than).timestamp()
-        if self.newer_than!='': self.newer_than = dateutil.parser.parse(self.newer_than).timestamp()
+        if self.older_than!='' or self.newer_than!='':
+            import dateutil.parser
+            if self.older_than!='': self.older_than = dateutil.parser.parse(self.older_than).timestamp()
+            if self.newer_than!='': self.newer_than = dateutil.parser.parse(self.newer_than).timestamp()
         if self.resend_status_codes!='': self.resend_status_codes = [int(code) for code in self.resend_status_codes.split(",")]
 
         # create state_dir if it doesn't exist
@@ -126,7 +134,7 @@ class Lightbeam:
 
         # Initialize a dictionary for tracking run metadata (for structured output)
         namespace_overrides = self.config["namespace_overrides"] if "namespace_overrides" in self.config.keys() else None
-        namespace_overrides.pop("__line__") # (remove YAML parsing artifact)
+        if namespace_overrides: namespace_overrides.pop("__line__", None) # (remove YAML parsing artifact)
         self.metadata = {
             "started_at": self.start_timestamp.isoformat(timespec='microseconds'),
             "working_dir": os.getcwd(),
@@ -138,6 +146,48 @@ class Lightbeam:
             "resources": {}
         }
     
+    # The object for each command is only created (and its module, with that module's dependencies, imported)
+    # when first used, so a run of one command doesn't import everything every other command needs
+    @functools.cached_property
+    def counter(self):
+        from lightbeam.count import Counter
+        return Counter(self)
+
+    @functools.cached_property
+    def creator(self):
+        from lightbeam.create import Creator
+        return Creator(self)
+
+    @functools.cached_property
+    def fetcher(self):
+        from lightbeam.fetch import Fetcher
+        return Fetcher(self)
+
+    @functools.cached_property
+    def validator(self):
+        from lightbeam.validate import Validator
+        return Validator(self)
+
+    @functools.cached_property
+    def sender(self):
+        from lightbeam.send import Sender
+        return Sender(self)
+
+    @functools.cached_property
+    def deleter(self):
+        from lightbeam.delete import Deleter
+        return Deleter(self)
+
+    @functools.cached_property
+    def truncator(self):
+        from lightbeam.truncate import Truncator
+        return Truncator(self)
+
+    @functools.cached_property
+    def generator(self):
+        from lightbeam.generate import Generator
+        return Generator(self)
+
     def inject_cli_overrides(self):
         # parse self.overrides into configs:
         for key, value in self.overrides.items():
@@ -268,7 +318,7 @@ class Lightbeam:
     # For the specified endpoint, returns a list of all files in config.data_dir which end in .jsonl
     def get_data_files_for_endpoint(self, endpoint):
         file_list = []
-        for ext in self.DATA_FILE_EXTENSIONS:
+        for ext in self.get_data_file_extensions():
             # check for (for example):
             # - studentSchoolAssociations (default case from Ed-Fi Swagger)
             # - StudentSchoolAssociations (camelcase)
@@ -281,9 +331,10 @@ class Lightbeam:
                 if os.path.isfile(possible_file):
                     file_list.append(possible_file)
                     file_added = True
-                possible_dir = os.path.join(self.config["data_dir"] + cased_endpoint)
+                possible_dir = os.path.join(self.config["data_dir"], cased_endpoint)
                 if os.path.isdir(possible_dir):
-                    for file in os.listdir(possible_dir):
+                    # (sorted, so files of incremental `fetch` changes are processed in the order they were fetched)
+                    for file in sorted(os.listdir(possible_dir)):
                         if file.endswith("." + ext):
                             file_list.append(os.path.join(self.config["data_dir"], cased_endpoint, file))
                             file_added = True
@@ -294,6 +345,49 @@ class Lightbeam:
 
         return file_list
 
+    # Returns all the extensions of data files, including compressed ones (like `jsonl.gz`)
+    def get_data_file_extensions(self):
+        return self.DATA_FILE_EXTENSIONS + [
+            f"{ext}.{compressed_ext}" for compressed_ext in self.COMPRESSED_FILE_EXTENSIONS for ext in self.DATA_FILE_EXTENSIONS ]
+
+    # The number of records in each data file is cached in `state_dir` (along with the file's size and
+    # modification time, so a changed file isn't counted by its old count): `count` with `count.mode: local`
+    # saves the counts it makes, and `send` the number of payloads it reads - so `send` can report progress
+    # against the total without first reading every file to count it.
+    @functools.cached_property
+    def record_counts(self):
+        record_counts = {}
+        if self.track_state and not self.wipe:
+            try:
+                record_counts = hashlog.load(os.path.join(self.config["state_dir"], "cache", "record-counts.dat"))
+            except Exception as e:
+                self.logger.debug(f"(could not load cached record counts; files will be re-counted)")
+        return record_counts
+
+    # Returns the cached number of records in a data file, or None if it isn't cached (or the file has changed)
+    def get_record_count(self, file_name):
+        stat = os.stat(file_name)
+        cached = self.record_counts.get(os.path.abspath(file_name), None)
+        if cached is None or cached[:2]!=(stat.st_size, stat.st_mtime_ns): return None
+        return cached[2]
+
+    def set_record_count(self, file_name, count):
+        stat = os.stat(file_name)
+        self.record_counts[os.path.abspath(file_name)] = (stat.st_size, stat.st_mtime_ns, count)
+        self.record_counts_changed = True
+
+    def save_record_counts(self):
+        if self.track_state and self.record_counts_changed:
+            hashlog.save(os.path.join(self.config["state_dir"], "cache", "record-counts.dat"), self.record_counts)
+            self.record_counts_changed = False
+
+    # Splits a file name into its name without the extension, and its data file extension (or None, if it's not a data file)
+    def split_data_file_name(self, filename):
+        for ext in self.get_data_file_extensions():
+            if filename.endswith("." + ext):
+                return filename[:-len(ext)-1], ext
+        return filename, None
+
     # Prunes the list of endpoints down to those for which .jsonl files exist in the config.data_dir
     def get_endpoints_with_data(self, filter_endpoints=None):
         if not filter_endpoints:
@@ -305,10 +399,9 @@ class Lightbeam:
             data_dir_item_path = os.path.join(self.config["data_dir"], data_dir_item)
             if os.path.isfile(data_dir_item_path):
                 filename = os.path.basename(data_dir_item)
-                extension = filename.rsplit(".", 1)[-1]
-                filename_without_extension = filename.rsplit(".", 1)[0]
+                filename_without_extension, extension = self.split_data_file_name(filename)
                 if (
-                    extension in self.DATA_FILE_EXTENSIONS # valid file extension
+                    extension is not None # valid file extension
                     and filename_without_extension in self.all_endpoints # valid endpoint
                     and filename_without_extension in filter_endpoints # selected endpoint
                 ):
@@ -321,10 +414,9 @@ class Lightbeam:
                         sub_dir_item_path = os.path.join(data_dir_item_path, sub_dir_item)
                         if os.path.isfile(sub_dir_item_path):
                             filename = os.path.basename(sub_dir_item)
-                            extension = filename.rsplit(".", 1)[-1]
-                            filename_without_extension = filename.rsplit(".", 1)[0]
+                            filename_without_extension, extension = self.split_data_file_name(filename)
                             if (
-                                extension in self.DATA_FILE_EXTENSIONS # valid file extension
+                                extension is not None # valid file extension
                                 and data_dir_item in self.all_endpoints # valid endpoint
                                 and data_dir_item in filter_endpoints # selected endpoint
                             ):
@@ -354,11 +446,43 @@ class Lightbeam:
 
     ###################### Async task-processing methods ######################
 
-    # Waits for an entire queue of `counter` `tasks` to complete (asynchronously)
-    async def do_tasks(self, tasks, counter, log_status_counts=True):
+    # Opens a client (with which tasks make requests) for the duration of the context; processes
+    # whose tasks should make progress while more are being queued (like a fused `validate+send`)
+    # hold one open throughout, and `do_tasks()` re-uses it instead of opening another
+    @contextlib.asynccontextmanager
+    async def open_client(self):
+        if self.api.client is not None:
+            yield self.api.client
+            return
         async with self.api.get_retry_client() as client:
             self.api.client = client
-            self.lock = asyncio.Lock()
+            try:
+                yield client
+            finally:
+                self.api.client = None
+
+    # Runs `do_endpoint(endpoint)` for each of `endpoints` in reverse-dependency order, one dependency level
+    # at a time: all the endpoints of a level are processed concurrently (sharing one client, so at most
+    # `connection.pool_size` requests are in flight), and the next level starts once they're all done
+    def run_reverse_dependency_levels(self, endpoints, do_endpoint):
+        levels = self.api.get_dependency_levels(endpoints)
+        levels.reverse()
+        for i, level in enumerate(levels):
+            self.logger.info("processing level {0} of {1} ({2}) ...".format(i+1, len(levels), ", ".join(level)))
+            start = time.time()
+            self.reset_counters()
+            asyncio.run(self.do_endpoints(level, do_endpoint))
+            self.logger.info("finished processing level {0} of {1} in {2:.1f} seconds!".format(i+1, len(levels), time.time()-start))
+            self.logger.info("  (final status counts: {0})".format(self.status_counts))
+            self.log_status_reasons()
+
+    async def do_endpoints(self, endpoints, do_endpoint):
+        async with self.open_client():
+            await asyncio.gather(*[ do_endpoint(endpoint) for endpoint in endpoints ])
+
+    # Waits for an entire queue of `counter` `tasks` to complete (asynchronously)
+    async def do_tasks(self, tasks, counter, log_status_counts=True):
+        async with self.open_client():
             await asyncio.wait(tasks)
         if log_status_counts:
             self.logger.info("  (... status counts: {0}) ".format(str(self.status_counts)))
@@ -373,11 +497,11 @@ class Lightbeam:
         self.status_counts = {}
         self.status_reasons = {}
 
-    def increment_status_counts(self, status):
+    def increment_status_counts(self, status, count=1):
         if status not in self.status_counts:
-            self.status_counts[status] = 1
+            self.status_counts[status] = count
         else:
-            self.status_counts[status] += 1
+            self.status_counts[status] += count
     
     def increment_status_reason(self, reason):
         if reason not in self.status_reasons:
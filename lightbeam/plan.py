@@ -0,0 +1,29 @@
+# An EndpointPlan holds everything lightbeam needs to know about the structure of one endpoint, as
+# derived from the Swagger. Plans are built once (see `EdFiAPI.get_endpoint_plan()`) and cached
+# alongside the Swagger, so commands don't walk Swagger dictionaries while processing payloads.
+class EndpointPlan:
+
+    def __init__(self, endpoint, namespace, swagger_type, definition, url):
+        self.endpoint = endpoint
+        self.namespace = namespace
+        self.swagger_type = swagger_type # "resources" or "descriptors"
+        self.definition = definition     # like `edFi_studentSchoolAssociation`
+        self.url = url                   # where payloads for this endpoint are sent
+
+        # params structures (see `util.interpolate_params()`) mapping a param name to a
+        # (dot-separated) path in a payload, for the required and identity properties
+        self.required_params = {}
+        self.identity_params = {}
+        # a structure of all properties, annotated with whether each is required (see `lightbeam create`)
+        self.all_params = {}
+
+        # referenced endpoint -> properties needed to look up a reference to it
+        self.references = {}
+
+        # paths to properties which contain descriptor values; each path is a tuple of property
+        # names, where "*" means "each item of the array at this point"
+        self.descriptor_paths = []
+
+        # array property -> {"identity": params structure of its items, "arrays": (nested array properties of items)},
+        # so items of each array can be checked for uniqueness
+        self.array_identities = {}
@@ -3,6 +3,7 @@ import os
 import time
 import json
 import asyncio
+import datetime
 
 from lightbeam import util
 from lightbeam import hashlog
@@ -16,38 +17,54 @@ class Sender:
         self.logger = self.lightbeam.logger
         self.hashlog_data = {}
 
-    # Sends all (selected) endpoints
-    def send(self):
-
-        # get token with which to send requests
-        self.lightbeam.api.do_oauth()
+    # Sends all (selected) endpoints; with `validate=True` (a fused `validate+send`), each payload
+    # is validated immediately before it is sent, so data files are read and parsed only once
+    def send(self, validate=False):
+        command = "validate+send" if validate else "send"
 
         # filter down to selected endpoints that actually have .jsonl in config.data_dir
         endpoints = self.lightbeam.get_endpoints_with_data(self.lightbeam.endpoints)
         if len(endpoints)==0:
             self.logger.critical("`data_dir` {0} has no *.jsonl files".format(self.lightbeam.config["data_dir"]) + " for selected endpoints")
 
+        if validate:
+            self.lightbeam.validator.prepare(endpoints)
+            self.send_invalid = self.lightbeam.config.get("validate",{}).get("send_invalid", False)
+
+        # get token with which to send requests
+        self.lightbeam.api.do_oauth()
+
         # send each endpoint
         for endpoint in endpoints:
-            self.logger.info("sending endpoint {0} ...".format(endpoint))
-            asyncio.run(self.do_send(endpoint))
+            if validate:
+                self.logger.info("validating and sending endpoint {0} ...".format(endpoint))
+                self.lightbeam.validator.prepare_endpoint(endpoint)
+            else:
+                self.logger.info("sending endpoint {0} ...".format(endpoint))
+            total_counter = asyncio.run(self.do_send(endpoint, validate=validate))
+            if validate:
+                self.lightbeam.validator.finish_endpoint(endpoint, total_counter)
             self.logger.info("finished processing endpoint {0}!".format(endpoint))
             self.logger.info("  (final status counts: {0}) ".format(self.lightbeam.status_counts))
             self.lightbeam.log_status_reasons()
         
         # write structured output (if needed)
-        self.lightbeam.write_structured_output("send")
+        self.lightbeam.write_structured_output(command)
 
         if self.lightbeam.metadata["total_records_processed"] == self.lightbeam.metadata["total_records_skipped"]:
             self.logger.info("all payloads skipped")
             exit(99) # signal to downstream tasks (in Airflow) all payloads skipped
 
-        if self.lightbeam.metadata["total_records_processed"] == self.lightbeam.metadata["total_records_failed"]:
+        num_failed = self.lightbeam.metadata["total_records_failed"]
+        if validate and not self.send_invalid:
+            # (payloads which failed validation weren't sent)
+            num_failed += sum(item.get("records_invalid", 0) for item in self.lightbeam.metadata["resources"].values())
+        if self.lightbeam.metadata["total_records_processed"] == num_failed:
             self.logger.info("all payloads failed")
             exit(1) # signal to downstream tasks (in Airflow) all payloads failed
 
-    # Sends a single endpoint
-    async def do_send(self, endpoint):
+    # Sends a single endpoint (optionally validating each payload first); returns the number of payloads processed
+    async def do_send(self, endpoint, validate=False):
         # We try to  avoid re-POSTing JSON we've already (successfully) sent.
         # This is done by storing a few things in a file we call a hashlog:
         # - the hash of the JSON (so we can recognize it in the future)
@@ -66,61 +83,71 @@ class Sender:
         data_files = self.lightbeam.get_data_files_for_endpoint(endpoint)
         tasks = []
         total_counter = 0
-        for file_name in data_files:
-            with open(file_name) as file:
-                # process each line
-                for i, line in enumerate(file):
-                    line_number = i + 1
-                    total_counter += 1
-                    data = line.strip()
-                    # compute hash of current row
-                    data_hash = hashlog.get_hash(data)
-                    # check if we've posted this data before
-                    if (
-                        self.lightbeam.track_state
-                        and data_hash in self.hashlog_data.keys()
-                    ):
-                        # check if the last post meets criteria for a resend
-                        if self.lightbeam.meets_process_criteria(
-                            self.hashlog_data[data_hash]
-                        ):
-                            # yes, we need to (re)post it; append to task queue
-                            tasks.append(
-                                asyncio.create_task(
-                                    self.do_post(
-                                        endpoint,
-                                        file_name,
-                                        data,
-                                        line_number,
-                                        data_hash,
-                                    )
-                                )
-                            )
-                        else:
+        self.num_invalid = 0
+        # (progress is reported against the number of payloads, if all the files' counts are cached - see
+        # `Lightbeam.record_counts`; the files aren't read an extra time to count them)
+        start_time = time.time()
+        file_counts = [ self.lightbeam.get_record_count(file_name) for file_name in data_files ]
+        num_payloads = sum(file_counts) if None not in file_counts else None
+        # the client is held open across the whole endpoint so queued POSTs (and, with `validate`, the
+        # validation of each payload, including any remote reference lookups) are in flight while later
+        # payloads are still being read
+        async with self.lightbeam.open_client():
+            for file_name in data_files:
+                file_counter = 0 # (not counting blank lines at the end, like `util.count_records()`)
+                with util.open_data_file(file_name) as file:
+                    # process each line
+                    for i, line in enumerate(file):
+                        if validate: await self.check_fail_fast(endpoint, tasks, total_counter)
+                        line_number = i + 1
+                        total_counter += 1
+                        data = line.strip()
+                        if data!="": file_counter = line_number
+                        # compute hash of current row
+                        data_hash = hashlog.get_hash(data)
+                        # check if we've posted this data before
+                        is_skipped = (
+                            self.lightbeam.track_state
+                            and data_hash in self.hashlog_data.keys()
+                            and not self.lightbeam.meets_process_criteria(self.hashlog_data[data_hash])
+                        )
+
+                        if is_skipped:
                             # no, do not (re)post
                             self.lightbeam.num_skipped += 1
-                            continue
-                    else:
-                        # new, never-before-seen payload! append it to task queue
-                        tasks.append(
-                            asyncio.create_task(
-                                self.do_post(
-                                    endpoint, file_name, data, line_number, data_hash
-                                )
-                            )
-                        )
+                            # (... but with `validate`, it's validated anyway, so - as with a separate `validate` -
+                            # other payloads are checked for uniqueness against it, and it's remembered as valid)
+                            if not validate: continue
+
+                        if validate:
+                            # (validated in the payload's task, so reference lookups don't hold up reading the file)
+                            task = self.do_validate_and_post(endpoint, file_name, data, line_number, data_hash, is_skipped)
+                        else:
+                            # new payload, or one which meets resend criteria
+                            task = self.do_post(endpoint, file_name, data, line_number, data_hash)
+                        tasks.append(asyncio.create_task(task))
 
-                    if total_counter%self.lightbeam.MAX_TASK_QUEUE_SIZE==0:
-                        await self.lightbeam.do_tasks(tasks, total_counter)
-                        tasks = []
+                        if total_counter%self.lightbeam.MAX_TASK_QUEUE_SIZE==0:
+                            await self.lightbeam.do_tasks(tasks, total_counter)
+                            tasks = []
+                            self.log_progress(total_counter, num_payloads, start_time)
 
-                if self.lightbeam.num_skipped>0:
-                    self.logger.info("skipped {0} of {1} payloads because they were previously processed and did not match any resend criteria".format(self.lightbeam.num_skipped, total_counter))
-            if len(tasks)>0: await self.lightbeam.do_tasks(tasks, total_counter)
+                    if self.lightbeam.num_skipped>0:
+                        self.logger.info("skipped {0} of {1} payloads because they were previously processed and did not match any resend criteria".format(self.lightbeam.num_skipped, total_counter))
+                self.lightbeam.set_record_count(file_name, file_counter)
+                if len(tasks)>0:
+                    await self.lightbeam.do_tasks(tasks, total_counter)
+                    tasks = []
+            if validate: await self.check_fail_fast(endpoint, tasks, total_counter)
+
+        if self.num_invalid>0:
+            verb = "sent" if self.send_invalid else "did not send"
+            self.logger.warning(f"{self.num_invalid} of {total_counter} payloads failed validation ({verb} them; see details above)")
 
         # any task may have updated the hashlog, so we need to re-save it out to disk
         if self.lightbeam.track_state:
             hashlog.save(hashlog_file, self.hashlog_data)
+        self.lightbeam.save_record_counts()
 
         # update metadata counts for this endpoint
         statuses = self.lightbeam.status_counts.keys()
@@ -135,6 +162,46 @@ class Sender:
             "records_skipped": self.lightbeam.num_skipped,
             "records_failed": self.lightbeam.num_errors
         })
+        if validate:
+            self.lightbeam.metadata["resources"][endpoint]["records_invalid"] = self.num_invalid
+        return total_counter
+
+    # Implements the "fail fast" feature for a fused `validate+send`: stops once `validate.references.max_failures`
+    # payloads have failed validation
+    async def check_fail_fast(self, endpoint, tasks, total_counter):
+        num_failed = self.lightbeam.validator.num_failed
+        fail_fast_threshold = self.lightbeam.validator.fail_fast_threshold
+        if fail_fast_threshold is None or num_failed < fail_fast_threshold: return
+        # (POSTs already under way are finished first)
+        if len(tasks)>0: await self.lightbeam.do_tasks(tasks, total_counter)
+        self.lightbeam.metadata["resources"][endpoint].update({
+            "records_processed": total_counter,
+            "records_skipped": self.lightbeam.num_skipped,
+            "records_failed": self.lightbeam.num_errors,
+            "records_invalid": self.num_invalid,
+        })
+        self.lightbeam.shutdown("validate+send")
+        self.logger.critical(f"... STOPPING; found {num_failed} >= validate.references.max_failures={fail_fast_threshold} VALIDATION ERRORS.")
+
+    # Validates a single payload (for a fused `validate+send`), then posts it unless it was skipped (as previously
+    # sent) or is invalid
+    async def do_validate_and_post(self, endpoint, file_name, data, line_number, data_hash, is_skipped):
+        validator = self.lightbeam.validator
+        # (once the run is stopping - see `check_fail_fast()` - payloads aren't validated or counted)
+        if validator.fail_fast_threshold is not None and validator.num_failed >= validator.fail_fast_threshold: return
+        is_valid = await validator.do_validate_payload(endpoint, file_name, data, line_number, data_hash)
+        if not is_valid: self.num_invalid += 1
+        if is_skipped or (not is_valid and not self.send_invalid): return
+        await self.do_post(endpoint, file_name, data, line_number, data_hash)
+
+    # Logs how many of an endpoint's payloads have been processed (if the number of them is known), and about
+    # how long the rest will take
+    def log_progress(self, total_counter, num_payloads, start_time):
+        if not num_payloads: return
+        num_payloads = max(num_payloads, total_counter)
+        remaining = (time.time() - start_time) / total_counter * (num_payloads - total_counter)
+        self.logger.info("  (... processed {0} of {1} payloads ({2:.0%}); about {3} remaining)".format(
+            total_counter, num_payloads, total_counter / num_payloads, datetime.timedelta(seconds=round(remaining))))
 
     # Posts a single data payload to a single endpoint
     async def do_post(self, endpoint, file_name, data, line_number, data_hash):
@@ -145,7 +212,7 @@ class Sender:
                     util.url_join(self.lightbeam.api.config["data_url"], self.lightbeam.get_namespace_for_endpoint(endpoint), endpoint),
                     data=data,
                     ssl=self.lightbeam.config["connection"]["verify_ssl"],
-                    headers=self.lightbeam.api.headers
+                    headers=await self.lightbeam.api.get_headers()
                     ) as response:
                     body = await response.text()
                     status = response.status
@@ -187,7 +254,7 @@ class Sender:
                             for message in messages:
                                 do_append = True
                                 for index, item in enumerate(failures):
-                                    if item["status_code"]==response.status and item["message"]==message and item["file"]==file_name:
+                                    if item.get("status_code")==response.status and item["message"]==message and item["file"]==file_name:
                                         failures[index]["line_numbers"].append(line_number)
                                         failures[index]["count"] += 1
                                         do_append = False
@@ -215,18 +282,17 @@ class Sender:
                                 round(time.time()),
                                 response.status,
                             )
+                            # (plus the `id` of the record created or updated, from its URL in the `Location`
+                            # header, so `delete` can delete it without searching for it)
+                            location = response.headers.get("Location", "")
+                            if response.status in [ 200, 201 ] and location:
+                                self.hashlog_data[data_hash] += (hashlog.pack_id(location.rstrip("/").rsplit("/", 1)[-1]),)
 
                         break # (out of while loop)
 
                     else: # 401 status
-                        # this could be broken out to a separate function call,
-                        # but not doing so should help keep the critical section small
-                        if self.lightbeam.token_version == curr_token_version:
-                            self.lightbeam.lock.acquire()
-                            self.lightbeam.api.update_oauth()
-                            self.lightbeam.lock.release()
-                        else:
-                            await asyncio.sleep(1)
+                        # refresh the token (unless another task already did)
+                        await self.lightbeam.api.refresh_oauth(curr_token_version)
                         curr_token_version = int(str(self.lightbeam.token_version))
 
             except RuntimeError as e:
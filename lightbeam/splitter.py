@@ -0,0 +1,103 @@
+import re
+
+
+# anything except brackets or braces (skipping over strings, which may contain them), then nested
+# arrays or objects up to `depth` deep:
+def get_run_pattern(depth):
+    other = rb'[^"\[\]{}]'
+    string = rb'"[^"\\]*(?:\\.[^"\\]*)*"'
+    run = other + rb'*(?:' + string + other + rb'*)*'
+    for _ in range(depth):
+        run = other + rb'*(?:(?:' + string + rb'|[\[{]' + run + rb'[\]}])' + other + rb'*)*'
+    return run
+
+
+# Splits a JSON array, fed in chunks of bytes (as it's read from a response), into the raw bytes of each
+# of its elements, without parsing them. (`fetch` uses this to write records straight through to JSONL.)
+# Elements must be objects or arrays - like the records returned by the Ed-Fi API.
+class JSONArraySplitter:
+
+    # (regex can't match arbitrarily-nested brackets, so elements are matched whole, in one go, up to this
+    # depth of nesting; deeper elements are scanned bracket by bracket)
+    MAX_MATCHED_DEPTH = 8
+
+    ELEMENT = re.compile(rb'[\[{]' + get_run_pattern(MAX_MATCHED_DEPTH - 1) + rb'[\]}]')
+    # the next bracket that isn't part of a (complete) nested array or object; group 1 is an opening bracket
+    BRACKET = re.compile(get_run_pattern(MAX_MATCHED_DEPTH - 1) + rb'(?:([\[{])|[\]}])')
+    WHITESPACE = re.compile(rb'[ \t\r\n]*')
+    SEPARATORS = re.compile(rb'[ \t\r\n,]*')
+
+    def __init__(self):
+        self.buffer = b""
+        self.pos = 0        # where to resume scanning the buffer
+        self.depth = 0      # of nested arrays/objects (the array being split is depth 1)
+        self.start = None   # where the element being scanned bracket by bracket starts in the buffer
+        self.done = False   # whether the end of the array has been reached
+
+    # Feeds the next chunk of bytes; returns a list of the (bytes of) elements it completed.
+    # Raises a ValueError if the data isn't a JSON array of objects or arrays.
+    def feed(self, chunk):
+        buffer = self.buffer + chunk
+        pos = self.pos
+        elements = []
+        while True:
+            if self.depth==0:
+                pos = self.WHITESPACE.match(buffer, pos).end()
+                if pos==len(buffer): break
+                if self.done:
+                    raise ValueError("unexpected data after the end of the JSON array")
+                if buffer[pos:pos+1]!=b"[":
+                    raise ValueError("JSON is not an array")
+                self.depth = 1
+                pos += 1
+
+            elif self.depth==1:
+                pos = self.SEPARATORS.match(buffer, pos).end()
+                if pos==len(buffer): break
+                char = buffer[pos:pos+1]
+                if char==b"]":
+                    self.depth = 0
+                    self.done = True
+                    pos += 1
+                elif char in (b"{", b"["):
+                    match = self.ELEMENT.match(buffer, pos)
+                    if match:
+                        elements.append(self.get_line(buffer[pos:match.end()]))
+                        pos = match.end()
+                    else:
+                        # the element is deeply-nested, or incomplete (so far)
+                        self.start = pos
+                        self.depth = 2
+                        pos += 1
+                else:
+                    raise ValueError("JSON is not an array of objects or arrays")
+
+            else:
+                match = self.BRACKET.match(buffer, pos)
+                if match is None: break # (we need more data)
+                pos = match.end()
+                if match.lastindex: self.depth += 1
+                else:
+                    self.depth -= 1
+                    if self.depth==1:
+                        elements.append(self.get_line(buffer[self.start:pos]))
+                        self.start = None
+
+        # keep only what's still needed: the element being scanned, or what's left to scan
+        keep_from = self.start if self.start is not None else pos
+        self.buffer = buffer[keep_from:]
+        self.pos = pos - keep_from
+        if self.start is not None: self.start = 0
+        return elements
+
+    # Checks that the whole array has been fed; raises a ValueError otherwise
+    def close(self):
+        if not self.done or self.depth!=0:
+            raise ValueError("incomplete JSON array")
+
+    # (a JSONL record must be on one line; raw line breaks can only be whitespace outside of strings)
+    @staticmethod
+    def get_line(element):
+        if b"\n" in element or b"\r" in element:
+            element = element.replace(b"\r", b" ").replace(b"\n", b" ")
+        return element
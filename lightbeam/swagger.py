@@ -0,0 +1,93 @@
+import os
+import mmap
+import pickle
+import struct
+from collections.abc import Mapping
+
+# A Swagger doc is cached (see `EdFiAPI.load_swagger_docs()`) preprocessed into a binary file, so later runs
+# needn't parse multi-MB of JSON just to process a few endpoints. The large sections of the doc (its
+# definitions and paths) are split up, with each definition or path pickled separately; the file holds
+# the length of an index, the index (the rest of the doc, plus the position of each definition or path),
+# then the pickled definitions and paths. Loading the file only reads the index: each definition or path
+# is only unpickled when it's first used.
+
+FORMAT_VERSION = 1
+SECTIONS = (("definitions",), ("paths",), ("components", "schemas"))
+INDEX_LENGTH = struct.Struct("<Q")
+
+
+# One (split-up) section of a Swagger doc, like its `definitions`, which is read-only and loads each of its
+# items when it's first accessed. (It's deliberately not a `dict`, so things like `jsonschema`'s
+# `RefResolver`, which search all the `dict`s within a document, don't load every item.)
+class LazySection(Mapping):
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+        self.items_loaded = {}
+
+    def __getitem__(self, key):
+        if key not in self.items_loaded:
+            start, end = self.offsets[key]
+            self.items_loaded[key] = pickle.loads(self.data[start:end])
+        return self.items_loaded[key]
+
+    def __contains__(self, key):
+        return key in self.offsets
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+# Saves a (parsed) Swagger doc to a file, along with a dictionary of `info` about it
+def save(file, swagger, info={}):
+    doc = dict(swagger)
+    blobs = []
+    position = 0
+    sections = {}
+    for path in SECTIONS:
+        # (copy the dictionaries along the path, so `swagger` isn't modified)
+        parent = doc
+        for key in path[:-1]:
+            if not isinstance(parent.get(key, None), dict): break
+            parent[key] = dict(parent[key])
+            parent = parent[key]
+        else:
+            if not isinstance(parent.get(path[-1], None), dict): continue
+            offsets = {}
+            for key, value in parent.pop(path[-1]).items():
+                blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+                offsets[key] = (position, position + len(blob))
+                position += len(blob)
+                blobs.append(blob)
+            sections[path] = offsets
+    index = pickle.dumps({"format": FORMAT_VERSION, "info": info, "doc": doc, "sections": sections}, protocol=pickle.HIGHEST_PROTOCOL)
+    # (written to a temporary file, then renamed over the original, so an interruption can't leave it incomplete)
+    with open(file + '.tmp', 'wb') as f:
+        f.write(INDEX_LENGTH.pack(len(index)))
+        f.write(index)
+        for blob in blobs:
+            f.write(blob)
+    os.replace(file + '.tmp', file)
+
+# Loads a Swagger doc saved by `save()` (with its sections loaded lazily), and the `info` saved with it
+def load(file):
+    with open(file, 'rb') as f:
+        index_length, = INDEX_LENGTH.unpack(f.read(INDEX_LENGTH.size))
+        if index_length > os.fstat(f.fileno()).st_size - INDEX_LENGTH.size:
+            raise ValueError("incomplete Swagger cache file")
+        index = pickle.loads(f.read(index_length))
+        if index["format"]!=FORMAT_VERSION:
+            raise ValueError(f"unsupported Swagger cache format {index['format']}")
+        if index["sections"]:
+            data = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))[INDEX_LENGTH.size + index_length:]
+    doc = index["doc"]
+    for path, offsets in index["sections"].items():
+        parent = doc
+        for key in path[:-1]:
+            parent = parent[key]
+        parent[path[-1]] = LazySection(data, offsets)
+    return doc, index["info"]
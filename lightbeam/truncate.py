@@ -13,73 +13,71 @@ class Truncator:
         self.lightbeam = lightbeam
         self.lightbeam.reset_counters()
         self.logger = self.lightbeam.logger
-        self.hashlog_data = {}
+        self.incomplete_endpoints = []
     
     # Deletes all data in the Ed-Fi API for selected endpoints
     def truncate(self):
         # get token with which to send requests
         self.lightbeam.api.do_oauth()
 
-        # process endpoints in reverse-dependency order, so we don't get dependency errors
-        endpoints = self.lightbeam.endpoints
-        endpoints.reverse()
-
         # prompt to confirm this destructive operation
-        self.lightbeam.confirm_truncate(endpoints)
-
-        for endpoint in endpoints:
-            asyncio.run(self.do_truncates(endpoint))
-            self.logger.info("finished processing endpoint {0}!".format(endpoint))
-            self.logger.info("  (final status counts: {0})".format(self.lightbeam.status_counts))
-            self.lightbeam.log_status_reasons()
+        self.lightbeam.confirm_truncate(list(reversed(self.lightbeam.endpoints)))
 
-    # Deletes data matching payloads in config.data_dir for single endpoint
-    async def do_truncates(self, endpoint):
-        # load the hashlog, since we delete previously-seen payloads from it after deleting them
-        if self.lightbeam.track_state:
-            hashlog_file = os.path.join(self.lightbeam.config["state_dir"], f"{endpoint}.dat")
-            self.hashlog_data = hashlog.load(hashlog_file)
-        
-        
-        selector_backup = self.lightbeam.selector
-        exclude_backup = self.lightbeam.exclude
-        track_state_backup = self.lightbeam.track_state
-        self.lightbeam.selector = endpoint
-        self.lightbeam.keep_keys = "id"
-        self.lightbeam.track_state = False
-        all_endpoints = self.lightbeam.api.get_sorted_endpoints()
-        self.lightbeam.endpoints = self.lightbeam.api.apply_filters(all_endpoints)
+        # process endpoints in reverse-dependency order, so we don't get dependency errors
+        self.lightbeam.run_reverse_dependency_levels(self.lightbeam.endpoints, self.do_truncates)
 
-        # this fetches the IDs of all payloads in the Ed-Fi API into self.lightbeam.results:
-        self.lightbeam.results = []
-        await self.lightbeam.fetcher.get_records(do_write=False, log_status_counts=False)
+        if self.incomplete_endpoints:
+            self.logger.critical("{0} could not be completely truncated (see above); re-run `truncate` to delete the remaining records".format(", ".join(self.incomplete_endpoints)))
 
+    # Deletes all records of a single endpoint from the Ed-Fi API. Pages of `id`s are read into a bounded
+    # queue, from which `pool_size` workers delete them - so deletes start right away, and only a couple of
+    # pages of `id`s are held in memory at once. Pages are read from the last one back to the first, so
+    # deleting a page's records doesn't shift the offsets of those still to be read.
+    async def do_truncates(self, endpoint):
         self.logger.info("TRUNCATING ALL DATA from endpoint {0} ...".format(endpoint))
-        tasks = []
-        counter = 0
-        self.lightbeam.reset_counters()
-        # loop over IDs and delete each one:
-        for result in self.lightbeam.results:
-            counter += 1
-            id = result["id"]
-            tasks.append(asyncio.create_task(self.lightbeam.deleter.do_delete_id(endpoint, id)))
-            # process task queue occasionally before if gets too big:
-            if counter%self.lightbeam.MAX_TASK_QUEUE_SIZE==0:
-                await self.lightbeam.do_tasks(tasks, counter)
-                tasks = []
+        limit = self.lightbeam.config["fetch"]["page_size"]
+        async with self.lightbeam.open_client():
+            num_records = await self.lightbeam.counter.get_record_count(endpoint)
+            if num_records is None: return
 
-        # finish up any uncompleted tasks:
-        if len(tasks)>0: await self.lightbeam.do_tasks(tasks, counter)
+            ids = asyncio.Queue(maxsize=2*limit)
+            workers = [ asyncio.create_task(self.delete_ids(endpoint, ids))
+                for _ in range(self.lightbeam.config["connection"]["pool_size"]) ]
+            num_failed_pages = 0
+            next_progress = self.lightbeam.MAX_TASK_QUEUE_SIZE
+            for offset in reversed(range(0, num_records, limit)):
+                records = await self.lightbeam.fetcher.get_records_page(endpoint, offset, limit)
+                if records is None:
+                    num_failed_pages += 1
+                    continue
+                for record in records:
+                    await ids.put(record["id"])
+                # (log progress occasionally; only from here, so each milestone is logged once)
+                if self.lightbeam.num_finished>=next_progress:
+                    self.logger.info("  (... status counts: {0}) ".format(str(self.lightbeam.status_counts)))
+                    next_progress = (self.lightbeam.num_finished//self.lightbeam.MAX_TASK_QUEUE_SIZE + 1) * self.lightbeam.MAX_TASK_QUEUE_SIZE
+            for _ in workers: await ids.put(None)
+            await asyncio.wait(workers)
+            # (records may also remain because deleting them failed)
+            num_remaining = await self.lightbeam.counter.get_record_count(endpoint) if num_failed_pages==0 else None
+
+        if num_failed_pages>0 or num_remaining!=0:
+            # (the hashlog is kept, since some of the payloads in it may still be in Ed-Fi)
+            if num_failed_pages>0: reason = "{0} pages of its records could not be read".format(num_failed_pages)
+            elif num_remaining is None: reason = "its records could not be counted afterwards"
+            else: reason = "{0} of its records remain".format(num_remaining)
+            self.logger.warning("endpoint {0} was not completely truncated: {1}".format(endpoint, reason))
+            self.incomplete_endpoints.append(endpoint)
+            return
 
         # clear out the hashlog file, since those payloads aren't in Ed-Fi anymore
-        if track_state_backup:
-            self.hashlog_data = {}
-            hashlog.save(hashlog_file, self.hashlog_data)
+        if self.lightbeam.track_state:
+            hashlog.save(os.path.join(self.lightbeam.config["state_dir"], f"{endpoint}.dat"), {})
+        self.logger.info("finished processing endpoint {0}!".format(endpoint))
 
-        self.lightbeam.results = []
-        self.lightbeam.selector = selector_backup
-        self.lightbeam.exclude = exclude_backup
-        self.lightbeam.track_state = track_state_backup
-        self.lightbeam.keep_keys = ""
-        all_endpoints = self.lightbeam.api.get_sorted_endpoints()
-        self.lightbeam.endpoints = self.lightbeam.api.apply_filters(all_endpoints)
\ No newline at end of file
+    # Deletes `id`s from a queue until it yields None
+    async def delete_ids(self, endpoint, ids):
+        while True:
+            id = await ids.get()
+            if id is None: return
+            await self.lightbeam.deleter.do_delete_id(endpoint, id)
@@ -1,4 +1,8 @@
+import io
+import os
 import re
+import gzip
+import mmap
 import json
 import itertools
 import copy
@@ -33,6 +37,32 @@ def pluralize_endpoint(endpoint):
     elif endpoint=="person": return "people"
     else: return endpoint+"s"
 
+# References to generic endpoints (like an `educationOrganizationReference`) may be to any of several
+# endpoints, whose identity property corresponds to the reference's
+EDFI_GENERICS_TO_RESOURCES_MAPPING = {
+    "educationOrganizations": ["localEducationAgencies", "stateEducationAgencies", "schools"],
+}
+EDFI_GENERIC_REFS_TO_PROPERTIES_MAPPING = {
+    "educationOrganizationId": {
+        "localEducationAgencies": "localEducationAgencyId",
+        "stateEducationAgencies": "stateEducationAgencyId",
+        "schools": "schoolId",
+    },
+}
+
+# Converts (for example) `schoolReference` to `schools`, or `parentObjectiveAssessmentReference` to `objectiveAssessments`
+def resolve_reference_to_endpoint(referenceName):
+    endpoint = referenceName
+    # remove final "Reference"
+    if endpoint.endswith("Reference"):
+        endpoint = endpoint[:-1*len("Reference")]
+    # remove leading "parent" if whole endpoint name isn't just "parent"
+    # (this handles things like parentObjectiveAssessmentReference)
+    if endpoint.startswith("parent") and endpoint!="parent":
+        endpoint = endpoint[len("parent"):]
+        endpoint = endpoint[0].lower() + endpoint[1:]
+    return pluralize_endpoint(endpoint)
+
 # Takes a params structure and interpolates values from a (string) JSON payload
 def interpolate_params(params_structure, payload):
     params = {}
@@ -43,6 +73,99 @@ def interpolate_params(params_structure, payload):
         params[k] = value
     return params
 
+# Compiles a path (a tuple of keys, with "*" meaning "each item of the array at this point") into a
+# function which returns a list of (value, array indexes) for every value at that path in a payload
+def compile_path_accessor(path):
+    if "*" not in path:
+        def accessor(payload):
+            value = payload
+            for key in path:
+                if not isinstance(value, dict) or key not in value: return []
+                value = value[key]
+            return [(value, ())]
+        return accessor
+
+    def accessor(payload):
+        nodes = [(payload, ())]
+        for key in path:
+            next_nodes = []
+            for value, indexes in nodes:
+                if key=="*":
+                    if isinstance(value, list):
+                        next_nodes.extend((item, indexes+(i,)) for i, item in enumerate(value))
+                elif isinstance(value, dict) and key in value:
+                    next_nodes.append((value[key], indexes))
+            nodes = next_nodes
+        return nodes
+    return accessor
+
+# Returns a list of (value, path, array indexes) for every property anywhere in a payload whose name ends with
+# `suffix` (with paths as for `compile_path_accessor()`)
+def find_by_key_suffix(payload, suffix, path=(), indexes=()):
+    found = []
+    if isinstance(payload, dict):
+        for k, v in payload.items():
+            if k.endswith(suffix): found.append((v, path+(k,), indexes))
+            else: found.extend(find_by_key_suffix(v, suffix, path+(k,), indexes))
+    elif isinstance(payload, list):
+        for i, item in enumerate(payload):
+            found.extend(find_by_key_suffix(item, suffix, path+("*",), indexes+(i,)))
+    return found
+
+# Formats a path (see `compile_path_accessor()`) and array indexes like `studentAssessmentItems[0].assessmentItemReference`
+def format_path(path, indexes):
+    formatted = ""
+    indexes = iter(indexes)
+    for key in path:
+        if key=="*": formatted += f"[{next(indexes)}]"
+        else: formatted += ("." if formatted!="" else "") + key
+    return formatted
+
+# Opens a data file for reading (as text, or bytes if `binary`), decompressing it if it's compressed (like
+# `schools.jsonl.gz`)
+def open_data_file(file_name, binary=False):
+    if file_name.endswith(".gz"):
+        if binary: return gzip.open(file_name, "rb")
+        return gzip.open(file_name, "rt", encoding="utf-8")
+    if file_name.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError(f"reading {file_name} requires the `zstandard` package (`pip install lightbeam[zstd]`)")
+        # (a file may hold several zstd frames, as `fetch` writes them)
+        reader = zstandard.ZstdDecompressor().stream_reader(open(file_name, "rb"), read_across_frames=True, closefd=True)
+        if binary: return reader
+        return io.TextIOWrapper(reader, encoding="utf-8")
+    if binary: return open(file_name, "rb")
+    return open(file_name)
+
+COUNT_CHUNK_SIZE = 16 * 1024 * 1024 # bytes
+
+# Counts the records (lines, not counting any blank lines at the end) in a data file, by counting newlines a
+# chunk at a time; plain files are memory-mapped, compressed ones decompressed as they're read
+def count_records(file_name):
+    newlines = 0
+    trailing_newlines = 0 # (after the last non-whitespace byte)
+    has_records = False
+    with open_data_file(file_name, binary=True) as file:
+        mapped = not file_name.endswith((".gz", ".zst")) and os.path.getsize(file_name)>0
+        reader = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) if mapped else file
+        try:
+            while True:
+                chunk = reader.read(COUNT_CHUNK_SIZE)
+                if not chunk: break
+                newlines += chunk.count(b"\n")
+                content = chunk.rstrip()
+                if content:
+                    has_records = True
+                    trailing_newlines = chunk.count(b"\n", len(content))
+                else:
+                    trailing_newlines += chunk.count(b"\n")
+        finally:
+            if mapped: reader.close()
+    # (the last record may or may not end with a newline)
+    return newlines - trailing_newlines + 1 if has_records else 0
+
 def url_join(*args):
     return '/'.join(
         map(lambda x: str(x).rstrip('/'), filter(lambda x: x is not None, args))
@@ -1,9 +1,9 @@
+import os
 import json
-import requests
+import copy
+import time
 import asyncio, concurrent.futures
 from urllib.parse import urlencode
-from jsonschema import RefResolver
-from jsonschema import Draft4Validator
 
 from lightbeam import util
 from lightbeam import hashlog
@@ -15,24 +15,37 @@ class Validator:
     MAX_VALIDATE_TASK_QUEUE_SIZE = 100
     DEFAULT_VALIDATION_METHODS = ["schema", "descriptors", "uniqueness"]
 
-    EDFI_GENERICS_TO_RESOURCES_MAPPING = {
-        "educationOrganizations": ["localEducationAgencies", "stateEducationAgencies", "schools"],
-    }
-    EDFI_GENERIC_REFS_TO_PROPERTIES_MAPPING = {
-        "educationOrganizationId": {
-            "localEducationAgencies": "localEducationAgencyId",
-            "stateEducationAgencies": "stateEducationAgencyId",
-            "schools": "schoolId",
-        },
-    }
+    EDFI_GENERICS_TO_RESOURCES_MAPPING = util.EDFI_GENERICS_TO_RESOURCES_MAPPING
+    EDFI_GENERIC_REFS_TO_PROPERTIES_MAPPING = util.EDFI_GENERIC_REFS_TO_PROPERTIES_MAPPING
 
     def __init__(self, lightbeam=None):
         self.lightbeam = lightbeam
+        self.lightbeam.reset_counters()
         self.logger = self.lightbeam.logger
+        # (counted separately from `lightbeam.num_errors`, which a fused `validate+send` uses for failed POSTs)
+        self.num_failed = 0
         
     # Validates (selected) endpoints
     def validate(self):
+        endpoints_with_data = self.lightbeam.get_endpoints_with_data()
+        self.lightbeam.endpoints = self.lightbeam.api.apply_filters(endpoints_with_data)
+
+        self.prepare(self.lightbeam.endpoints)
+
+        for endpoint in self.lightbeam.endpoints:
+            asyncio.run(self.validate_endpoint(endpoint))
+        
+        # write structured output (if needed)
+        self.lightbeam.write_structured_output("validate")
+
+        if self.lightbeam.metadata["total_records_processed"] == self.lightbeam.metadata["total_records_failed"]:
+            self.logger.info("all payloads failed")
+            exit(1) # signal to downstream tasks (in Airflow) all payloads failed
 
+    # Loads config, Swagger, and descriptor values needed to validate `endpoints` (which should already be
+    # filtered to those with data, so only the descriptors they use are loaded)
+    # (also used by `Sender` for a fused `validate+send`)
+    def prepare(self, endpoints):
         # The below should go in __init__(), but rely on lightbeam.config which is not yet available there.
         self.fail_fast_threshold = self.lightbeam.config.get("validate",{}).get("references",{}).get("max_failures", None)
         self.validation_methods = self.lightbeam.config.get("validate",{}).get("methods",self.DEFAULT_VALIDATION_METHODS)
@@ -47,46 +60,39 @@ class Validator:
         if self.validation_references_behavior not in ["exclude", "include"]:
             self.logger.error(f"`config.validate.references.behavior` must be either `exclude` (default) or `include`)")
         self.validation_references_remote = self.lightbeam.config.get("validate",{}).get("references",{}).get("remote", True)
+        if self.lightbeam.offline: self.validation_references_remote = False
         if "references" in self.validation_methods and not self.validation_references_remote:
-            self.logger.info(f"(references will only be validated against local data, since `config.validate.references.remote: False`)")
+            reason = "`--offline`" if self.lightbeam.offline else "`config.validate.references.remote: False`"
+            self.logger.info(f"(references will only be validated against local data, since {reason})")
 
         self.lightbeam.api.load_swagger_docs()
         self.logger.info(f"validating by methods {self.validation_methods}...")
         if "descriptors" in self.validation_methods:
             # load remote descriptors
-            asyncio.run(self.lightbeam.api.load_descriptors_values())
+            asyncio.run(self.lightbeam.api.load_descriptors_values(endpoints))
             self.lightbeam.reset_counters()
             self.load_local_descriptors()
-        
-        endpoints_with_data = self.lightbeam.get_endpoints_with_data()
-        self.lightbeam.endpoints = self.lightbeam.api.apply_filters(endpoints_with_data)
+
+        # A payload which previously passed validation against the same Swagger and descriptor values
+        # need not be re-validated; these versions are stored with each payload hash (see `do_validate_payload()`)
+        self.cacheable_methods = tuple(sorted(x for x in self.validation_methods if x!="references"))
+        self.descriptors_version = ""
+        if "descriptors" in self.validation_methods:
+            self.descriptors_version = hashlog.get_hash_string(self.lightbeam.api.descriptor_values_version + json.dumps(self.local_descriptors))
+
+            # index of all valid (local or remote) descriptor values, like `uri://ed-fi.org/SomeDescriptor#SomeValue`
+            self.descriptor_index = set(value for values in self.lightbeam.api.descriptor_values.values() for value in values)
+            self.descriptor_index.update(
+                f"{descriptor.get('namespace', '')}#{descriptor.get('codeValue', '')}"
+                for descriptor in (self.local_descriptors or []) if type(descriptor)==dict)
 
         # structures for local and remote reference lookups to prevent repeated lookups for the same thing
         self.remote_reference_cache = {}
         self.local_reference_cache = {}
-
-        for endpoint in self.lightbeam.endpoints:
-            if "references" in self.validation_methods and "Descriptor" not in endpoint: # Descriptors have no references:
-                # We don't want every `do_validate_payload()` to separately have to open and scan
-                # local files looking for a matching payload; this pre-loads local data that
-                # might resolve references from within payloads of this endpoint.
-                # We assume that the data fits in memory; the largest Ed-Fi endpoints
-                # (studentSectionAssociations, studentSchoolAttendanceEvents, etc.) contain references
-                # to comparatively small datasets (sections, schools, students).
-                self.build_local_reference_cache(endpoint)
-            asyncio.run(self.validate_endpoint(endpoint))
-        
-        # write structured output (if needed)
-        self.lightbeam.write_structured_output("validate")
-
-        if self.lightbeam.metadata["total_records_processed"] == self.lightbeam.metadata["total_records_failed"]:
-            self.logger.info("all payloads failed")
-            exit(1) # signal to downstream tasks (in Airflow) all payloads failed
     
     def build_local_reference_cache(self, endpoint):
-        swagger = self.lightbeam.api.resources_swagger
-        definition = self.get_swagger_definition_for_endpoint(endpoint)
-        references_structure = self.load_references_structure(swagger, definition)
+        # (copied, since the rebalancing below changes it)
+        references_structure = copy.deepcopy(self.lightbeam.api.get_endpoint_plan(endpoint).references)
         references_structure = self.rebalance_local_references_structure(references_structure)
         # more memory-efficient to load local data and populate cache for one endpoint at a time:
         for original_endpoint in references_structure.keys():
@@ -127,7 +133,7 @@ class Validator:
         data = []
         data_files = self.lightbeam.get_data_files_for_endpoint(endpoint)
         for file_name in data_files:
-            with open(file_name) as file:
+            with util.open_data_file(file_name) as file:
                 for i, line in enumerate(file):
                     line_number = i + 1
                     line = line.strip()
@@ -145,101 +151,45 @@ class Validator:
                     data.append(ref_payload)
         return data
 
-    def load_references_structure(self, swagger, definition):
-        if "definitions" in swagger.keys():
-            schema = swagger["definitions"][definition]
-        elif "components" in swagger.keys() and "schemas" in swagger["components"].keys():
-            schema = swagger["components"]["schemas"][definition]
-        else:
-            self.logger.critical(f"Swagger contains neither `definitions` nor `components.schemas` - check that the Swagger is valid.")
-        references = {}
-        prefixes_to_remove = ["#/definitions/", "#/components/schemas/"]
-        for k in schema["properties"].keys():
-            if k.endswith("Reference"):
-                original_endpoint = self.resolve_reference_to_endpoint(k)
-
-                # this deals with the fact that an educationOrganizationReference may be to a school, LEA, etc.:
-                endpoints_to_check = self.EDFI_GENERICS_TO_RESOURCES_MAPPING.get(original_endpoint, [original_endpoint])
-                
-                for endpoint in endpoints_to_check:
-                    ref_definition = schema["properties"][k]["$ref"]
-                    for prefix_to_remove in prefixes_to_remove:
-                        ref_definition = ref_definition.replace(prefix_to_remove,"")
-                    # look up (in swagger) the required fields for any reference
-                    ref_properties = self.load_reference(swagger, ref_definition)
-                    references[endpoint] = ref_properties
-            elif "items" in schema["properties"][k].keys():
-                # this deals with a property which is a list of items which themselves contain References
-                # (example: studentAssessment.studentObjectiveAssessments contain an objectiveAssessmentReference)
-                nested_definition = schema["properties"][k]["items"]["$ref"]
-                for prefix_to_remove in prefixes_to_remove:
-                    nested_definition = nested_definition.replace(prefix_to_remove,"")
-                nested_references = self.load_references_structure(swagger, nested_definition)
-                references.update(nested_references)
-        return references
-
-    def load_reference(self, swagger, definition):
-        properties = []
-        if "definitions" in swagger.keys():
-            schema = swagger["definitions"][definition]
-        elif "components" in swagger.keys() and "schemas" in swagger["components"].keys():
-            schema = swagger["components"]["schemas"][definition]
-        else:
-            self.logger.critical(f"Swagger contains neither `definitions` nor `components.schemas` - check that the Swagger is valid.")
-        for k in schema["properties"].keys():
-            if k in schema.get("required",[]):
-                properties.append(k)
-        return properties
-
-    def get_swagger_definition_for_endpoint(self, endpoint):
-        return util.camel_case(self.lightbeam.get_namespace_for_endpoint(endpoint)) + "_" + util.singularize_endpoint(endpoint)
-    
     # Validates a single endpoint based on the Swagger docs
     async def validate_endpoint(self, endpoint):
+        # (only remote reference lookups make requests, so only they need a client)
+        if "references" in self.validation_methods and self.validation_references_remote:
+            async with self.lightbeam.open_client():
+                await self.do_validate_endpoint(endpoint)
+        else:
+            await self.do_validate_endpoint(endpoint)
+
+    async def do_validate_endpoint(self, endpoint):
         self.lightbeam.metadata["resources"].update({endpoint: {}})
-        definition = self.get_swagger_definition_for_endpoint(endpoint)
+        definition = self.lightbeam.api.get_endpoint_plan(endpoint).definition
         data_files = self.lightbeam.get_data_files_for_endpoint(endpoint)
         tasks = []
         total_counter = 0
-        self.lightbeam.num_errors = 0
         self.lightbeam.metadata["resources"][endpoint].update({
             "records_processed": 0,
             "records_skipped": 0,
             "records_failed": 0
         })
-        # structures to support testing uniqueness accross payloads:
-        definition = self.get_swagger_definition_for_endpoint(endpoint)
-        if "Descriptor" in endpoint:
-            swagger = self.lightbeam.api.descriptors_swagger
-        else:
-            swagger = self.lightbeam.api.resources_swagger
-            
-        if "definitions" in swagger.keys():
-            resource_schema = swagger["definitions"][definition]
-        elif "components" in swagger.keys() and "schemas" in swagger["components"].keys():
-            resource_schema = swagger["components"]["schemas"][definition]
-        else:
-            self.logger.critical(f"Swagger contains neither `definitions` nor `components.schemas` - check that the Swagger is valid.")
-        self.uniqueness_hashes = { endpoint: [] }
-        self.identity_params_structures = {}
-        self.schema_resolver = RefResolver("test", swagger, swagger)
-        self.schema_validator = Draft4Validator(resource_schema, resolver=self.schema_resolver)
-        
+        self.prepare_endpoint(endpoint)
+
         for file_name in data_files:
             self.logger.info(f"validating {file_name} against {definition} schema...")
             file_counter = 0
-            with open(file_name) as file:
+            with util.open_data_file(file_name) as file:
                 for i, line in enumerate(file):
                     line_number = i + 1
                     total_counter += 1
                     file_counter += 1
                     data = line.strip()
+                    data_hash = hashlog.get_hash(data)
                         
                     tasks.append(asyncio.create_task(
-                        self.do_validate_payload(endpoint, file_name, data, line_number)))
+                        self.do_validate_payload(endpoint, file_name, data, line_number, data_hash)))
                 
                     if len(tasks) >= self.MAX_VALIDATE_TASK_QUEUE_SIZE:
-                        await self.lightbeam.do_tasks(tasks, total_counter, log_status_counts=False)
+                        # (any client needed is already open - see `validate_endpoint()` - so this needn't use `do_tasks()`)
+                        await asyncio.wait(tasks)
                         tasks = []
                         if total_counter%1000==0:
                             self.logger.info(f"(processed {total_counter}...)")
@@ -247,89 +197,194 @@ class Validator:
                     # update metadata counts
                     self.lightbeam.metadata["resources"][endpoint]["records_processed"] = total_counter
                     self.lightbeam.metadata["resources"][endpoint]["records_skipped"] = self.lightbeam.num_skipped
-                    self.lightbeam.metadata["resources"][endpoint]["records_failed"] = self.lightbeam.num_errors
+                    self.lightbeam.metadata["resources"][endpoint]["records_failed"] = self.num_failed
                     
                     # implement "fail fast" feature:
-                    if self.fail_fast_threshold is not None and self.lightbeam.num_errors >= self.fail_fast_threshold:
+                    if self.fail_fast_threshold is not None and self.num_failed >= self.fail_fast_threshold:
                         self.lightbeam.shutdown("validate")
-                        self.logger.critical(f"... STOPPING; found {self.lightbeam.num_errors} >= validate.references.max_failures={self.fail_fast_threshold} VALIDATION ERRORS.")
+                        self.logger.critical(f"... STOPPING; found {self.num_failed} >= validate.references.max_failures={self.fail_fast_threshold} VALIDATION ERRORS.")
                         break
 
-            if len(tasks)>0: await self.lightbeam.do_tasks(tasks, total_counter, log_status_counts=False)
+            if len(tasks)>0: await asyncio.wait(tasks)
 
             # update metadata counts
             self.lightbeam.metadata["resources"][endpoint]["records_processed"] = total_counter
             self.lightbeam.metadata["resources"][endpoint]["records_skipped"] = self.lightbeam.num_skipped
-            self.lightbeam.metadata["resources"][endpoint]["records_failed"] = self.lightbeam.num_errors
+            self.lightbeam.metadata["resources"][endpoint]["records_failed"] = self.num_failed
             
-            if self.lightbeam.num_errors==0: self.logger.info(f"... all lines validate ok!")
+            if self.num_failed==0: self.logger.info(f"... all lines validate ok!")
             else:
-                num_others = self.lightbeam.num_errors - self.MAX_VALIDATION_ERRORS_TO_DISPLAY
-                if self.lightbeam.num_errors > self.MAX_VALIDATION_ERRORS_TO_DISPLAY:
+                num_others = self.num_failed - self.MAX_VALIDATION_ERRORS_TO_DISPLAY
+                if self.num_failed > self.MAX_VALIDATION_ERRORS_TO_DISPLAY:
                     self.logger.warn(f"... and {num_others} others!")
-                self.logger.warn(f"... VALIDATION ERRORS on {self.lightbeam.num_errors} of {file_counter} lines in {file_name}; see details above.")
+                self.logger.warn(f"... VALIDATION ERRORS on {self.num_failed} of {file_counter} lines in {file_name}; see details above.")
+
+        self.finish_endpoint(endpoint, total_counter)
+
+    # Sets up the schema validator, uniqueness tracking, and validation hashlog for a single endpoint
+    def prepare_endpoint(self, endpoint):
+        if "references" in self.validation_methods and "Descriptor" not in endpoint: # Descriptors have no references:
+            # We don't want every `do_validate_payload()` to separately have to open and scan
+            # local files looking for a matching payload; this pre-loads local data that
+            # might resolve references from within payloads of this endpoint.
+            # We assume that the data fits in memory; the largest Ed-Fi endpoints
+            # (studentSectionAssociations, studentSchoolAttendanceEvents, etc.) contain references
+            # to comparatively small datasets (sections, schools, students).
+            self.build_local_reference_cache(endpoint)
+
+        plan = self.lightbeam.api.get_endpoint_plan(endpoint)
+        definition = plan.definition
+        if plan.swagger_type=="descriptors":
+            swagger = self.lightbeam.api.descriptors_swagger
+        else:
+            swagger = self.lightbeam.api.resources_swagger
+            
+        if "definitions" in swagger.keys():
+            resource_schema = swagger["definitions"][definition]
+        elif "components" in swagger.keys() and "schemas" in swagger["components"].keys():
+            resource_schema = swagger["components"]["schemas"][definition]
+        else:
+            self.logger.critical(f"Swagger contains neither `definitions` nor `components.schemas` - check that the Swagger is valid.")
+        # number of payloads which failed validation:
+        self.num_failed = 0
+        # structures to support testing uniqueness accross payloads:
+        self.uniqueness_hashes = { endpoint: set() }
+        # accessors for the properties where descriptor values can occur:
+        self.descriptor_accessors = [ (path, util.compile_path_accessor(path)) for path in plan.descriptor_paths ]
+        self.descriptor_paths = set(plan.descriptor_paths)
+        self.unchecked_descriptor_properties = set()
+        from jsonschema import RefResolver, Draft4Validator # (only needed to validate)
+        self.schema_resolver = RefResolver("test", swagger, swagger)
+        self.schema_validator = Draft4Validator(resource_schema, resolver=self.schema_resolver)
+
+        # load the validation hashlog (payloads which previously passed validation)
+        self.swagger_version = definition + ":" + self.lightbeam.api.swagger_versions.get(plan.swagger_type, "")
+        self.validation_hashlog_data = {}
+        self.new_validation_hashlog_data = {}
+        self.num_cached = 0
+        if self.lightbeam.track_state:
+            if not self.lightbeam.force:
+                self.validation_hashlog_data = hashlog.load(self.get_validation_hashlog_file(endpoint))
+
+    # Saves the validation hashlog and frees memory used to validate a single endpoint
+    def finish_endpoint(self, endpoint, total_counter):
+        if self.num_cached>0:
+            self.logger.info(f"(re-used previous validation results for {self.num_cached} of {total_counter} payloads)")
+
+        # save only the payloads seen on this run, so the validation hashlog doesn't grow indefinitely
+        if self.lightbeam.track_state:
+            hashlog.save(self.get_validation_hashlog_file(endpoint), self.new_validation_hashlog_data)
         
         # free up some memory
         self.uniqueness_hashes = {}
-        self.identity_params_structures = {}
+        self.descriptor_accessors = []
+        self.descriptor_paths = set()
         self.schema_resolver = None
         self.schema_validator = None
+        self.validation_hashlog_data = {}
+        self.new_validation_hashlog_data = {}
+
+    def get_validation_hashlog_file(self, endpoint):
+        return os.path.join(self.lightbeam.config["state_dir"], "validate", f"{endpoint}.dat")
+
+    # Validates a single payload; returns whether it is valid
+    async def do_validate_payload(self, endpoint, file_name, data, line_number, data_hash=None):
+        if self.fail_fast_threshold is not None and self.num_failed >= self.fail_fast_threshold: return False
+
+        # check if this exact payload previously passed validation (under the same Swagger and descriptor values)
+        is_cached = self.is_previously_validated(data_hash)
+        if is_cached and "uniqueness" in self.validation_methods:
+            identity_hash = self.validation_hashlog_data[data_hash][4]
+            if identity_hash in self.uniqueness_hashes[endpoint]:
+                # a duplicate of another payload on this run; fully re-validate to report the error
+                is_cached = False
+            else:
+                self.uniqueness_hashes[endpoint].add(identity_hash)
+        payload = None
 
-
-    async def do_validate_payload(self, endpoint, file_name, data, line_number):
-        if self.fail_fast_threshold is not None and self.lightbeam.num_errors >= self.fail_fast_threshold: return
-        
-        # check payload is valid JSON
-        try:
-            payload = json.loads(data)
-        except Exception as e:
-            self.log_validation_error(endpoint, file_name, line_number, "json", f"invalid JSON {str(e).replace(' line 1','')}")
-            return
-
-        # check payload obeys Swagger schema
-        if "schema" in self.validation_methods:
+        is_valid = True
+        if is_cached:
+            self.num_cached += 1
+            self.new_validation_hashlog_data[data_hash] = self.validation_hashlog_data[data_hash]
+        else:
+            # check payload is valid JSON
             try:
-                self.schema_validator.validate(payload)
+                payload = json.loads(data)
             except Exception as e:
-                e_path = [str(x) for x in list(e.path)]
-                context = ""
-                if len(e_path)>0: context = " in " + " -> ".join(e_path)
-                self.log_validation_error(endpoint, file_name, line_number, "schema", f"{str(e.message)} {context}")
-                return
+                self.log_validation_error(endpoint, file_name, line_number, "json", f"invalid JSON {str(e).replace(' line 1','')}")
+                return False
+
+            # check payload obeys Swagger schema
+            if "schema" in self.validation_methods:
+                try:
+                    self.schema_validator.validate(payload)
+                except Exception as e:
+                    e_path = [str(x) for x in list(e.path)]
+                    context = ""
+                    if len(e_path)>0: context = " in " + " -> ".join(e_path)
+                    self.log_validation_error(endpoint, file_name, line_number, "schema", f"{str(e.message)} {context}")
+                    return False
 
-        # check descriptor values are valid
-        if "descriptors" in self.validation_methods:
-            error_message = self.has_invalid_descriptor_values(payload, path="")
-            if error_message != "":
-                self.log_validation_error(endpoint, file_name, line_number, "descriptors", error_message)
-                return
-
-        # check natural keys are unique
-        if not self.identity_params_structures.get(endpoint, False):
-            self.identity_params_structures[endpoint] = self.lightbeam.api.get_params_for_endpoint(endpoint, type='identity')
-        if "uniqueness" in self.validation_methods:
-            error_message = self.violates_uniqueness(endpoint, payload, path="")
-            if error_message != "":
-                self.log_validation_error(endpoint, file_name, line_number, "uniqueness", error_message)
+            # check descriptor values are valid
+            if "descriptors" in self.validation_methods:
+                error_message = self.has_invalid_descriptor_values(payload, data)
+                if error_message != "":
+                    self.log_validation_error(endpoint, file_name, line_number, "descriptors", error_message)
+                    return False
+
+            # check natural keys are unique
+            identity_hash = None
+            if "uniqueness" in self.validation_methods:
+                error_message = self.violates_uniqueness(endpoint, payload, path="")
+                if error_message != "":
+                    self.log_validation_error(endpoint, file_name, line_number, "uniqueness", error_message)
+                    data_hash = None # (don't remember this payload as valid)
+                    is_valid = False
+                else:
+                    identity_hash = self.get_identity_hash(endpoint, payload)
+
+            # remember that this payload passed validation
+            if self.lightbeam.track_state and data_hash is not None:
+                self.new_validation_hashlog_data[data_hash] = (
+                    round(time.time()),
+                    self.cacheable_methods,
+                    self.swagger_version,
+                    self.descriptors_version,
+                    identity_hash,
+                )
             
         # check references values are valid
+        # (these depend on local and remote data, which may have changed since a previous validation, so are always checked)
         if "references" in self.validation_methods and "Descriptor" not in endpoint: # Descriptors have no references
-            self.lightbeam.api.do_oauth()
-            error_message = self.has_invalid_references(endpoint, payload, path="")
+            if payload is None: payload = json.loads(data)
+            error_message = await self.has_invalid_references(endpoint, payload, path="")
             if error_message != "":
                 self.log_validation_error(endpoint, file_name, line_number, "references", error_message)
-                
+                is_valid = False
+
+        return is_valid
+
+    # Determines whether a payload (hash) previously passed validation with the current validation
+    # methods, Swagger, and descriptor values (in which case it need not be re-validated)
+    def is_previously_validated(self, data_hash):
+        if data_hash is None or data_hash not in self.validation_hashlog_data: return False
+        _, methods, swagger_version, descriptors_version, _ = self.validation_hashlog_data[data_hash]
+        return (
+            set(self.cacheable_methods).issubset(methods)
+            and swagger_version==self.swagger_version
+            and ("descriptors" not in self.cacheable_methods or descriptors_version==self.descriptors_version)
+        )
                 
     def log_validation_error(self, endpoint, file_name, line_number, method, message):
-        if self.lightbeam.num_errors < self.MAX_VALIDATION_ERRORS_TO_DISPLAY:
+        if self.num_failed < self.MAX_VALIDATION_ERRORS_TO_DISPLAY:
             self.logger.warning(f"... VALIDATION ERROR ({method} at line {line_number}): {message}")
-        self.lightbeam.num_errors += 1
+        self.num_failed += 1
 
         # update run metadata...
         failures = self.lightbeam.metadata["resources"][endpoint].get("failures", [])
         do_append = True
         for index, item in enumerate(failures):
-            if item["method"]==method and item["message"]==message and item["file"]==file_name:
+            if item.get("method")==method and item["message"]==message and item["file"]==file_name:
                 failures[index]["line_numbers"].append(line_number)
                 failures[index]["count"] += 1
                 do_append = False
@@ -344,27 +399,29 @@ class Validator:
             failures.append(failure)
         self.lightbeam.metadata["resources"][endpoint]["failures"] = failures
     
+    def get_identity_hash(self, endpoint, payload):
+        identity_params = self.lightbeam.api.get_endpoint_plan(endpoint).identity_params
+        return hashlog.get_hash(json.dumps(util.interpolate_params(identity_params, payload)))
+
     def violates_uniqueness(self, endpoint, payload, path=""):
-        params = json.dumps(util.interpolate_params(self.identity_params_structures[endpoint], payload))
+        plan = self.lightbeam.api.get_endpoint_plan(endpoint)
+        return self.has_duplicate_identity(payload, plan.identity_params, plan.array_identities, self.uniqueness_hashes[endpoint], path)
+
+    # Checks a payload's identity against those already seen (`hashes`), then (recursively) checks
+    # uniqueness of items in its arrays (returns an error message or empty string)
+    def has_duplicate_identity(self, payload, identity_params, array_identities, hashes, path=""):
+        params = json.dumps(util.interpolate_params(identity_params, payload))
         params_hash = hashlog.get_hash(params)
-        if params_hash in self.uniqueness_hashes[endpoint]:
+        if params_hash in hashes:
             return f"duplicate value(s) for identity key(s): " + ("(at "+path+"): " if path!="" else ": ") + f"{params}"
-        else:
-            self.uniqueness_hashes[endpoint].append(params_hash)
-            # (recursively) check uniqueness of items in arrays
-            swagger = self.lightbeam.api.resources_swagger
-            endpoint_def = util.get_swagger_ref_for_endpoint(self.lightbeam.config.get('namespace', ''), swagger, endpoint)
-            for k in payload.keys():
-                if isinstance(payload[k], list):
-                    subarray_definition = util.resolve_swagger_ref(swagger, endpoint_def)
-                    if subarray_definition:
-                        subarray_ref = subarray_definition['properties'][k].get('items',{}).get('$ref','')
-                        if not self.identity_params_structures.get(subarray_ref, False):
-                            self.identity_params_structures[subarray_ref] = self.lightbeam.api.get_identity_params_from_swagger(swagger, subarray_ref)
-                        self.uniqueness_hashes[subarray_ref] = []
-                        for i in range(0, len(payload[k])):
-                            value = self.violates_uniqueness(subarray_ref, payload[k][i], path+("." if path!="" else "") + f"{k}[{i}]")
-                            if value!="": return value
+        hashes.add(params_hash)
+        for k, item_structure in array_identities.items():
+            items = payload.get(k, None)
+            if not isinstance(items, list): continue
+            item_hashes = set()
+            for i in range(0, len(items)):
+                value = self.has_duplicate_identity(items[i], item_structure["identity"], item_structure["arrays"], item_hashes, path+("." if path!="" else "") + f"{k}[{i}]")
+                if value!="": return value
         return ""
 
     
@@ -375,48 +432,54 @@ class Validator:
         for descriptor in descriptor_endpoints:
             data_files = self.lightbeam.get_data_files_for_endpoint(descriptor)
             for file_name in data_files:
-                with open(file_name) as file:
+                with util.open_data_file(file_name) as file:
                     # process each line
                     for line in file:
                         local_descriptors.append(json.loads(line.strip()))
         self.local_descriptors = local_descriptors
     
-    # Validates descriptor values for a single payload (returns an error message or empty string)
-    def has_invalid_descriptor_values(self, payload, path=""):
-        for k in payload.keys():
-            if isinstance(payload[k], dict):
-                value = self.has_invalid_descriptor_values(payload[k], path+("." if path!="" else "")+k)
-                if value!="": return value
-            elif isinstance(payload[k], list):
-                for i in range(0, len(payload[k])):
-                    value = self.has_invalid_descriptor_values(payload[k][i], path+("." if path!="" else "") + f"{k}[{i}]")
-                    if value!="": return value
-            elif isinstance(payload[k], str) and k.endswith("Descriptor"):
-                if "#" not in payload[k]:
-                    return payload[k] + f" is not a valid descriptor value for {k}" + (" (at " + path + ")" if path!="" else "") + "; format should be like `uri://namespace.org/SomeDescriptor#SomeValue`"
-                namespace = payload[k].split("#")[0]
-                codeValue = payload[k].split("#")[1]
-                # check if it's a local descriptor:
-                matching_local_descriptors = list(filter(lambda descriptor:
-                                                            type(descriptor)==dict
-                                                            and descriptor.get("namespace", "")==namespace
-                                                            and descriptor.get("codeValue", "")==codeValue
-                                                         , self.local_descriptors or []))
-                if len(matching_local_descriptors)>0: return ""
-                # check if it's a remote descriptor:
-                if not self.is_valid_descriptor_value(namespace, codeValue):
-                    return payload[k] + f" is not a valid descriptor value for {k}" + (" (at " + path + ")" if path!="" else "")
-        return ""
+    # Validates descriptor values for a single payload, given also as its JSON `data` (returns an error message
+    # or empty string)
+    def has_invalid_descriptor_values(self, payload, data):
+        # gather the values at each path where the Swagger says descriptors can occur...
+        found = []
+        for path, accessor in self.descriptor_accessors:
+            for value, indexes in accessor(payload):
+                if isinstance(value, str): found.append((value, path, indexes))
+        # ... and, if the payload has more properties named like `...Descriptor` than that (which is quick to count
+        # in its JSON), those elsewhere (like in extensions the Swagger doesn't describe)
+        if data.count('Descriptor"') > len(found):
+            for value, path, indexes in util.find_by_key_suffix(payload, "Descriptor"):
+                if path in self.descriptor_paths or not isinstance(value, str): continue
+                # (only the values of descriptors the endpoint's Swagger-described properties can hold are loaded;
+                # see `EdFiAPI.get_descriptor_endpoints()`)
+                if not any(self.lightbeam.api.descriptor_matches_property(descriptor, path[-1]) for descriptor in self.lightbeam.api.descriptor_values):
+                    if path[-1] not in self.unchecked_descriptor_properties:
+                        self.logger.warning(f"(values of {path[-1]} aren't validated, since the Swagger doesn't describe it, and its descriptor's values weren't loaded)")
+                        self.unchecked_descriptor_properties.add(path[-1])
+                    continue
+                found.append((value, path, indexes))
+        if not found: return ""
+        # ... and check them all at once against the index of valid values
+        invalid_values = set(x[0] for x in found).difference(self.descriptor_index)
+        if not invalid_values: return ""
+        for value, path, indexes in found:
+            if value in invalid_values:
+                location = util.format_path(path[:-1], indexes)
+                message = value + f" is not a valid descriptor value for {path[-1]}" + (" (at " + location + ")" if location!="" else "")
+                if "#" not in value:
+                    message += "; format should be like `uri://namespace.org/SomeDescriptor#SomeValue`"
+                return message
 
     # Validates descriptor values for a single payload (returns an error message or empty string)
-    def has_invalid_references(self, endpoint, payload, path=""):
+    async def has_invalid_references(self, endpoint, payload, path=""):
         for k in payload.keys():
             if isinstance(payload[k], dict) and not k.endswith("Reference"):
-                value = self.has_invalid_references(endpoint, payload[k], path+("." if path!="" else "")+k)
+                value = await self.has_invalid_references(endpoint, payload[k], path+("." if path!="" else "")+k)
                 if value!="": return value
             elif isinstance(payload[k], list):
                 for i in range(0, len(payload[k])):
-                    value = self.has_invalid_references(endpoint, payload[k][i], path+("." if path!="" else "")+k+"["+str(i)+"]")
+                    value = await self.has_invalid_references(endpoint, payload[k][i], path+("." if path!="" else "")+k+"["+str(i)+"]")
                     if value!="": return value
             elif isinstance(payload[k], dict) and k.endswith("Reference"):
                 check_this_reference = (
@@ -443,7 +506,7 @@ class Validator:
                 if not is_valid_reference and self.validation_references_remote: # not found in local data...
                     for endpt in endpoints_to_check:
                         # check if it's a remote reference:
-                        value = self.remote_reference_exists(endpt, params)
+                        value = await self.remote_reference_exists(endpt, params)
                         if value:
                             is_valid_reference = True
                             break
@@ -451,25 +514,7 @@ class Validator:
                     return f"payload contains an invalid {k} " + (" (at "+path+"): " if path!="" else ": ") + json.dumps(params)
         return ""
 
-    @staticmethod
-    def resolve_reference_to_endpoint(referenceName):
-        endpoint = referenceName
-        # remove final "Reference"
-        if endpoint.endswith("Reference"):
-            endpoint = endpoint[:-1*len("Reference")]
-        # remove leading "parent" if whole endpoint name isn't just "parent"
-        # (this handles things like parentObjectiveAssessmentReference)
-        if endpoint.startswith("parent") and endpoint!="parent":
-            endpoint = endpoint[len("parent"):]
-            endpoint = endpoint[0].lower() + endpoint[1:]
-        return util.pluralize_endpoint(endpoint)
-
-    # Tells you if a specified descriptor value is valid or not
-    def is_valid_descriptor_value(self, namespace, codeValue):
-        for row in self.lightbeam.api.descriptor_values:
-            if row[1]==namespace and row[2]==codeValue:
-                return True
-        return False
+    resolve_reference_to_endpoint = staticmethod(util.resolve_reference_to_endpoint)
 
     @staticmethod
     def get_cache_key(payload):
@@ -480,38 +525,32 @@ class Validator:
             cache_key += f"{payload[k]}~~~"
         return cache_key
     
-    def remote_reference_exists(self, endpoint, params):
+    # Looks up (with the shared client, so a fused `validate+send`'s POSTs keep going meanwhile) whether a
+    # referenced record exists in the API
+    async def remote_reference_exists(self, endpoint, params):
         # check cache:
         if endpoint not in self.remote_reference_cache.keys():
             self.remote_reference_cache[endpoint] = []
         cache_key = self.get_cache_key(params)
         if cache_key in self.remote_reference_cache[endpoint]:
             return True
-        # print(f"remote reference lookup to {endpoint} for {params}")
         # do remote lookup
         curr_token_version = int(str(self.lightbeam.token_version))
-        while True: # this is not great practice, but an effective way (along with the `break` below) to achieve a do:while loop
+        while True: # this is not great practice, but an effective way (along with the `return`s below) to achieve a do:while loop
             try:
                 # send GET request
-                response = requests.get(
+                async with self.lightbeam.api.client.get(
                     util.url_join(self.lightbeam.api.config["data_url"], self.lightbeam.get_namespace_for_endpoint(endpoint), endpoint),
-                    params=params,
-                    verify=self.lightbeam.config["connection"]["verify_ssl"],
-                    headers=self.lightbeam.api.headers
-                    )
-                body = response.text
-                status = str(response.status_code)
-                if status!='401':
-                    self.lightbeam.increment_status_counts(status)
+                    params={k: str(v) for k,v in params.items()},
+                    ssl=self.lightbeam.config["connection"]["verify_ssl"],
+                    headers=await self.lightbeam.api.get_headers()
+                    ) as response:
+                    body = await response.text()
+                    status = str(response.status)
+                # (not counted in `lightbeam.status_counts`, which in a fused `validate+send` are those of POSTs)
                 if status=='401':
-                    # this could be broken out to a separate function call,
-                    # but not doing so should help keep the critical section small
-                    if self.lightbeam.token_version == curr_token_version:
-                        self.lightbeam.lock.acquire()
-                        self.lightbeam.api.update_oauth()
-                        self.lightbeam.lock.release()
-                    else:
-                        pass # await asyncio.sleep(1)
+                    # refresh the token (unless another task already did)
+                    await self.lightbeam.api.refresh_oauth(curr_token_version)
                     curr_token_version = int(str(self.lightbeam.token_version))
                 elif status=='404' or status=='400':
                     return False
@@ -524,13 +563,10 @@ class Validator:
                         return True
                     else: return False
                 else:
-                    print(f"Status: {status}")
-                    print(f"Body: {body}")
                     self.logger.warn(f"Unable to resolve reference for {endpoint}... API returned {status} status.")
                     return False
 
             except RuntimeError as e:
-                pass # await asyncio.sleep(1)
+                await asyncio.sleep(1)
             except Exception as e:
                 self.logger.critical(f"Unable to resolve reference for {endpoint} from API... terminating. Check API connectivity.")
-
@@ -0,0 +1,231 @@
+import os
+import glob
+import time
+import zlib
+import queue
+import shutil
+import asyncio
+import threading
+
+
+# Compresses the data written to a file as a series of gzip members or zstd frames (which decompress as one
+# stream); `finish()` ends the current one, after which everything written so far is complete - so the file
+# may later be truncated back to that point and appended to.
+class Compressor:
+
+    EXTENSIONS = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+    def __init__(self, compression):
+        self.compression = compression
+        self.compressobj = None
+        if compression=="zstd":
+            import zstandard # (optional: `pip install lightbeam[zstd]`)
+            self.zstd_compressor = zstandard.ZstdCompressor()
+
+    def compress(self, data):
+        if self.compression is None: return data
+        if self.compressobj is None:
+            if self.compression=="gzip": self.compressobj = zlib.compressobj(wbits=31) # (31: gzip format)
+            else: self.compressobj = self.zstd_compressor.compressobj()
+        return self.compressobj.compress(data)
+
+    def finish(self):
+        if self.compressobj is None: return b""
+        data = self.compressobj.flush()
+        self.compressobj = None
+        return data
+
+
+# Writes the fetched records of one endpoint to a file, from a background thread (so disk I/O and
+# compression don't block requests). Records arrive as pages, which may complete in any order; they are
+# written in order.
+#
+# A writer has one or more `streams` of pages; stream 0 is written straight to the file, while later
+# streams are spooled to segment files which are appended (in order) when the writer is closed. (With
+# offset paging there's a single stream of pages; with cursor paging, each partition is a stream.)
+#
+# Output may be `compression`-ed (with `gzip` or `zstd`), and may be split into shards of up to
+# `shard_records` records and/or `shard_bytes` (uncompressed) bytes: `schools/part.jsonl` is then written
+# as `schools/part-00000.jsonl`, `schools/part-00001.jsonl`, and so on. (Each stream is split separately,
+# and the shards of all streams are numbered in order when the writer is closed.)
+#
+# Everything is written to temporary files, which are only renamed into place once complete. Every
+# `CHECKPOINT_INTERVAL` seconds, the progress of each stream - the number of pages written, an optional
+# `checkpoint` value passed with its last page (like the token for its next page), and its position in its
+# current file - is passed to `on_checkpoint()` (in the event loop), so an interrupted writer can later be
+# resumed from it.
+class EndpointWriter:
+
+    CHECKPOINT_INTERVAL = 1 # seconds
+
+    def __init__(self, file_name, compression=None, shard_records=None, shard_bytes=None):
+        self.file_name = file_name
+        self.compression = compression
+        self.extension = Compressor.EXTENSIONS[compression]
+        self.shard_records = shard_records
+        self.shard_bytes = shard_bytes
+        self.sharded = bool(shard_records or shard_bytes)
+
+    # Starts writing; when resuming, `resume_from` is the progress of each stream (see above)
+    def start(self, num_streams=1, resume_from=None, on_checkpoint=None):
+        self.num_streams = num_streams
+        self.on_checkpoint = on_checkpoint
+        self.loop = asyncio.get_running_loop()
+        self.queue = queue.Queue()
+        self.error = None
+        # the progress of each stream, as of the last checkpoint:
+        self.progress = [ dict(progress) if progress else None for progress in resume_from ] if resume_from else [ None ] * num_streams
+        # the file, compressor, and (current) progress of each stream being written, in the thread:
+        self.streams = {}
+        # pages that arrived before the preceding page(s) of their stream, and the next page index of each stream:
+        self.pending = [ {} for _ in range(num_streams) ]
+        self.next_index = [ progress["pages"] if progress else 0 for progress in self.progress ]
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Returns whether writing can be resumed from `resume_from` (only if its temporary files are still there)
+    def can_resume(self, resume_from):
+        return all(
+            os.path.isfile(self.get_temp_file_name(stream, shard))
+            for stream, progress in enumerate(resume_from) if progress
+            for shard in range(progress["shard"] + 1)
+        )
+
+    # Queues the (bytes) `data` of page number `index` of a stream to be written; `on_written` is called
+    # (in the event loop) once it has been
+    def write(self, stream, index, data, on_written=None, checkpoint=None):
+        pending = self.pending[stream]
+        pending[index] = (data, on_written, checkpoint)
+        while self.next_index[stream] in pending:
+            data, on_written, checkpoint = pending.pop(self.next_index[stream])
+            self.queue.put((stream, data, on_written, checkpoint))
+            self.next_index[stream] += 1
+
+    # Waits for all queued pages to be written, then closes the file(s) and renames them into place
+    async def close(self):
+        self.queue.put(None)
+        await self.loop.run_in_executor(None, self.thread.join)
+        if self.error: raise self.error
+
+    # The (final) name of the file, or of shard number `shard` of it
+    def get_output_file_name(self, shard=None):
+        if shard is None: return self.file_name + self.extension
+        root, extension = os.path.splitext(self.file_name)
+        return f"{root}-{shard:05d}{extension}{self.extension}"
+
+    def get_temp_file_name(self, stream, shard=0):
+        if self.sharded:
+            return f"{self.get_output_file_name(shard)}.tmp.segment{stream}"
+        return self.get_output_file_name() + ".tmp" + (f".segment{stream}" if stream>0 else "")
+
+    # Opens the current file of a stream; when resuming, anything written after its last checkpoint is discarded
+    def open_stream(self, stream):
+        progress = self.progress[stream]
+        if progress is None:
+            progress = {"pages": 0, "checkpoint": None, "shard": 0, "bytes": 0, "records": 0, "size": 0}
+            file = open(self.get_temp_file_name(stream), "w+b")
+        else:
+            progress = dict(progress)
+            file = open(self.get_temp_file_name(stream, progress["shard"]), "r+b")
+            file.truncate(progress["bytes"])
+            file.seek(0, os.SEEK_END)
+        self.streams[stream] = {"file": file, "compressor": Compressor(self.compression), "progress": progress}
+
+    def write_stream(self, stream, data):
+        current = self.streams[stream]
+        progress = current["progress"]
+        if self.sharded:
+            # (start a new shard wherever the current one would exceed `shard_records` or `shard_bytes`)
+            lines = data.splitlines(keepends=True)
+            start = 0
+            for i, line in enumerate(lines):
+                if progress["records"]>0 and (
+                    (self.shard_records and progress["records"]>=self.shard_records)
+                    or (self.shard_bytes and progress["size"]+len(line)>self.shard_bytes)
+                ):
+                    current["file"].write(current["compressor"].compress(b"".join(lines[start:i])))
+                    current["file"].write(current["compressor"].finish())
+                    current["file"].close()
+                    progress.update({"shard": progress["shard"] + 1, "records": 0, "size": 0})
+                    current["file"] = open(self.get_temp_file_name(stream, progress["shard"]), "w+b")
+                    start = i
+                progress["records"] += 1
+                progress["size"] += len(line)
+            data = b"".join(lines[start:])
+        current["file"].write(current["compressor"].compress(data))
+
+    def checkpoint(self):
+        for stream, current in self.streams.items():
+            # (end the current gzip member or zstd frame, so the file is complete up to here)
+            current["file"].write(current["compressor"].finish())
+            current["file"].flush()
+            current["progress"]["bytes"] = current["file"].tell()
+            self.progress[stream] = dict(current["progress"])
+        if self.on_checkpoint:
+            self.loop.call_soon_threadsafe(self.on_checkpoint, [ dict(progress) if progress else None for progress in self.progress ])
+
+    def run(self):
+        item = ()
+        try:
+            for stream in range(self.num_streams):
+                if (stream==0 and not self.sharded) or self.progress[stream] is not None:
+                    self.open_stream(stream)
+            last_checkpoint = time.monotonic()
+            while True:
+                item = self.queue.get()
+                if item is None: break
+                stream, data, on_written, checkpoint = item
+                if stream not in self.streams:
+                    self.open_stream(stream)
+                self.write_stream(stream, data)
+                self.streams[stream]["progress"]["pages"] += 1
+                self.streams[stream]["progress"]["checkpoint"] = checkpoint
+                if on_written: self.loop.call_soon_threadsafe(on_written)
+                if time.monotonic() - last_checkpoint >= self.CHECKPOINT_INTERVAL:
+                    self.checkpoint()
+                    last_checkpoint = time.monotonic()
+            for current in self.streams.values():
+                current["file"].write(current["compressor"].finish())
+                current["file"].close()
+            if self.sharded: self.place_shards()
+            else: self.place_file()
+        except Exception as e:
+            self.error = e
+            # (keep releasing pages' callbacks, so requests waiting on them don't hang)
+            while item is not None:
+                if item and item[2]: self.loop.call_soon_threadsafe(item[2])
+                item = self.queue.get()
+        finally:
+            for current in self.streams.values():
+                current["file"].close()
+
+    # Appends the spooled streams (in order) to the file, and renames it into place
+    def place_file(self):
+        with open(self.get_temp_file_name(0), "ab") as file:
+            for stream in range(1, self.num_streams):
+                if stream not in self.streams: continue
+                with open(self.get_temp_file_name(stream), "rb") as segment:
+                    shutil.copyfileobj(segment, file)
+        os.replace(self.get_temp_file_name(0), self.get_output_file_name())
+        self.output_file_names = [ self.get_output_file_name() ]
+        # (segments are only removed once the file is in place, so an interrupted writer can still be resumed)
+        for stream in range(1, self.num_streams):
+            if stream in self.streams: os.remove(self.get_temp_file_name(stream))
+
+    # Renames the shards of all streams into place, numbered in order (replacing any from a previous fetch)
+    def place_shards(self):
+        root, extension = os.path.splitext(self.file_name)
+        for file_name in glob.glob(f"{glob.escape(root)}-[0-9]*{extension}{self.extension}"):
+            os.remove(file_name)
+        self.output_file_names = []
+        for stream in range(self.num_streams):
+            if stream not in self.streams: continue
+            progress = self.streams[stream]["progress"]
+            for stream_shard in range(progress["shard"] + 1):
+                temp_file_name = self.get_temp_file_name(stream, stream_shard)
+                # (only a stream's last shard can be empty)
+                if stream_shard==progress["shard"] and progress["records"]==0:
+                    os.remove(temp_file_name)
+                    continue
+                self.output_file_names.append(self.get_output_file_name(len(self.output_file_names)))
+                os.replace(temp_file_name, self.output_file_names[-1])
@@ -29,6 +29,9 @@ setuptools.setup (
     packages = setuptools.find_namespace_packages(include=['lightbeam', 'lightbeam.*']),
     # package_data={'lightbeam': ['resources/*.txt']},
     install_requires = install_requires,
+    extras_require = {
+        "zstd": ["zstandard"],
+    },
     python_requires='>=3',
     entry_points='''
         [console_scripts]
@@ -0,0 +1,135 @@
+import os
+import glob
+import time
+import asyncio
+import logging
+import pytest
+from types import SimpleNamespace
+
+from lightbeam.api import EdFiAPI
+from lightbeam.plan import EndpointPlan
+from lightbeam.lightbeam import Lightbeam
+
+
+def get_requests(mock_api):
+    return mock_api.stats()["paths"]
+
+# API metadata (the base URL's, the dependencies, and the Swagger docs) is cached in a bundle, and later
+# runs only check that it's still current
+def test_metadata_bundle(mock_api, lightbeam):
+    lightbeam.write_students(3)
+    assert lightbeam("validate").returncode == 0
+    requests = get_requests(mock_api)
+    for path in ["/", "/metadata/", "/metadata/data/v3/dependencies", "/metadata/data/v3/resources/swagger.json", "/metadata/data/v3/descriptors/swagger.json"]:
+        assert requests[f"GET {path}"] == 1
+    assert len(glob.glob(os.path.join(lightbeam.state_dir, "cache", "metadata-*.dat"))) == 1
+    swagger_files = glob.glob(os.path.join(lightbeam.state_dir, "cache", "swagger-*.dat"))
+    assert len(swagger_files) == 2
+    modified = [ os.path.getmtime(file_name) for file_name in swagger_files ]
+
+    mock_api.reset_stats()
+    assert lightbeam("validate").returncode == 0
+    requests = get_requests(mock_api)
+    # (each document is requested again, conditionally, and is still current - so the Swagger isn't re-cached;
+    # nor are descriptor values re-fetched)
+    assert all(path.startswith("GET /metadata/") or path=="GET /" for path in requests)
+    assert all(count==1 for count in requests.values())
+    assert [ os.path.getmtime(file_name) for file_name in swagger_files ] == modified
+
+    # `--wipe` re-fetches it all
+    mock_api.reset_stats()
+    assert lightbeam("validate", "--wipe").returncode == 0
+    assert "GET /data/v3/ed-fi/birthSexDescriptors" in get_requests(mock_api)
+
+# With `--offline`, only the cached metadata is used
+def test_offline(mock_api, lightbeam):
+    lightbeam.write_students(3)
+    process = lightbeam("validate", "--offline")
+    assert process.returncode != 0
+    assert "can't be loaded `--offline`" in process.stdout
+    assert lightbeam("validate").returncode == 0
+
+    mock_api.reset_stats()
+    output = lightbeam("validate", "--offline").stdout
+    assert "all lines validate ok" in output
+    assert get_requests(mock_api) == {}
+
+
+def make_api(mock_api):
+    lightbeam = SimpleNamespace(logger=logging.getLogger("lightbeam"), token_version=0,
+        config={"connection": {"verify_ssl": False, "timeout": 60}})
+    api = EdFiAPI(lightbeam)
+    api.config = {"oauth_url": mock_api.base_url + "oauth/token", "client_id": "client_id", "client_secret": "client_secret"}
+    return api
+
+async def get_headers_concurrently(api, number):
+    return await asyncio.gather(*[ api.get_headers() for _ in range(number) ])
+
+async def refresh_concurrently(api, token_version, number):
+    await asyncio.gather(*[ api.refresh_oauth(token_version) for _ in range(number) ])
+
+# A token about to expire is refreshed before it's used, once, however many requests are waiting for it
+def test_proactive_single_flight_refresh(mock_api):
+    api = make_api(mock_api)
+    api.do_oauth()
+    assert mock_api.stats()["tokens"] == 1
+    token = api.token
+    # (still fresh: not refreshed)
+    asyncio.run(get_headers_concurrently(api, 50))
+    assert mock_api.stats()["tokens"] == 1
+
+    api.token_refresh_at = time.time() - 1
+    headers = asyncio.run(get_headers_concurrently(api, 50))
+    assert mock_api.stats()["tokens"] == 2
+    assert api.token != token
+    assert all(h["authorization"]=="Bearer " + api.token for h in headers)
+
+# Tasks which all got a 401 with the same token refresh it only once
+def test_single_flight_refresh_after_401(mock_api):
+    api = make_api(mock_api)
+    api.do_oauth()
+    asyncio.run(refresh_concurrently(api, api.lightbeam.token_version, 50))
+    assert mock_api.stats()["tokens"] == 2
+    # (a token version that's since been replaced isn't refreshed again)
+    asyncio.run(refresh_concurrently(api, api.lightbeam.token_version - 1, 50))
+    assert mock_api.stats()["tokens"] == 2
+
+# Over a send which outlasts several tokens, tokens are refreshed as they expire - a few times, not once for
+# each request which got a 401 (as requests queued for a connection may, with a token that's since expired)
+@pytest.mark.parametrize("mock_api", [{"token_expiry": 2, "latency_ms": 50}], indirect=True)
+def test_send_refreshes_expiring_tokens(mock_api, lightbeam):
+    lightbeam.write_students(200)
+    assert lightbeam("send").returncode == 0
+    stats = mock_api.stats()
+    assert 1 < stats["tokens"] < 10
+    assert stats["records"]["students"] == 200
+
+# Loading the Swagger again (with the same version) keeps the EndpointPlans built since, to be saved
+def test_reload_swagger_keeps_endpoint_plans(mock_api, lightbeam):
+    lb = Lightbeam(lightbeam.write_config(), logger=logging.getLogger("lightbeam"))
+    lb.api.load_swagger_docs()
+    plan = lb.api.get_endpoint_plan("students")
+    lb.api.load_swagger_docs()
+    assert lb.api.endpoint_plans["students"] is plan
+    assert lb.api.endpoint_plans_changed
+    lb.api.save_endpoint_plans()
+    assert glob.glob(os.path.join(lightbeam.state_dir, "cache", "endpoint-plans-*.dat")) == [lb.api.endpoint_plans_file]
+
+# Only the values of descriptors which a selected endpoint's descriptor properties can hold are loaded, or all
+# of them if any such property can't be matched to a descriptor
+def test_descriptor_endpoints():
+    lightbeam = SimpleNamespace(logger=logging.getLogger("lightbeam"),
+        all_endpoints=["gradeLevelDescriptors", "sexDescriptors", "schools", "students", "studentSchoolAssociations", "surveys"])
+    api = EdFiAPI(lightbeam)
+    for endpoint, paths in {
+        "schools": [("gradeLevels", "*", "gradeLevelDescriptor")],
+        "students": [("birthSexDescriptor",)],
+        "studentSchoolAssociations": [("entryGradeLevelDescriptor",)],
+        "surveys": [("surveyCategoryDescriptor",)],
+    }.items():
+        api.endpoint_plans[endpoint] = EndpointPlan(endpoint, "ed-fi", "resources", "", "")
+        api.endpoint_plans[endpoint].descriptor_paths = paths
+    assert api.get_descriptor_endpoints(["schools"]) == ["gradeLevelDescriptors"]
+    assert api.get_descriptor_endpoints(["students", "studentSchoolAssociations"]) == ["gradeLevelDescriptors", "sexDescriptors"]
+    assert api.get_descriptor_endpoints(["students", "surveys"]) == ["gradeLevelDescriptors", "sexDescriptors"]
+    assert api.get_descriptor_endpoints([]) == []
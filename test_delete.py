@@ -0,0 +1,131 @@
+import os
+import asyncio
+import logging
+
+from lightbeam import hashlog
+from lightbeam.delete import Deleter
+from lightbeam.lightbeam import Lightbeam
+
+
+STUDENTS_PATH = "/data/v3/ed-fi/students"
+
+# The number of requests the mock API received with `method` for the students endpoint (or for `id`s of it)
+def count_requests(mock_api, method, ids=False):
+    return sum(count for path, count in mock_api.stats()["paths"].items()
+        if path==f"{method} {STUDENTS_PATH}" or (ids and path.startswith(f"{method} {STUDENTS_PATH}/")))
+
+def count_students(mock_api):
+    return mock_api.stats()["records"].get("students", 0)
+
+
+# Payloads are looked up in an index of the endpoint's records, built a page at a time
+def test_delete_by_index(mock_api, lightbeam):
+    lightbeam.write_students(30)
+    assert lightbeam("send").returncode == 0
+    # (without state, so no `id`s were saved, and every payload must be looked up)
+    del lightbeam.config["state_dir"]
+    lightbeam.write_students(31)
+    lightbeam.config["fetch"] = {"page_size": 10}
+    lightbeam.config["delete"] = {"lookup": "index"}
+    mock_api.reset_stats()
+    output = lightbeam("delete").stdout
+    assert "indexing current records of endpoint students" in output
+    assert "payload not found in API" in output
+    assert count_students(mock_api) == 0
+    # (a request for the number of records, then one for each page of them, then a search for the payload not
+    # found in the index)
+    assert count_requests(mock_api, "GET") == 1 + 3 + 1
+    assert count_requests(mock_api, "DELETE", ids=True) == 30
+
+# Payloads are found in the index despite differences in formatting from the API's records; any which aren't
+# are searched for, as the API's search may still find them
+def test_delete_by_index_normalizes_identities(mock_api, lightbeam):
+    students = [ {"studentUniqueId": f"Ada{i}", "birthDate": "2015-09-01", "firstName": "Ada", "lastSurname": "Lovelace"} for i in range(30) ]
+    lightbeam.write_data("students", students)
+    del lightbeam.config["state_dir"]
+    assert lightbeam("send").returncode == 0
+    students[0]["studentUniqueId"] = "ADA0"
+    students[1]["studentUniqueId"] = " Ada1 "
+    lightbeam.write_data("students", students)
+    lightbeam.config["fetch"] = {"page_size": 10}
+    lightbeam.config["delete"] = {"lookup": "index"}
+    mock_api.reset_stats()
+    assert lightbeam("delete").returncode == 0
+    assert count_students(mock_api) == 0
+    # (" Ada1 " matches in the index, but wouldn't in the API's search; "ADA0" would in either)
+    assert count_requests(mock_api, "GET") == 1 + 3
+
+def test_identity_hash():
+    assert Deleter.get_identity_hash({"schoolId": "255901", "entryDate": "2024-08-15"}) == Deleter.get_identity_hash({"entryDate": "2024-08-15T00:00:00Z", "schoolId": 255901})
+    assert Deleter.get_identity_hash({"descriptor": "uri://ed-fi.org/GradeLevelDescriptor#Ninth grade"}) == Deleter.get_identity_hash({"descriptor": "uri://ed-fi.org/GradeLevelDescriptor#ninth Grade"})
+    assert Deleter.get_identity_hash({"schoolId": 255901}) != Deleter.get_identity_hash({"schoolId": 255902})
+    assert Deleter.get_identity_hash({"entryDate": "2024-08-15"}) != Deleter.get_identity_hash({"entryDate": "2024-08-15T12:00:00Z"})
+
+# ... unless searching for each payload takes fewer requests
+def test_delete_by_search(mock_api, lightbeam):
+    lightbeam.write_students(25)
+    del lightbeam.config["state_dir"]
+    assert lightbeam("send").returncode == 0
+    lightbeam.write_students(2)
+    lightbeam.config["fetch"] = {"page_size": 10}
+    mock_api.reset_stats()
+    output = lightbeam("delete").stdout
+    assert "indexing" not in output
+    assert count_students(mock_api) == 23
+    # (a request for the number of records, then a search for each payload)
+    assert count_requests(mock_api, "GET") == 1 + 2
+
+
+# Payloads sent (from the same `state_dir`) are deleted by the `id` saved then, without looking them up
+def test_delete_by_saved_id(mock_api, lightbeam):
+    lightbeam.write_students(20)
+    assert lightbeam("send").returncode == 0
+    hashlog_file = os.path.join(lightbeam.state_dir, "students.dat")
+    assert all(len(entry)==3 for entry in hashlog.load(hashlog_file).values())
+    mock_api.reset_stats()
+    # (`--force`, since payloads in the hashlog are otherwise skipped)
+    assert lightbeam("delete", "--force").returncode == 0
+    assert count_students(mock_api) == 0
+    assert count_requests(mock_api, "GET") == 0
+    assert count_requests(mock_api, "DELETE", ids=True) == 20
+    # (deleted payloads are removed from the hashlog)
+    assert hashlog.load(hashlog_file) == {}
+
+# ... unless the record has since been deleted and re-created (with another `id`), when it's looked up
+def test_delete_by_saved_id_falls_back_to_lookup(mock_api, lightbeam):
+    lightbeam.write_students(20)
+    assert lightbeam("send").returncode == 0
+    state_dir = lightbeam.config.pop("state_dir")
+    assert lightbeam("delete").returncode == 0
+    assert lightbeam("send").returncode == 0
+    lightbeam.config["state_dir"] = state_dir
+    mock_api.reset_stats()
+    assert lightbeam("delete", "--force").returncode == 0
+    assert count_students(mock_api) == 0
+    # (a 404 for each saved `id`, then a search for the payload, then its deletion)
+    assert count_requests(mock_api, "DELETE", ids=True) == 2 * 20
+    assert count_requests(mock_api, "GET") == 20
+    assert hashlog.load(os.path.join(state_dir, "students.dat")) == {}
+
+
+# Endpoints are deleted a dependency level at a time, in reverse dependency order; those of a level concurrently
+def test_reverse_dependency_levels(mock_api, lightbeam):
+    lb = Lightbeam(lightbeam.write_config(), logger=logging.getLogger("lightbeam"))
+    selected = {"gradeLevelDescriptors", "schoolTypeDescriptors", "students", "stateEducationAgencies", "schools", "studentSchoolAssociations", "disciplineActions"}
+    endpoints = [ endpoint for endpoint in lb.all_endpoints if endpoint in selected ]
+    levels = [
+        ["studentSchoolAssociations", "disciplineActions"],
+        ["schools"],
+        ["stateEducationAgencies", "students"],
+        ["gradeLevelDescriptors", "schoolTypeDescriptors"],
+    ]
+    assert lb.api.get_dependency_levels(endpoints) == list(reversed(levels))
+
+    events = []
+    async def do_endpoint(endpoint):
+        events.append(("start", endpoint))
+        await asyncio.sleep(0.05)
+        events.append(("end", endpoint))
+    lb.run_reverse_dependency_levels(endpoints, do_endpoint)
+    # (every endpoint of a level starts before any of them ends, and the next level starts after they all end)
+    assert events == [ (event, endpoint) for level in levels for event in ["start", "end"] for endpoint in level ]
@@ -0,0 +1,171 @@
+import os
+import json
+import asyncio
+import logging
+import pytest
+
+from lightbeam import util
+from lightbeam import hashlog
+from lightbeam.lightbeam import Lightbeam
+
+
+def read_students(file_names):
+    records = []
+    for file_name in file_names:
+        with util.open_data_file(file_name) as file:
+            records.extend(json.loads(line) for line in file)
+    return sorted(records, key=lambda record: record["studentUniqueId"])
+
+def test_fetch(lightbeam):
+    lightbeam.write_students(25)
+    with open(os.path.join(lightbeam.data_dir, "students.jsonl")) as file:
+        sent = [ json.loads(line) for line in file ]
+    assert lightbeam("send").returncode == 0
+    os.remove(os.path.join(lightbeam.data_dir, "students.jsonl"))
+
+    lightbeam.config["fetch"] = {"page_size": 10}
+    assert lightbeam("fetch", "-s", "students").returncode == 0
+    fetched = read_students([ os.path.join(lightbeam.data_dir, "students.jsonl") ])
+    assert len(fetched) == 25
+    assert all("id" in record for record in fetched)
+
+    assert lightbeam("fetch", "-s", "students", "--drop-keys", "id,_etag,_lastModifiedDate").returncode == 0
+    assert read_students([ os.path.join(lightbeam.data_dir, "students.jsonl") ]) == sent
+
+def test_fetch_compressed_shards(lightbeam):
+    lightbeam.write_students(25)
+    assert lightbeam("send").returncode == 0
+
+    # (with offset paging, all records are one stream - see `EndpointWriter`)
+    lightbeam.config["fetch"] = {"page_size": 10, "pagination": "offset", "compression": "gzip", "shard_records": 10}
+    lightbeam.config["data_dir"] = os.path.join(lightbeam.dir, "fetched")
+    os.mkdir(lightbeam.config["data_dir"])
+    assert lightbeam("fetch", "-s", "students").returncode == 0
+    shards = [ os.path.join(lightbeam.dir, "fetched", "students", f"part-{shard:05d}.jsonl.gz") for shard in range(3) ]
+    assert sorted(os.path.join(lightbeam.dir, "fetched", "students", name) for name in os.listdir(os.path.join(lightbeam.dir, "fetched", "students"))) == shards
+    assert [ util.count_records(shard) for shard in shards ] == [10, 10, 5]
+    assert len(read_students(shards)) == 25
+
+# With cursor paging, each partition's pages (by `pageToken`) together return every record exactly once
+def test_fetch_cursor_paging(mock_api, lightbeam):
+    lightbeam.write_students(50)
+    assert lightbeam("send").returncode == 0
+    os.remove(os.path.join(lightbeam.data_dir, "students.jsonl"))
+
+    lightbeam.config["fetch"] = {"page_size": 7, "pagination": "cursor", "partitions": 3}
+    mock_api.reset_stats()
+    assert lightbeam("fetch", "-s", "students").returncode == 0
+    fetched = read_students([ os.path.join(lightbeam.data_dir, "students.jsonl") ])
+    assert [ record["studentUniqueId"] for record in fetched ] == [ f"{i:06d}" for i in range(50) ]
+    requests = mock_api.stats()["paths"]
+    assert requests["GET /data/v3/ed-fi/students/partitions"] == 1
+    # (a request for the count, then 3 partitions of 17, 17, and 16 records, in pages of 7)
+    assert requests["GET /data/v3/ed-fi/students"] == 1 + 3 * 3
+
+# A page which can't be loaded is given up on (after `connection.num_retries` attempts), so the fetch ends -
+# with an error, and the endpoint left to be fetched again with `--resume`
+@pytest.mark.parametrize("mock_api", [{"error_rate": 0.5, "random_seed": 1}], indirect=True)
+def test_fetch_gives_up_on_failed_pages(mock_api, lightbeam):
+    lightbeam.write_students(100)
+    lightbeam.config["connection"].update({"num_retries": 30})
+    assert lightbeam("send").returncode == 0
+    os.remove(os.path.join(lightbeam.data_dir, "students.jsonl"))
+
+    lightbeam.config["fetch"] = {"page_size": 10, "pagination": "offset"}
+    lightbeam.config["connection"].update({"num_retries": 1})
+    process = lightbeam("fetch", "-s", "students")
+    assert process.returncode != 0
+    assert "students could not be completely fetched" in process.stdout
+    assert os.path.isfile(os.path.join(lightbeam.state_dir, "fetch-progress.dat"))
+
+    lightbeam.config["connection"].update({"num_retries": 30})
+    assert lightbeam("fetch", "-s", "students", "--resume").returncode == 0
+    fetched = read_students([ os.path.join(lightbeam.data_dir, "students.jsonl") ])
+    assert [ record["studentUniqueId"] for record in fetched ] == [ f"{i:06d}" for i in range(100) ]
+
+# An incremental fetch fetches only the changes since the change version saved by the previous one
+def test_fetch_incremental(mock_api, lightbeam):
+    lightbeam.write_students(10)
+    assert lightbeam("send").returncode == 0
+    data_dir = lightbeam.config["data_dir"]
+    fetched_dir = os.path.join(lightbeam.dir, "fetched")
+    os.mkdir(fetched_dir)
+    lightbeam.config.update({"data_dir": fetched_dir, "fetch": {"page_size": 10, "incremental": True}})
+    change_versions_file = os.path.join(lightbeam.state_dir, "fetch-change-versions.dat")
+
+    assert lightbeam("fetch", "-s", "students").returncode == 0
+    change_versions, = hashlog.load(change_versions_file).values()
+    version = change_versions["students"]
+    assert version > 0
+    files = [ f"000000000000-{version:012d}.jsonl" ]
+    assert os.listdir(os.path.join(fetched_dir, "students")) == files
+    assert len(read_students([ os.path.join(fetched_dir, "students", files[0]) ])) == 10
+
+    # (nothing has changed, so nothing is requested)
+    mock_api.reset_stats()
+    assert lightbeam("fetch", "-s", "students").returncode == 0
+    assert not any(path.startswith("GET /data/") for path in mock_api.stats()["paths"])
+    assert os.listdir(os.path.join(fetched_dir, "students")) == files
+
+    lightbeam.config["data_dir"] = data_dir
+    lightbeam.write_students(15, first_name="Grace")
+    assert lightbeam("send").returncode == 0
+    lightbeam.config["data_dir"] = fetched_dir
+    assert lightbeam("fetch", "-s", "students").returncode == 0
+    change_versions, = hashlog.load(change_versions_file).values()
+    assert change_versions == {"students": version + 15}
+    changes = read_students([ os.path.join(fetched_dir, "students", f"{version+1:012d}-{version+15:012d}.jsonl") ])
+    assert [ record["studentUniqueId"] for record in changes ] == [ f"{i:06d}" for i in range(15) ]
+    assert all(record["firstName"]=="Grace" for record in changes)
+
+# With a `--query-file`, each (distinct) query is paged through, and records returned for more than one
+# query are written once
+def test_fetch_query_file(mock_api, lightbeam):
+    lightbeam.write_data("students", [
+        {"studentUniqueId": f"{i:06d}", "birthDate": "2015-09-01", "firstName": "Ada" if i<15 else "Grace", "lastSurname": "Lovelace"}
+        for i in range(30)
+    ])
+    assert lightbeam("send").returncode == 0
+    os.remove(os.path.join(lightbeam.data_dir, "students.jsonl"))
+    with open(os.path.join(lightbeam.dir, "queries.jsonl"), "w") as file:
+        for query in [{"firstName": "Ada"}, {"studentUniqueId": "000001"}, {"firstName": "Ada"}, {"firstName": "Grace", "lastSurname": "Lovelace"}, {"nickname": "Ada"}]:
+            file.write(json.dumps(query) + "\n")
+
+    lightbeam.config["fetch"] = {"page_size": 4}
+    mock_api.reset_stats()
+    process = lightbeam("fetch", "-s", "students", "--query-file", "queries.jsonl")
+    assert process.returncode == 0
+    assert "1 queries contain keys that are not params for the endpoint students" in process.stdout
+    fetched = read_students([ os.path.join(lightbeam.data_dir, "students.jsonl") ])
+    assert [ record["studentUniqueId"] for record in fetched ] == [ f"{i:06d}" for i in range(30) ]
+    # (15 records in 4 pages for each `firstName`, and 1 page for the `studentUniqueId`; no counts)
+    assert mock_api.stats()["paths"]["GET /data/v3/ed-fi/students"] == 4 + 1 + 4
+
+# Each endpoint's pages are requested as soon as its count arrives, while other endpoints' counts are pending
+def test_fetch_pages_before_all_counts(mock_api, lightbeam):
+    lightbeam.write_students(25)
+    assert lightbeam("send").returncode == 0
+    os.remove(os.path.join(lightbeam.data_dir, "students.jsonl"))
+    lightbeam.config["fetch"] = {"page_size": 10}
+    lb = Lightbeam(lightbeam.write_config(), logger=logging.getLogger("lightbeam"), selector="students,schools")
+    fetcher = lb.fetcher
+
+    # (the count of schools only arrives once a page of students has been requested; if paging waited for
+    # all counts, it never would)
+    paging_started = asyncio.Event()
+    counted = []
+    get_record_count = lb.counter.get_record_count
+    async def get_record_count_after_paging(endpoint, params={}):
+        if endpoint=="schools": await asyncio.wait_for(paging_started.wait(), timeout=10)
+        counted.append(endpoint)
+        return await get_record_count(endpoint, params)
+    lb.counter.get_record_count = get_record_count_after_paging
+    get_page = fetcher.get_page
+    async def get_page_and_signal(endpoint, *args, **kwargs):
+        paging_started.set()
+        return await get_page(endpoint, *args, **kwargs)
+    fetcher.get_page = get_page_and_signal
+
+    fetcher.fetch()
+    assert counted == ["students", "schools"]
+    assert len(read_students([ os.path.join(lightbeam.data_dir, "students.jsonl") ])) == 25
@@ -0,0 +1,50 @@
+import os
+import json
+
+
+def read_records(lightbeam, endpoint):
+    with open(os.path.join(lightbeam.data_dir, f"{endpoint}.jsonl")) as file:
+        return [ json.loads(line) for line in file ]
+
+def read_files(lightbeam):
+    contents = {}
+    for file_name in sorted(os.listdir(lightbeam.data_dir)):
+        with open(os.path.join(lightbeam.data_dir, file_name)) as file:
+            contents[file_name] = file.read()
+    return contents
+
+# Generated records are unique by their identity (even where there are few of a referenced endpoint's
+# records), and their references resolve to other generated records
+def test_generate_unique_identities(lightbeam):
+    lightbeam.config["generate"] = {"records": 3000, "counts": {"schools": 2, "students": 500}}
+    assert lightbeam("generate", "-s", "studentSchoolAssociations").returncode == 0
+
+    students = read_records(lightbeam, "students")
+    schools = read_records(lightbeam, "schools")
+    associations = read_records(lightbeam, "studentSchoolAssociations")
+    assert (len(students), len(schools), len(associations)) == (500, 2, 3000)
+    assert len(set(student["studentUniqueId"] for student in students)) == 500
+    assert len(set(school["schoolId"] for school in schools)) == 2
+    identities = set(
+        (association["studentReference"]["studentUniqueId"], association["schoolReference"]["schoolId"], association["entryDate"])
+        for association in associations)
+    assert len(identities) == 3000
+    assert set(identity[0] for identity in identities) <= set(student["studentUniqueId"] for student in students)
+    assert set(identity[1] for identity in identities) <= set(school["schoolId"] for school in schools)
+
+    lightbeam.config["validate"] = {"methods": ["schema", "descriptors", "uniqueness", "references"], "references": {"remote": False}}
+    output = lightbeam("validate").stdout
+    assert output.count("all lines validate ok") == 3
+
+# Output is the same for the same `generate.seed`, and existing files are only overwritten with `--force`
+def test_generate_seed(lightbeam):
+    lightbeam.config["generate"] = {"records": 50}
+    assert lightbeam("generate", "-s", "studentSchoolAssociations").returncode == 0
+    generated = read_files(lightbeam)
+    assert lightbeam("generate", "-s", "studentSchoolAssociations").returncode != 0
+    assert lightbeam("generate", "-s", "studentSchoolAssociations", "--force").returncode == 0
+    assert read_files(lightbeam) == generated
+
+    lightbeam.config["generate"]["seed"] = 1
+    assert lightbeam("generate", "-s", "studentSchoolAssociations", "--force").returncode == 0
+    assert read_files(lightbeam) != generated
@@ -0,0 +1,94 @@
+import os
+import sys
+import json
+import subprocess
+import pytest
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def read_results(lightbeam):
+    with open(os.path.join(lightbeam.dir, "results.json")) as file:
+        return json.load(file)["resources"]["students"]
+
+# A fused `validate+send` counts payloads which fail validation apart from those which fail to send
+def test_fused_validate_send(mock_api, lightbeam):
+    lightbeam.write_students(10)
+    with open(os.path.join(lightbeam.data_dir, "students.jsonl"), "a") as file:
+        file.write(json.dumps({"studentUniqueId": "invalid", "firstName": "Ada"}) + "\n")
+    lightbeam.config["validate"] = {"fused": True}
+    lightbeam("validate+send", "--results-file", "results.json")
+    results = read_results(lightbeam)
+    assert (results["records_processed"], results["records_invalid"], results["records_failed"]) == (11, 1, 0)
+    assert mock_api.stats()["records"]["students"] == 10
+
+    # payloads skipped (as already sent) are still validated, so a changed duplicate of one is caught
+    with open(os.path.join(lightbeam.data_dir, "students.jsonl"), "a") as file:
+        file.write(json.dumps({"studentUniqueId": "000001", "birthDate": "2015-09-01", "firstName": "Grace", "lastSurname": "Hopper"}) + "\n")
+    output = lightbeam("validate+send", "--results-file", "results.json").stdout
+    assert "VALIDATION ERROR (uniqueness at line 12)" in output
+    results = read_results(lightbeam)
+    assert (results["records_skipped"], results["records_invalid"], results["records_failed"]) == (10, 2, 0)
+
+# A fused `validate+send` stops once `validate.references.max_failures` payloads have failed validation
+def test_fused_validate_send_fail_fast(mock_api, lightbeam):
+    lightbeam.write_data("students", [ {"studentUniqueId": f"invalid{i}", "firstName": "Ada"} for i in range(300) ])
+    lightbeam.config["validate"] = {"fused": True, "references": {"max_failures": 5}}
+    process = lightbeam("validate+send", "--results-file", "results.json")
+    assert process.returncode != 0
+    assert "STOPPING; found 5 >= validate.references.max_failures=5" in process.stdout
+    assert read_results(lightbeam)["records_invalid"] == 5
+    assert mock_api.stats()["records"]["students"] == 0
+
+# References not in local data are looked up in the API (with the client POSTs are sent with), several at once
+# (since each payload is validated in its own task, rather than as the data file is read)
+@pytest.mark.parametrize("mock_api", [{"latency_ms": 20}], indirect=True)
+def test_fused_validate_send_remote_references(mock_api, lightbeam):
+    lightbeam.config["generate"] = {"records": 20, "counts": {"schools": 2, "students": 10}}
+    assert lightbeam("generate", "-s", "studentSchoolAssociations").returncode == 0
+    assert lightbeam("send", "-s", "schools,students").returncode == 0
+    for endpoint in ["schools", "students"]:
+        os.remove(os.path.join(lightbeam.data_dir, f"{endpoint}.jsonl"))
+    with open(os.path.join(lightbeam.data_dir, "studentSchoolAssociations.jsonl")) as file:
+        invalid = json.loads(file.readline())
+    invalid["studentReference"]["studentUniqueId"] = "missing"
+    with open(os.path.join(lightbeam.data_dir, "studentSchoolAssociations.jsonl"), "a") as file:
+        file.write(json.dumps(invalid) + "\n")
+
+    lightbeam.config["validate"] = {"fused": True, "methods": ["schema", "descriptors", "uniqueness", "references"]}
+    mock_api.reset_stats()
+    output = lightbeam("validate+send", "-s", "studentSchoolAssociations", "--results-file", "results.json").stdout
+    assert "payload contains an invalid studentReference" in output
+    with open(os.path.join(lightbeam.dir, "results.json")) as file:
+        results = json.load(file)["resources"]["studentSchoolAssociations"]
+    assert (results["records_processed"], results["records_invalid"], results["records_failed"]) == (21, 1, 0)
+    assert mock_api.stats()["records"]["studentSchoolAssociations"] == 20
+    assert mock_api.stats()["paths"]["GET /data/v3/ed-fi/students"] > 0
+    assert mock_api.stats()["concurrency"]["GET /data/v3/ed-fi/students"] > 1
+
+# Progress is reported against the number of payloads when the data files' counts are cached (by `count` or
+# a previous `send`, and only while the files are unchanged), without reading the files to count them
+def test_send_progress_from_cached_counts(mock_api, lightbeam):
+    lightbeam.write_students(4000)
+    assert "processed 2000 of" not in lightbeam("send").stdout
+    assert "processed 2000 of 4000 payloads (50%)" in lightbeam("send", "--force").stdout
+
+    lightbeam.write_students(4001, first_name="Grace")
+    assert "processed 2000 of" not in lightbeam("send").stdout
+    lightbeam.write_students(4002, first_name="Ida")
+    lightbeam.config["count"] = {"mode": "local"}
+    assert "4002\tstudents" in lightbeam("count").stdout
+    assert "processed 2000 of 4002 payloads" in lightbeam("send").stdout
+
+# `send` doesn't import the (slow-to-import) dependencies only other commands need
+def test_send_imports(mock_api, lightbeam):
+    lightbeam.write_students(3)
+    process = subprocess.run([sys.executable, "-X", "importtime", "-m", "lightbeam", "send", "-c", lightbeam.write_config()],
+        cwd=lightbeam.dir, env=dict(os.environ, PYTHONPATH=ROOT_DIR), capture_output=True, text=True)
+    assert process.returncode == 0
+    assert mock_api.stats()["records"]["students"] == 3
+    # (`-X importtime` writes a line per module imported, like `import time: 123 | 456 | jsonschema.validators`)
+    modules = set(line.split("|")[-1].strip().split(".")[0] for line in process.stderr.splitlines() if line.startswith("import time:"))
+    assert "aiohttp" in modules
+    assert "jsonschema" not in modules
+    assert "pandas" not in modules
@@ -0,0 +1,48 @@
+import json
+import pytest
+
+from lightbeam.splitter import JSONArraySplitter
+
+
+RECORDS = [
+    {"id": "a", "name": "plain"},
+    {"id": "b", "name": "brackets ] } [ { in a string", "escaped": "a \"quoted\" \\ backslash\\"},
+    {"id": "c", "items": [{"x": [1, 2, {"y": []}]}, {}], "unicode": "é中"},
+    {"id": "d", "deep": json.loads("[" * 20 + "]" * 20)},
+    [1, 2, 3],
+]
+
+def split(data, chunk_size):
+    splitter = JSONArraySplitter()
+    elements = []
+    for i in range(0, len(data), chunk_size):
+        elements.extend(splitter.feed(data[i:i+chunk_size]))
+    splitter.close()
+    return elements
+
+# The elements are the same however the array is split into chunks (even across strings and escapes)
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 64, 100000])
+def test_split(chunk_size):
+    data = json.dumps(RECORDS, indent=2, ensure_ascii=False).encode("utf-8")
+    elements = split(data, chunk_size)
+    assert [json.loads(element) for element in elements] == RECORDS
+    # (each element is on one line, for JSONL)
+    assert all(b"\n" not in element for element in elements)
+
+def test_split_compact():
+    data = json.dumps(RECORDS, separators=(",", ":")).encode("utf-8")
+    assert split(data, 5) == [json.dumps(record, separators=(",", ":")).encode("utf-8") for record in RECORDS]
+
+def test_split_empty():
+    assert split(b"[]", 1) == []
+    assert split(b" \n[ \n] \n", 1) == []
+
+@pytest.mark.parametrize("data", [b'{"id": "a"}', b'[1, 2]', b'["a"]', b'[{"id": "a"}] []'])
+def test_split_invalid(data):
+    with pytest.raises(ValueError):
+        split(data, 1)
+
+@pytest.mark.parametrize("data", [b'', b'[{"id": "a"}', b'[{"id": "a"}, {"id": "b"'])
+def test_split_incomplete(data):
+    with pytest.raises(ValueError):
+        split(data, 3)
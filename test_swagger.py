@@ -0,0 +1,91 @@
+import os
+import glob
+import copy
+import json
+import pytest
+
+from lightbeam import swagger as swagger_cache
+
+
+SWAGGER = {
+    "swagger": "2.0",
+    "info": {"title": "Ed-Fi"},
+    "definitions": {
+        "edFi_school": {"type": "object", "properties": {"schoolId": {"type": "integer"}}, "required": ["schoolId"]},
+        "edFi_student": {"type": "object", "properties": {"studentUniqueId": {"type": "string", "maxLength": 32}}},
+    },
+    "paths": {
+        "/ed-fi/schools": {"get": {"parameters": [{"name": "schoolId", "in": "query"}]}},
+    },
+}
+
+OPENAPI = {
+    "openapi": "3.0.1",
+    "components": {
+        "schemas": {"edFi_school": {"type": "object"}},
+        "securitySchemes": {"oauth2_client_credentials": {"type": "oauth2"}},
+    },
+    "paths": {"/ed-fi/schools": {}},
+}
+
+@pytest.mark.parametrize("swagger", [SWAGGER, OPENAPI, {"swagger": "2.0"}])
+def test_round_trip(tmp_path, swagger):
+    file_name = str(tmp_path / "swagger.dat")
+    original = copy.deepcopy(swagger)
+    swagger_cache.save(file_name, swagger, {"reports_identity": True})
+    assert swagger == original
+    loaded, info = swagger_cache.load(file_name)
+    assert info == {"reports_identity": True}
+    # (the sections are `Mapping`s, which compare equal to `dict`s with the same items)
+    assert json.loads(json.dumps(loaded, default=dict)) == original
+    assert not os.path.exists(file_name + ".tmp")
+
+# Definitions and paths are only loaded when they're first used
+def test_lazy_sections(tmp_path):
+    file_name = str(tmp_path / "swagger.dat")
+    swagger_cache.save(file_name, SWAGGER)
+    loaded, _ = swagger_cache.load(file_name)
+    definitions = loaded["definitions"]
+    assert isinstance(definitions, swagger_cache.LazySection)
+    assert not isinstance(definitions, dict)
+    assert sorted(definitions) == ["edFi_school", "edFi_student"]
+    assert "edFi_school" in definitions and "edFi_staff" not in definitions
+    assert definitions.items_loaded == {}
+    assert definitions["edFi_school"] == SWAGGER["definitions"]["edFi_school"]
+    assert list(definitions.items_loaded) == ["edFi_school"]
+    assert loaded["info"] == SWAGGER["info"]
+
+def test_load_unsupported_format(tmp_path, monkeypatch):
+    file_name = str(tmp_path / "swagger.dat")
+    monkeypatch.setattr(swagger_cache, "FORMAT_VERSION", 0)
+    swagger_cache.save(file_name, SWAGGER)
+    monkeypatch.undo()
+    with pytest.raises(ValueError):
+        swagger_cache.load(file_name)
+
+
+# A cached Swagger doc which can't be read is re-fetched (and cached again)
+@pytest.mark.parametrize("corrupt", [
+    lambda data: data[:100],
+    lambda data: b"",
+    lambda data: b"\xff" * len(data),
+])
+def test_corrupt_cache(mock_api, lightbeam, corrupt):
+    lightbeam.write_students(3)
+    assert lightbeam("validate").returncode == 0
+    for file_name in glob.glob(os.path.join(lightbeam.state_dir, "cache", "swagger-*.dat")):
+        with open(file_name, "rb") as file:
+            data = file.read()
+        with open(file_name, "wb") as file:
+            file.write(corrupt(data))
+
+    mock_api.reset_stats()
+    process = lightbeam("validate")
+    assert process.returncode == 0
+    assert "all lines validate ok" in process.stdout
+    requests = mock_api.stats()["paths"]
+    assert requests["GET /metadata/data/v3/resources/swagger.json"] == 2
+    assert requests["GET /metadata/data/v3/descriptors/swagger.json"] == 2
+
+    mock_api.reset_stats()
+    assert lightbeam("validate", "--offline").returncode == 0
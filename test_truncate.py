@@ -0,0 +1,35 @@
+import os
+import pytest
+
+from lightbeam import hashlog
+
+
+def test_truncate(mock_api, lightbeam):
+    lightbeam.write_students(45)
+    assert lightbeam("send").returncode == 0
+    lightbeam.config["fetch"] = {"page_size": 10}
+    assert lightbeam("truncate", "-s", "students").returncode == 0
+    assert mock_api.stats()["records"].get("students", 0) == 0
+    assert hashlog.load(os.path.join(lightbeam.state_dir, "students.dat")) == {}
+
+# If some records can't be read or deleted, truncate exits with an error (keeping the hashlog), and can be re-run
+@pytest.mark.parametrize("mock_api", [{"error_rate": 0.1, "random_seed": 1}], indirect=True)
+def test_truncate_with_errors(mock_api, lightbeam):
+    lightbeam.write_students(200)
+    assert lightbeam("send").returncode == 0
+    hashlog_file = os.path.join(lightbeam.state_dir, "students.dat")
+    assert len(hashlog.load(hashlog_file)) == 200
+
+    lightbeam.config["fetch"] = {"page_size": 10}
+    lightbeam.config["connection"].update({"num_retries": 1, "retry_statuses": []})
+    process = lightbeam("truncate", "-s", "students")
+    assert process.returncode != 0
+    assert "students could not be completely truncated" in process.stdout
+    assert mock_api.stats()["records"]["students"] > 0
+    assert len(hashlog.load(hashlog_file)) == 200
+
+    del lightbeam.config["connection"]["retry_statuses"]
+    lightbeam.config["connection"]["num_retries"] = 10
+    assert lightbeam("truncate", "-s", "students").returncode == 0
+    assert mock_api.stats()["records"].get("students", 0) == 0
+    assert hashlog.load(hashlog_file) == {}
@@ -0,0 +1,93 @@
+import gzip
+import importlib.util
+import pytest
+
+from lightbeam import util
+
+
+ZSTD = pytest.mark.skipif(importlib.util.find_spec("zstandard") is None, reason="requires `zstandard`")
+
+
+PAYLOAD = {
+    "schoolId": 1,
+    "gradeLevels": [
+        {"gradeLevelDescriptor": "uri://ed-fi.org/GradeLevelDescriptor#First grade"},
+        {"gradeLevelDescriptor": "uri://ed-fi.org/GradeLevelDescriptor#Second grade"},
+    ],
+    "addresses": [
+        {"periods": [{"beginDate": "2020-01-01"}, {"beginDate": "2021-01-01"}]},
+        {"periods": []},
+        {"periods": [{"beginDate": "2022-01-01"}]},
+    ],
+    "localEducationAgencyReference": {"localEducationAgencyId": 2},
+}
+
+def test_path_accessor():
+    assert util.compile_path_accessor(("schoolId",))(PAYLOAD) == [(1, ())]
+    assert util.compile_path_accessor(("localEducationAgencyReference", "localEducationAgencyId"))(PAYLOAD) == [(2, ())]
+    # (missing properties have no values)
+    assert util.compile_path_accessor(("nameOfInstitution",))(PAYLOAD) == []
+    assert util.compile_path_accessor(("schoolId", "nested"))(PAYLOAD) == []
+
+def test_path_accessor_arrays():
+    accessor = util.compile_path_accessor(("gradeLevels", "*", "gradeLevelDescriptor"))
+    assert accessor(PAYLOAD) == [
+        ("uri://ed-fi.org/GradeLevelDescriptor#First grade", (0,)),
+        ("uri://ed-fi.org/GradeLevelDescriptor#Second grade", (1,)),
+    ]
+    accessor = util.compile_path_accessor(("addresses", "*", "periods", "*", "beginDate"))
+    assert accessor(PAYLOAD) == [("2020-01-01", (0, 0)), ("2021-01-01", (0, 1)), ("2022-01-01", (2, 0))]
+    # (a property which isn't an array has no items)
+    assert util.compile_path_accessor(("schoolId", "*"))(PAYLOAD) == []
+    assert util.compile_path_accessor(("categories", "*", "categoryDescriptor"))(PAYLOAD) == []
+
+def test_find_by_key_suffix():
+    assert util.find_by_key_suffix(PAYLOAD, "Descriptor") == [
+        ("uri://ed-fi.org/GradeLevelDescriptor#First grade", ("gradeLevels", "*", "gradeLevelDescriptor"), (0,)),
+        ("uri://ed-fi.org/GradeLevelDescriptor#Second grade", ("gradeLevels", "*", "gradeLevelDescriptor"), (1,)),
+    ]
+    assert util.find_by_key_suffix(PAYLOAD, "Id") == [(1, ("schoolId",), ()), (2, ("localEducationAgencyReference", "localEducationAgencyId"), ())]
+    assert util.find_by_key_suffix(PAYLOAD, "Missing") == []
+
+def test_format_path():
+    assert util.format_path(("schoolId",), ()) == "schoolId"
+    assert util.format_path(("gradeLevels", "*", "gradeLevelDescriptor"), (1,)) == "gradeLevels[1].gradeLevelDescriptor"
+    assert util.format_path(("addresses", "*", "periods", "*", "beginDate"), (2, 0)) == "addresses[2].periods[0].beginDate"
+    assert util.format_path(("gradeLevels", "*"), (0,)) == "gradeLevels[0]"
+
+
+@pytest.mark.parametrize("content, num_records", [
+    (b"", 0),
+    (b"\n\n", 0),
+    (b'{"a": 1}', 1),
+    (b'{"a": 1}\n', 1),
+    (b'{"a": 1}\n{"a": 2}\n{"a": 3}', 3),
+    (b'{"a": 1}\n{"a": 2}\n\n \n', 2),
+    (b'{"a": 1}\r\n{"a": 2}\r\n', 2),
+])
+@pytest.mark.parametrize("compression", [None, "gzip", pytest.param("zstd", marks=ZSTD)])
+def test_count_records(tmp_path, content, num_records, compression):
+    file_name = str(tmp_path / "schools.jsonl")
+    if compression=="gzip":
+        file_name += ".gz"
+        content = gzip.compress(content)
+    elif compression=="zstd":
+        import zstandard
+        file_name += ".zst"
+        content = zstandard.ZstdCompressor().compress(content)
+    with open(file_name, "wb") as file:
+        file.write(content)
+    assert util.count_records(file_name) == num_records
+
+# (records and trailing blank lines may span chunks)
+@pytest.mark.parametrize("chunk_size", [1, 3, 8, 1024])
+def test_count_records_in_chunks(tmp_path, monkeypatch, chunk_size):
+    monkeypatch.setattr(util, "COUNT_CHUNK_SIZE", chunk_size)
+    file_name = str(tmp_path / "schools.jsonl")
+    with open(file_name, "w") as file:
+        file.write('{"a": 1}\n{"a": 2}\n{"a": 3}\n\n\n  \n\n')
+    assert util.count_records(file_name) == 3
+    with open(file_name, "w") as file:
+        file.write('{"a": 1}\n\n{"a": 2}')
+    # (blank lines between records are counted, like records, so line numbers match)
+    assert util.count_records(file_name) == 3
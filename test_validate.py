@@ -0,0 +1,99 @@
+import logging
+from types import SimpleNamespace
+
+from lightbeam.validate import Validator
+
+
+def make_validator():
+    validator = Validator(SimpleNamespace(logger=logging.getLogger("lightbeam"), reset_counters=lambda: None))
+    validator.cacheable_methods = ("descriptors", "schema", "uniqueness")
+    validator.swagger_version = "School:abc"
+    validator.descriptors_version = "def"
+    return validator
+
+# A payload's validation result is only re-used under the same methods, Swagger, and descriptor values
+def test_previously_validated():
+    validator = make_validator()
+    validator.validation_hashlog_data = { b"hash": (0, ("descriptors", "schema", "uniqueness"), "School:abc", "def", None) }
+    assert validator.is_previously_validated(b"hash")
+    assert not validator.is_previously_validated(b"other")
+    assert not validator.is_previously_validated(None)
+
+    validator.swagger_version = "School:changed"
+    assert not validator.is_previously_validated(b"hash")
+    validator.swagger_version = "School:abc"
+
+    validator.descriptors_version = "changed"
+    assert not validator.is_previously_validated(b"hash")
+    # (... unless descriptors aren't validated)
+    validator.cacheable_methods = ("schema", "uniqueness")
+    assert validator.is_previously_validated(b"hash")
+
+def test_previously_validated_by_fewer_methods():
+    validator = make_validator()
+    validator.validation_hashlog_data = { b"hash": (0, ("schema",), "School:abc", "def", None) }
+    assert not validator.is_previously_validated(b"hash")
+    validator.cacheable_methods = ("schema",)
+    assert validator.is_previously_validated(b"hash")
+
+
+def test_validate_reuses_results(lightbeam):
+    lightbeam.write_students(20)
+    assert "all lines validate ok" in lightbeam("validate").stdout
+    output = lightbeam("validate").stdout
+    assert "re-used previous validation results for 20 of 20 payloads" in output
+
+    # changed payloads are re-validated
+    lightbeam.write_students(20, first_name="Grace")
+    output = lightbeam("validate").stdout
+    assert "all lines validate ok" in output
+    assert "re-used previous validation results" not in output
+
+    # `--force` ignores previous results
+    assert "re-used previous validation results" not in lightbeam("validate", "--force").stdout
+
+def test_validate_by_more_methods(lightbeam):
+    lightbeam.write_students(20)
+    lightbeam.config["validate"] = {"methods": ["schema"]}
+    lightbeam("validate")
+    lightbeam.config["validate"] = {"methods": ["schema", "descriptors", "uniqueness"]}
+    assert "re-used previous validation results" not in lightbeam("validate").stdout
+    # (payloads validated by more methods needn't be re-validated by fewer)
+    lightbeam.config["validate"] = {"methods": ["schema"]}
+    assert "re-used previous validation results for 20 of 20 payloads" in lightbeam("validate").stdout
+
+def test_validate_reports_duplicates_of_previously_validated_payloads(lightbeam):
+    lightbeam.write_students(5)
+    lightbeam("validate")
+    lightbeam.write_data("students", [
+        {"studentUniqueId": "000001", "birthDate": "2015-09-01", "firstName": "Ada", "lastSurname": "Lovelace"},
+        {"studentUniqueId": "000001", "birthDate": "2015-09-01", "firstName": "Ada", "lastSurname": "Lovelace"},
+    ])
+    output = lightbeam("validate").stdout
+    assert "VALIDATION ERROR (uniqueness at line 2)" in output
+    assert "re-used previous validation results for 1 of 2 payloads" in output
+
+# Only the values of descriptors used by the endpoints being validated (of those selected, the ones with data)
+# are fetched
+def test_validate_loads_only_descriptors_used(lightbeam, mock_api):
+    lightbeam.write_students(5)
+    mock_api.reset_stats()
+    assert "all lines validate ok" in lightbeam("validate").stdout
+    fetched = set(path.split("/")[-1] for path in mock_api.stats()["paths"] if path.startswith("GET ") and path.endswith("Descriptors"))
+    assert fetched == {"birthSexDescriptors"}
+
+# Descriptor values are also checked in properties the Swagger doesn't describe (like some extensions'), if the
+# values of their descriptors are loaded
+def test_validate_descriptors_not_in_swagger(lightbeam):
+    student = {"studentUniqueId": "000001", "birthDate": "2015-09-01", "firstName": "Ada", "lastSurname": "Lovelace",
+        "birthSexDescriptor": "uri://ed-fi.org/BirthSexDescriptor#Female"}
+    lightbeam.write_data("students", [
+        dict(student, _ext={"sample": {"otherBirthSexDescriptor": "uri://ed-fi.org/BirthSexDescriptor#Male"}}),
+        dict(student, studentUniqueId="000002", _ext={"sample": {"otherBirthSexDescriptor": "uri://ed-fi.org/BirthSexDescriptor#Other"}}),
+        dict(student, studentUniqueId="000003", _ext={"sample": {"gradeLevelDescriptor": "uri://ed-fi.org/GradeLevelDescriptor#Other"}}),
+    ])
+    output = lightbeam("validate").stdout
+    assert "VALIDATION ERROR (descriptors at line 2): uri://ed-fi.org/BirthSexDescriptor#Other is not a valid descriptor value for otherBirthSexDescriptor (at _ext.sample)" in output
+    # (`gradeLevelDescriptors` aren't loaded for `students`, so its values can't be checked)
+    assert "values of gradeLevelDescriptor aren't validated" in output
+    assert "VALIDATION ERRORS on 1 of 3 lines" in output
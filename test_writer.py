@@ -0,0 +1,147 @@
+import os
+import glob
+import shutil
+import asyncio
+import importlib.util
+import pytest
+
+from lightbeam import util
+from lightbeam.writer import EndpointWriter
+
+
+# `num_pages` pages (of `page_size` JSONL records) of each of `num_streams` streams
+def make_pages(num_streams, num_pages, page_size=3):
+    return [
+        [ b"".join(f'{{"stream": {stream}, "page": {page}, "record": {record}}}\n'.encode() for record in range(page_size))
+            for page in range(num_pages) ]
+        for stream in range(num_streams)
+    ]
+
+def read_records(file_names):
+    records = b""
+    for file_name in file_names:
+        with util.open_data_file(file_name, binary=True) as file:
+            records += file.read()
+    return records
+
+# Writes some of `pages` (of each stream) with a writer, in the order given by `order` (a list of (stream,
+# page)), and waits for them all to be written; returns the progress passed to each checkpoint
+async def write_pages(writer, pages, order, resume_from=None, close=True):
+    checkpoints = []
+    written = asyncio.Event()
+    num_left = len(order)
+    def on_written():
+        nonlocal num_left
+        num_left -= 1
+        if num_left==0: written.set()
+    writer.start(num_streams=len(pages), resume_from=resume_from, on_checkpoint=checkpoints.append)
+    for stream, page in order:
+        writer.write(stream, page, pages[stream][page], on_written=on_written, checkpoint=f"after-{page}")
+    if order: await written.wait()
+    if close: await writer.close()
+    else: await asyncio.sleep(0.1) # (for the last checkpoints)
+    return checkpoints
+
+
+# Pages are written in order, whatever order they arrive in
+def test_write_in_order(tmp_path):
+    file_name = str(tmp_path / "schools.jsonl")
+    pages = make_pages(2, 5)
+    writer = EndpointWriter(file_name)
+    order = [ (stream, page) for page in reversed(range(5)) for stream in range(2) ]
+    asyncio.run(write_pages(writer, pages, order))
+    assert writer.output_file_names == [ file_name ]
+    assert read_records([ file_name ]) == b"".join(pages[0] + pages[1])
+    assert glob.glob(str(tmp_path / "*.tmp*")) == []
+
+
+ZSTD = pytest.mark.skipif(importlib.util.find_spec("zstandard") is None, reason="requires `zstandard`")
+WRITER_OPTIONS = [
+    {},
+    {"compression": "gzip"},
+    pytest.param({"compression": "zstd"}, marks=ZSTD),
+    {"shard_records": 4},
+    {"compression": "gzip", "shard_bytes": 200},
+]
+
+# A writer interrupted after some pages can be resumed from any checkpoint (anything written after it is
+# discarded), and the result is the same as if it hadn't been interrupted
+@pytest.mark.parametrize("options", WRITER_OPTIONS)
+@pytest.mark.parametrize("resume_at", [0, 3, 7])
+def test_resume(tmp_path, monkeypatch, options, resume_at):
+    monkeypatch.setattr(EndpointWriter, "CHECKPOINT_INTERVAL", 0)
+    file_name = str(tmp_path / "schools.jsonl")
+    pages = make_pages(2, 5)
+    order = [ (stream, page) for page in range(5) for stream in range(2) ]
+
+    # (the temporary files of an interrupted writer are those left before it's closed)
+    interrupted_dir = str(tmp_path / "interrupted")
+    os.mkdir(interrupted_dir)
+    async def interrupt():
+        writer = EndpointWriter(file_name, **options)
+        checkpoints = await write_pages(writer, pages, order, close=False)
+        for temp_file_name in glob.glob(str(tmp_path / "*.tmp*")):
+            shutil.copy(temp_file_name, interrupted_dir)
+        await writer.close()
+        return checkpoints, writer.output_file_names
+    checkpoints, output_file_names = asyncio.run(interrupt())
+    for output_file_name in output_file_names:
+        os.remove(output_file_name)
+    for temp_file_name in glob.glob(os.path.join(interrupted_dir, "*")):
+        shutil.move(temp_file_name, str(tmp_path))
+
+    progress = checkpoints[resume_at]
+    assert progress[0]["checkpoint"] == f"after-{progress[0]['pages'] - 1}"
+    writer = EndpointWriter(file_name, **options)
+    assert writer.can_resume(progress)
+    rest = [ (stream, page) for stream, page in order if page >= (progress[stream]["pages"] if progress[stream] else 0) ]
+    asyncio.run(write_pages(writer, pages, rest, resume_from=progress))
+    assert writer.output_file_names == output_file_names
+    assert read_records(output_file_names) == b"".join(pages[0] + pages[1])
+    assert glob.glob(str(tmp_path / "*.tmp*")) == []
+
+def test_cannot_resume_without_temporary_files(tmp_path):
+    writer = EndpointWriter(str(tmp_path / "schools.jsonl"))
+    assert not writer.can_resume([ {"pages": 2, "checkpoint": None, "shard": 0, "bytes": 100, "records": 0, "size": 0} ])
+    assert writer.can_resume([ None ])
+
+
+@pytest.mark.parametrize("compression, extension", [
+    ("gzip", ".gz"),
+    pytest.param("zstd", ".zst", marks=ZSTD),
+])
+def test_compression(tmp_path, compression, extension):
+    file_name = str(tmp_path / "schools.jsonl")
+    pages = make_pages(2, 5)
+    writer = EndpointWriter(file_name, compression=compression)
+    asyncio.run(write_pages(writer, pages, [ (stream, page) for stream in range(2) for page in range(5) ]))
+    assert writer.output_file_names == [ file_name + extension ]
+    assert read_records(writer.output_file_names) == b"".join(pages[0] + pages[1])
+    assert util.count_records(file_name + extension) == 30
+
+# Each stream is split into shards of at most `shard_records` records, which are numbered in order
+def test_shard_records(tmp_path):
+    os.mkdir(tmp_path / "schools")
+    file_name = str(tmp_path / "schools" / "part.jsonl")
+    # (shards of a previous fetch are replaced)
+    (tmp_path / "schools" / "part-00009.jsonl").write_text("{}\n")
+    pages = make_pages(2, 5)
+    writer = EndpointWriter(file_name, shard_records=4)
+    asyncio.run(write_pages(writer, pages, [ (stream, page) for page in range(5) for stream in range(2) ]))
+    # (15 records of each stream: 4 + 4 + 4 + 3)
+    assert writer.output_file_names == [ str(tmp_path / "schools" / f"part-{shard:05d}.jsonl") for shard in range(8) ]
+    assert sorted(glob.glob(str(tmp_path / "schools" / "*"))) == writer.output_file_names
+    assert [ util.count_records(name) for name in writer.output_file_names ] == [4, 4, 4, 3, 4, 4, 4, 3]
+    assert read_records(writer.output_file_names) == b"".join(pages[0] + pages[1])
+
+# Shards hold at most `shard_bytes` (uncompressed) bytes, so break between records
+def test_shard_bytes(tmp_path):
+    file_name = str(tmp_path / "part.jsonl")
+    pages = make_pages(1, 5)
+    record_size = len(pages[0][0].splitlines()[0]) + 1
+    writer = EndpointWriter(file_name, compression="gzip", shard_bytes=2 * record_size + 1)
+    asyncio.run(write_pages(writer, pages, [ (0, page) for page in range(5) ]))
+    assert len(writer.output_file_names) == 8
+    assert all(name.endswith(".jsonl.gz") for name in writer.output_file_names)
+    assert [ util.count_records(name) for name in writer.output_file_names ] == [2] * 7 + [1]
+    assert read_records(writer.output_file_names) == b"".join(pages[0])